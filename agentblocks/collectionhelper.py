@@ -68,6 +68,7 @@ def ingest_into_collection(
     chat_state: ChatState,
     is_new_collection: bool,
     retry_with_random_name: bool = False,
+    ids: list[str] | None = None,
 ) -> ChromaDDG:
     """
     Load provided documents and metadata into a new or existing collection.
@@ -79,6 +80,9 @@ def ingest_into_collection(
     metadata fields to the collection (overwriting such fields in the passed metadata).
     If is_new_collection is False, it will only add the "updated_at" field, and only if
     collection_metadata is not None.
+
+    If ids are passed, they are used as the ids of the full documents in the collection
+    (see ingest_into_chroma).
     """
     logger.info("Creating new collection and loading data")
 
@@ -102,6 +106,7 @@ def ingest_into_collection(
                 openai_api_key=chat_state.openai_api_key,
                 chroma_client=chat_state.vectorstore.client,
                 collection_metadata=full_metadata,
+                ids=ids,
             )
             break  # success
         except Exception as e:  # bad name error may not be ValueError in docker mode
@@ -0,0 +1,85 @@
+import hashlib
+import json
+
+from chromadb import Collection
+
+from utils.docgrab import FAKE_FULL_DOC_EMBEDDING
+from utils.prepare import get_logger
+
+logger = get_logger()
+
+# Agent state is stored in its collection as "state records": records with a fake
+# embedding, whose metadata has the STATE_RECORD_TYPE_KEY field (so that retrieval
+# skips them, see components.chroma_ddg.is_state_record). The state is split into
+# records so that saving only writes the records that changed since the state was
+# loaded or last saved. To tell what changed, we keep the digests of the records.
+Record = tuple[str | None, dict]  # (document, metadata); document is None if unknown
+RecordDigests = dict[str, tuple[str, str | None]]  # id -> (metadata, document)
+
+
+def get_digest(text: str) -> str:
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+
+def get_record_digests(records: dict[str, Record]) -> RecordDigests:
+    """Get the digests of the metadata and document of each record, by record id."""
+    return {
+        record_id: (
+            get_digest(json.dumps(metadata, sort_keys=True)),
+            None if document is None else get_digest(document),
+        )
+        for record_id, (document, metadata) in records.items()
+    }
+
+
+def save_state_records(
+    collection: Collection, records: dict[str, Record], old_digests: RecordDigests
+) -> RecordDigests:
+    """
+    Save state records in the collection, writing only the records that changed
+    compared to the digests of the stored records, and deleting the stored records
+    that are no longer there. A record whose document is None keeps its stored
+    document. Return the digests of the records as now stored.
+    """
+    new_digests: RecordDigests = {}
+    ids_to_upsert, documents_to_upsert, metadatas_to_upsert = [], [], []
+    ids_to_update, metadatas_to_update = [], []
+    for record_id, (metadata_digest, document_digest) in get_record_digests(
+        records
+    ).items():
+        document, metadata = records[record_id]
+        old_metadata_digest, old_document_digest = old_digests.get(
+            record_id, (None, None)
+        )
+        if record_id not in old_digests or (
+            document_digest is not None and document_digest != old_document_digest
+        ):
+            ids_to_upsert.append(record_id)
+            documents_to_upsert.append(document or "")
+            metadatas_to_upsert.append(metadata)
+        elif metadata_digest != old_metadata_digest:
+            # Keep the stored document (e.g. a link text that wasn't loaded)
+            ids_to_update.append(record_id)
+            metadatas_to_update.append(metadata)
+            document_digest = old_document_digest
+        else:
+            document_digest = old_document_digest
+        new_digests[record_id] = (metadata_digest, document_digest)
+    ids_to_delete = [x for x in old_digests if x not in new_digests]
+
+    if ids_to_upsert:
+        collection.upsert(
+            ids_to_upsert,
+            [FAKE_FULL_DOC_EMBEDDING] * len(ids_to_upsert),
+            metadatas_to_upsert,
+            documents_to_upsert,
+        )
+    if ids_to_update:
+        collection.update(ids_to_update, metadatas=metadatas_to_update)
+    if ids_to_delete:
+        collection.delete(ids_to_delete)  # e.g. reports removed by a reset
+    logger.info(
+        f"Saved state records: {len(ids_to_upsert)} written, "
+        f"{len(ids_to_update)} updated, {len(ids_to_delete)} deleted"
+    )
+    return new_digests
@@ -1,11 +1,20 @@
+from concurrent.futures import Future
 from typing import Callable
 
 from pydantic import BaseModel, Field
 
-from agentblocks.webretrieve import get_content_from_urls
+from agentblocks.webretrieve import (
+    URLRetrievalData,
+    aget_content_from_urls,
+    get_content_from_urls,
+)
+from utils.async_utils import shared_loop
+from utils.prepare import get_logger
 from utils.type_utils import Doc
 from utils.web import LinkData
 
+logger = get_logger()
+
 DEFAULT_MIN_OK_URLS = 5
 DEFAULT_INIT_BATCH_SIZE = 0  # 0 = "auto-determined"
 
@@ -51,27 +60,63 @@ class URLConveyer(BaseModel):
         self.urls.extend(urls)
         self.idx_last_url_refresh = idx_to_cut_at
 
-    def retrieve_content_from_urls(
+    def get_retrieval_kwargs(
         self,
         min_ok_urls: int | None = None,  # use default_min_ok_urls if None
         init_batch_size: int | None = None,  # use default_init_batch_size if None
         batch_fetcher: Callable[[list[str]], list[str]] | None = None,
-    ):
-        url_retrieval_data = get_content_from_urls(
-            urls=self.urls[self.idx_first_not_tried :],
-            min_ok_urls=min_ok_urls
+    ) -> dict:
+        """Get the kwargs for (a)get_content_from_urls to retrieve the next URLs."""
+        return {
+            "urls": self.urls[self.idx_first_not_tried :],
+            "min_ok_urls": min_ok_urls
             if min_ok_urls is not None
             else self.default_min_ok_urls,
-            init_batch_size=init_batch_size
+            "init_batch_size": init_batch_size
             if init_batch_size is not None
             else self.default_init_batch_size,
-            batch_fetcher=batch_fetcher,
-        )
+            "batch_fetcher": batch_fetcher,
+        }
 
+    def add_retrieved_content(self, url_retrieval_data: URLRetrievalData):
+        """
+        Record the content retrieved for the URLs from idx_first_not_tried on.
+        """
         self.num_url_retrievals += 1
         self.link_data_dict.update(url_retrieval_data.link_data_dict)
         self.idx_first_not_tried += url_retrieval_data.idx_first_not_tried
 
+    def retrieve_content_from_urls(
+        self,
+        min_ok_urls: int | None = None,  # use default_min_ok_urls if None
+        init_batch_size: int | None = None,  # use default_init_batch_size if None
+        batch_fetcher: Callable[[list[str]], list[str]] | None = None,
+    ):
+        self.add_retrieved_content(
+            get_content_from_urls(
+                **self.get_retrieval_kwargs(min_ok_urls, init_batch_size, batch_fetcher)
+            )
+        )
+
+    def roll_back(self, idx: int) -> list[str]:
+        """
+        Make the URLs from idx on untried again (e.g. if their content was retrieved
+        but not used), so that they are retrieved again later. Return those of them
+        that had been tried.
+        """
+        if idx < 0 or idx > self.idx_first_not_tried:
+            raise ValueError(f"idx must be between 0 and {self.idx_first_not_tried}")
+
+        rolled_back_urls = self.urls[idx : self.idx_first_not_tried]
+        earlier_urls = set(self.urls[:idx])
+        for url in rolled_back_urls:
+            if url not in earlier_urls:
+                self.link_data_dict.pop(url, None)
+
+        self.idx_first_not_tried = idx
+        self.idx_first_not_done = min(self.idx_first_not_done, idx)
+        return rolled_back_urls
+
     def get_next_docs(self) -> list[Doc]:
         docs = []
         for url in self.urls[self.idx_first_not_done : self.idx_first_not_tried]:
@@ -82,6 +127,7 @@ class URLConveyer(BaseModel):
             if link_data.num_tokens is not None:
                 doc.metadata["num_tokens"] = link_data.num_tokens
             docs.append(doc)
+            link_data.text = None  # now held by the doc, no need to keep (and save) it
 
         self.idx_first_not_done = self.idx_first_not_tried
         return docs
@@ -102,3 +148,71 @@ class URLConveyer(BaseModel):
             batch_fetcher=batch_fetcher,
         )
         return self.get_next_docs()
+
+
+class URLPrefetcher:
+    """
+    Retrieves the content of the next URLs of a URLConveyer in the background (in
+    the shared event loop), e.g. while an LLM is analyzing the already retrieved
+    content. The retrieved content is only added to the URLConveyer when collected
+    with get_docs, so the URLConveyer is only ever modified by the caller's thread
+    (which shouldn't retrieve content from the URLConveyer's URLs in the meantime).
+
+    At most max_retrievals retrievals can be started, one at a time.
+    """
+
+    def __init__(
+        self,
+        url_conveyer: URLConveyer,
+        max_retrievals: int,
+        min_ok_urls: int | None = None,  # use default_min_ok_urls if None
+        init_batch_size: int | None = None,  # use default_init_batch_size if None
+    ):
+        self.url_conveyer = url_conveyer
+        self.max_retrievals = max_retrievals
+        self.min_ok_urls = min_ok_urls
+        self.init_batch_size = init_batch_size
+        self.num_started_retrievals = 0
+        self._future: Future | None = None
+
+    @property
+    def is_in_flight(self) -> bool:
+        return self._future is not None
+
+    def start(self) -> bool:
+        """
+        Start retrieving the content of the next untried URLs. Return False (and do
+        nothing) if a retrieval is already in flight, max_retrievals retrievals were
+        already started or there are no untried URLs.
+        """
+        if (
+            self._future is not None
+            or self.num_started_retrievals >= self.max_retrievals
+            or not self.url_conveyer.num_untried_urls
+        ):
+            return False
+        self.num_started_retrievals += 1
+        self._future = shared_loop.submit(
+            aget_content_from_urls(
+                **self.url_conveyer.get_retrieval_kwargs(
+                    self.min_ok_urls, self.init_batch_size
+                )
+            )
+        )
+        return True
+
+    def get_docs(self) -> list[Doc]:
+        """
+        Wait for the retrieval in flight to finish, add the retrieved content to the
+        URLConveyer and return the new docs (see URLConveyer.get_next_docs).
+        """
+        future, self._future = self._future, None
+        self.url_conveyer.add_retrieved_content(future.result())
+        return self.url_conveyer.get_next_docs()
+
+    def cancel(self) -> None:
+        """Cancel the retrieval in flight, if any, discarding its results."""
+        if self._future is not None:
+            logger.info("Cancelling URL prefetching")
+            self._future.cancel()
+            self._future = None
@@ -1,13 +1,21 @@
+import asyncio
+import time
 from typing import Callable
 
 from pydantic import BaseModel, Field
 
+from utils.async_utils import run_task_in_shared_loop
+from utils.domain_stats import get_domain_stats_registry
 from utils.prepare import get_logger
+from utils.search_cache import get_search_cache
 from utils.type_utils import DDGError
-from utils.web import LinkData, get_batch_url_fetcher
+from utils.url_cache import get_url_cache
+from utils.web import LinkData, aextract_link_data, afetch_link_data, astream_link_data
 
 logger = get_logger()
 
+DOMAIN_SKIPPED_ERROR = "DOMAIN_SKIPPED"
+
 
 class URLRetrievalData(BaseModel):
     urls: list[str]
@@ -16,88 +24,151 @@ class URLRetrievalData(BaseModel):
     idx_first_not_tried: int = 0  # different from len(link_data_dict) if urls repeat
 
 
-MAX_INIT_BATCH_SIZE = 10
+MAX_URLS_IN_FLIGHT = 20
 
 
-def get_content_from_urls(
+async def aget_content_from_urls(
     urls: list[str],
     min_ok_urls: int,
-    init_batch_size: int = 0,  # auto-determined if 0
+    init_batch_size: int = 0,  # max number of urls in flight; MAX_URLS_IN_FLIGHT if 0
     batch_fetcher: Callable[[list[str]], list[str]] | None = None,
 ) -> URLRetrievalData:
     """
-    Fetch content from a list of urls using a batch fetcher. If at least
-    min_ok_urls urls are fetched successfully, return the fetched content.
-    Otherwise, fetch a new batch of urls, and repeat until at least min_ok_urls
-    urls are fetched successfully.
-
-    If there are duplicate URLs
+    Asynchronously fetch content from a list of urls, processing each url's content
+    as soon as it arrives. Once the first urls fetched (see below) include
+    min_ok_urls urls fetched successfully, the fetches still in flight are
+    cancelled and the fetched content is returned.
+
+    The number of urls in flight is adapted to the observed success rates and
+    latencies of the urls' domains, so that the expected number of successfully
+    fetched urls reaches min_ok_urls in a single round trip (see
+    DomainStatsRegistry.get_num_urls_to_fetch). Urls from domains that keep
+    failing are not fetched (their LinkData has the DOMAIN_SKIPPED_ERROR error).
+
+    The keys of link_data_dict in the result are the tried urls in their original
+    order (repeated urls are tried only once), i.e. a prefix of the unique urls,
+    all of whose fetches completed. A slow url is therefore waited for before the
+    urls after it count. Urls whose fetches were cancelled (and any urls fetched
+    after the first of them) are not included and count as not tried, so they
+    can be fetched later.
+
+    Must be run in the shared event loop.
 
     Args:
     - urls: list of urls to fetch content from
     - min_ok_urls: minimum number of urls that need to be fetched successfully
-    - init_batch_size: initial batch size to fetch content from
-    - batch_fetcher: function to fetch content from a batch of urls
+    - init_batch_size: max number of urls to fetch at the same time
+      (MAX_URLS_IN_FLIGHT if 0)
+    - batch_fetcher: function to fetch content from a batch of urls (if not
+      provided, the default fetcher is used, which extracts text from each
+      page while other pages are still being fetched)
 
     Returns:
     - URLRetrievalData: object containing the fetched content
     """
     try:
-        batch_fetcher = batch_fetcher or get_batch_url_fetcher()
-        init_batch_size = init_batch_size or min(
-            MAX_INIT_BATCH_SIZE, round(min_ok_urls * 1.2)
-        )  # NOTE: could optimize
+        max_urls_in_flight = init_batch_size or MAX_URLS_IN_FLIGHT
 
         logger.info(
             f"Fetching content from {len(urls)} urls:\n"
             f" - {min_ok_urls} successfully obtained URLs needed\n"
-            f" - {init_batch_size} is the initial batch size\n"
+            f" - {max_urls_in_flight} is the max number of URLs in flight\n"
         )
 
-        res = URLRetrievalData(urls=urls)
-        num_urls = len(urls)
-        url_set = set()  # to keep track of unique urls
+        if batch_fetcher:
+
+            async def afetch_link_data_func(url: str) -> LinkData:
+                html = (await asyncio.to_thread(batch_fetcher, [url]))[0]
+                return await aextract_link_data(html)
 
-        # If, say, only 3 ok urls are still needed, we might want to try fetching 3 + extra
-        num_extras = max(2, init_batch_size - min_ok_urls)
+        else:
+            afetch_link_data_func = afetch_link_data
 
-        while res.num_ok_urls < min_ok_urls:
-            batch_size = min(
-                init_batch_size,
-                min_ok_urls - res.num_ok_urls + num_extras,
+        domain_stats_registry = get_domain_stats_registry()
+
+        async def afetch_link_data_and_record_outcome(url: str) -> LinkData:
+            if domain_stats_registry.should_skip(url):
+                return LinkData(error=DOMAIN_SKIPPED_ERROR)
+            t_start = time.monotonic()
+            try:
+                link_data = await afetch_link_data_func(url)
+            except asyncio.CancelledError:
+                latency_s = time.monotonic() - t_start
+                domain_stats_registry.record_cancelled_fetch(url, latency_s)
+                raise
+            latency_s = time.monotonic() - t_start
+            domain_stats_registry.record_fetch(url, link_data.error, latency_s)
+            return link_data
+
+        res = URLRetrievalData(urls=urls)
+        unique_urls = list(dict.fromkeys(urls))
+        completed_link_data: dict[str, LinkData] = {}
+        num_ok_completed_urls = 0  # including ones after a url still in flight
+        num_unique_urls_tried = 0  # length of the prefix of completed unique urls
+
+        def get_max_in_flight() -> int:
+            # Urls are started in order, so these are the urls in flight, then the rest
+            urls_not_done = [u for u in unique_urls if u not in completed_link_data]
+            return domain_stats_registry.get_num_urls_to_fetch(
+                urls_not_done, min_ok_urls - num_ok_completed_urls, max_urls_in_flight
             )
-            batch_urls = []
-            for url in urls[res.idx_first_not_tried :]:
-                if len(batch_urls) == batch_size:
-                    break
-                if url in url_set:
-                    continue
-                batch_urls.append(url)
-                url_set.add(url)
-                res.idx_first_not_tried += 1
-
-            if (batch_size := len(batch_urls)) == 0:
-                break  # no more urls to fetch
-
-            logger.info(f"Fetching {batch_size} urls:\n- " + "\n- ".join(batch_urls))
-
-            # Fetch content from urls in batch
-            batch_htmls = batch_fetcher(batch_urls)
-
-            # Process fetched content
-            for url, html in zip(batch_urls, batch_htmls):
-                link_data = LinkData.from_raw_content(html)
-                res.link_data_dict[url] = link_data
-                if not link_data.error:
-                    res.num_ok_urls += 1
-
-            logger.info(
-                f"Total URLs processed: {res.idx_first_not_tried} ({num_urls} total)\n"
-                f"Total successful URLs: {res.num_ok_urls} ({min_ok_urls} needed)\n"
+
+        if min_ok_urls > 0:
+            link_data_stream = astream_link_data(
+                unique_urls, get_max_in_flight, afetch_link_data_and_record_outcome
             )
+            try:
+                async for url, link_data in link_data_stream:
+                    completed_link_data[url] = link_data
+                    if not link_data.error:
+                        num_ok_completed_urls += 1
+
+                    # Add the urls that now complete the prefix, in original order
+                    for next_url in unique_urls[num_unique_urls_tried:]:
+                        next_link_data = completed_link_data.get(next_url)
+                        if next_link_data is None:
+                            break  # still in flight
+                        res.link_data_dict[next_url] = next_link_data
+                        if not next_link_data.error:
+                            res.num_ok_urls += 1
+                        num_unique_urls_tried += 1
+                    if res.num_ok_urls >= min_ok_urls:
+                        break
+            finally:
+                await link_data_stream.aclose()  # cancels the fetches in flight
+
+        if num_unique_urls_tried:
+            last_tried_url = unique_urls[num_unique_urls_tried - 1]
+            res.idx_first_not_tried = urls.index(last_tried_url) + 1
+
+        num_not_kept = len(completed_link_data) - len(res.link_data_dict)
+        logger.info(
+            f"Total URLs processed: {res.idx_first_not_tried} ({len(urls)} total)\n"
+            f"Total successful URLs: {res.num_ok_urls} ({min_ok_urls} needed)\n"
+            f"URLs fetched after a cancelled one (not kept): {num_not_kept}\n"
+        )
+        if url_cache := get_url_cache():
+            logger.debug(f"URL cache stats: {url_cache.get_stats()}")
+        if search_cache := get_search_cache():
+            logger.debug(f"Search cache stats: {search_cache.get_stats()}")
 
         return res
     except Exception as e:
         raise DDGError(
             user_facing_message="Apologies, I ran into a problem trying to fetch URL content."
         ) from e
+
+
+def get_content_from_urls(
+    urls: list[str],
+    min_ok_urls: int,
+    init_batch_size: int = 0,  # max number of urls in flight; MAX_URLS_IN_FLIGHT if 0
+    batch_fetcher: Callable[[list[str]], list[str]] | None = None,
+) -> URLRetrievalData:
+    """
+    Fetch content from a list of urls until at least min_ok_urls urls are fetched
+    successfully (or there are no more urls). See aget_content_from_urls for details.
+    """
+    return run_task_in_shared_loop(
+        aget_content_from_urls(urls, min_ok_urls, init_batch_size, batch_fetcher)
+    )
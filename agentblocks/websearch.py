@@ -3,11 +3,12 @@ from pydantic import BaseModel
 
 from agentblocks.core import enforce_pydantic_json
 from utils.algo import interleave_iterables, remove_duplicates_keep_order
-from utils.async_utils import gather_tasks_sync
 from utils.chat_state import ChatState
+from utils.domain_stats import extract_domain, get_domain_stats_registry
 from utils.prepare import get_logger
+from utils.search_cache import get_search_cache
+from utils.serper import SerperClient
 from utils.type_utils import DDGError
-from langchain_community.utilities import GoogleSerperAPIWrapper
 
 logger = get_logger()
 
@@ -24,14 +25,6 @@ class WebSearchAPIError(DDGError):
     default_user_facing_message = WEB_SEARCH_API_ISSUE_MSG
 
 
-def _extract_domain(url: str):
-    try:
-        full_domain = url.split("://")[-1].split("/")[0]  # blah.blah.domain.com
-        return ".".join(full_domain.split(".")[-2:])  # domain.com
-    except Exception:
-        return ""
-
-
 def get_links_from_search_results(search_results: list[dict[str, Any]]):
     logger.debug(
         f"Getting links from results of {len(search_results)} searches "
@@ -46,14 +39,79 @@ def get_links_from_search_results(search_results: list[dict[str, Any]]):
         f"Number of links for each query: {[len(links) for links in links_for_each_query]}"
     )
     # NOTE: can ask LLM to decide which links to keep
-    return [
+    links = [
         link
         for link in remove_duplicates_keep_order(
             interleave_iterables(links_for_each_query)
         )
-        if _extract_domain(link) not in domain_blacklist
+        if extract_domain(link) not in domain_blacklist
     ]
 
+    # Use past fetch outcomes: drop links from domains that are almost certain
+    # to fail and move links from domains that often fail to the end
+    domain_stats_registry = get_domain_stats_registry()
+    good_links, unreliable_links = [], []
+    for link in links:
+        if domain_stats_registry.should_skip(link):
+            continue
+        if domain_stats_registry.should_deprioritize(link):
+            unreliable_links.append(link)
+        else:
+            good_links.append(link)
+
+    num_dropped = len(links) - len(good_links) - len(unreliable_links)
+    if num_dropped or unreliable_links:
+        logger.debug(
+            f"Dropped {num_dropped} links and deprioritized {len(unreliable_links)} "
+            "links based on domain health"
+        )
+    return good_links + unreliable_links
+
+
+def _is_search_result_ok(search_result: dict[str, Any]) -> bool:
+    try:
+        return search_result["statusCode"] // 100 == 2
+    except KeyError:
+        logger.warning("No status code in search result, assuming success.")
+        return True
+
+
+def get_search_results(
+    queries: list[str], num_search_results: int = 10
+) -> list[dict[str, Any]]:
+    """
+    Do a Google search for each query and return the search results. Results are
+    cached (see utils.search_cache), so only queries that are not in the cache
+    are sent to the search API.
+    """
+    search_cache = get_search_cache()
+    search_results_by_query = {}
+    if search_cache:
+        for query in queries:
+            search_result = search_cache.get(query, num_search_results)
+            if search_result is not None:
+                search_results_by_query[query] = search_result
+        logger.info(
+            f"Found {len(search_results_by_query)} of {len(queries)} queries "
+            "in the search results cache"
+        )
+
+    if queries_to_search := [q for q in queries if q not in search_results_by_query]:
+        logger.info(f"Performing web search for queries: {queries_to_search}")
+        new_search_results = SerperClient().search(queries_to_search, num_search_results)
+
+        # Check for errors
+        for query, search_result in zip(queries_to_search, new_search_results):
+            if not _is_search_result_ok(search_result):
+                logger.error(f"Error in search result: {search_result}")
+                # search_result can be {"statusCode": 400, "message": "Not enough credits"}
+                raise WebSearchAPIError()  # TODO: add message, make sure it gets logged
+            search_results_by_query[query] = search_result
+            if search_cache:
+                search_cache.put(query, num_search_results, search_result)
+
+    return [search_results_by_query[query] for query in queries]
+
 
 def get_links_from_queries(
     queries: list[str], num_search_results: int = 10
@@ -62,21 +120,7 @@ def get_links_from_queries(
     Get links from a list of queries by doing a Google search for each query.
     """
     try:
-        # Do a Google search for each query
-        logger.info(f"Performing web search for queries: {queries}")
-        search = GoogleSerperAPIWrapper(k=num_search_results)
-        search_tasks = [search.aresults(query) for query in queries]
-        search_results = gather_tasks_sync(search_tasks)  # can use serper's batching
-
-        # Check for errors
-        for search_result in search_results:
-            try:
-                if search_result["statusCode"] // 100 != 2:
-                    logger.error(f"Error in search result: {search_result}")
-                    # search_result can be {"statusCode": 400, "message": "Not enough credits"}
-                    raise WebSearchAPIError() # TODO: add message, make sure it gets logged
-            except KeyError:
-                logger.warning("No status code in search result, assuming success.")
+        search_results = get_search_results(queries, num_search_results)
 
         # Get links from search results
         return get_links_from_search_results(search_results)
@@ -21,7 +21,7 @@ from utils.prepare import CONTEXT_LENGTH
 from utils.prompts import SUMMARIZER_PROMPT
 from utils.query_parsing import IngestCommand
 from utils.type_utils import INSTRUCT_SHOW_UPLOADER, AccessRole, ChatMode, Instruction
-from utils.web import LinkData, get_batch_url_fetcher
+from utils.web import get_batch_link_data_fetcher
 from langchain_core.documents import Document
 
 DEFAULT_MAX_TOKENS_FINAL_CONTEXT = int(CONTEXT_LENGTH * 0.7)
@@ -138,9 +138,8 @@ def get_ingester_summarizer_response(chat_state: ChatState):
             res = {"answer": summarize(docs, chat_state)}
     else:
         # If no uploaded docs, ingest or summarize the external resource
-        fetch_func = get_batch_url_fetcher()  # don't really need the batch aspect here
-        html = fetch_func([message])[0]
-        link_data = LinkData.from_raw_content(html)
+        fetch_func = get_batch_link_data_fetcher()  # don't need the batch aspect here
+        link_data = fetch_func([message])[0]
 
         if link_data.error:
             return format_nonstreaming_answer(
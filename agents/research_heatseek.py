@@ -1,5 +1,8 @@
-import json
-from pydantic import BaseModel, Field
+import os
+from collections import deque
+from concurrent.futures import Future
+
+from pydantic import BaseModel
 
 from agentblocks.collectionhelper import (
     construct_new_collection_name,
@@ -7,16 +10,18 @@ from agentblocks.collectionhelper import (
 )
 from agentblocks.core import enforce_pydantic_json
 from agentblocks.docconveyer import DocConveyer
-from agentblocks.webprocess import URLConveyer
+from agentblocks.webprocess import URLConveyer, URLPrefetcher
 from agentblocks.websearch import (
     get_links_from_queries,
     get_web_search_queries_from_prompt,
 )
+from agents.research_heatseek_data import HeatseekData, save_hs_data_records
+from utils.async_utils import shared_loop
 from utils.chat_state import ChatState
 from utils.helpers import DELIMITER40, format_nonstreaming_answer, get_timestamp
 from utils.prepare import CONTEXT_LENGTH, get_logger
 from utils.strings import has_which_substring
-from utils.type_utils import JSONishDict, Props
+from utils.type_utils import Doc, JSONishDict, Props
 from langchain_core.prompts import ChatPromptTemplate, PromptTemplate
 
 logger = get_logger()
@@ -313,21 +318,17 @@ def shorten_url(url: str) -> str:
     return parts[0] if parts else url
 
 
-class HeatseekData(BaseModel):
-    query: str
-    search_queries: list[str]
-    past_search_queries: list[str] = Field(default_factory=list)
-    url_conveyer: URLConveyer
-    doc_conveyer: DocConveyer
-    is_answer_found: bool = False
-    answers: list[str] = Field(default_factory=list)
-    evaluations: list[str] = Field(default_factory=list)
-
-
 MIN_OK_URLS = 5
 INIT_BATCH_SIZE = 8
+
+# Max number of sources to process at the same time (1 means one by one)
+HEATSEEK_MAX_CONCURRENT_SOURCES = int(os.getenv("HEATSEEK_MAX_CONCURRENT_SOURCES", 4))
 MAX_SUB_ITERATIONS_IN_ONE_GO = 12  # can only reach if some sites are big and get split
-MAX_URL_RETRIEVALS_IN_ONE_GO = 1
+MAX_URL_RETRIEVALS_IN_ONE_GO = 2  # the second one is normally prefetched (see below)
+
+# When fewer docs than this are ready to be analyzed, the content of the next URLs
+# starts being fetched in the background (0 means only fetching when out of docs)
+HEATSEEK_MIN_READY_DOCS = int(os.getenv("HEATSEEK_MIN_READY_DOCS", 3))
 
 NUM_URLS_BEFORE_REFRESH = 70
 NUM_LEFT_URLS_FOR_REFRESH = 12
@@ -338,77 +339,160 @@ content_insufficient_evaluations = ["BAD"]
 evaluations_to_record_answers = ["EXCELLENT", "GOOD", "MEDIUM"]
 
 
+class SourceResult(BaseModel):
+    reply: str
+    evaluation: str | None = None
+    is_content_insufficient: bool
+
+
+async def aget_source_result(
+    chat_state: ChatState, query: str, docs: list[Doc]
+) -> SourceResult:
+    """
+    Get the LLM's answer to the query from the docs of one source and, unless the
+    LLM says the content is insufficient, the evaluator's evaluation of the answer.
+    """
+    source = docs[0].metadata["source"]
+    context = f"SOURCE: {source}\n\n{''.join(doc.page_content for doc in docs)}"
+    logger.debug(f"Context:\n{DELIMITER40}{context}\n{DELIMITER40}")
+
+    inputs = {"query": query, "context": context}
+    reply = await chat_state.aget_llm_reply(
+        hs_answer_generator_prompt, inputs, to_user=False
+    )
+    logger.debug(f"LLM reply: {reply}")
+
+    # Check if content is insufficient (this can change from False to True if
+    # the evaluator gives a bad evaluation later on)
+    if "content does not contain needed information" in reply:
+        return SourceResult(reply=reply, is_content_insufficient=True)
+
+    # If LLM wrote a reply, evaluate it
+    inputs = {"query": query, "answer": reply}
+    logger.info(f"Getting response from evaluator for source: {source}")
+    evaluator_reply = await chat_state.aget_llm_reply(
+        answer_evaluator_prompt, inputs, to_user=False
+    )
+    evaluation = has_which_substring(
+        evaluator_reply, ["EXCELLENT", "GOOD", "MEDIUM", "BAD"]
+    )
+    logger.info(f"Evaluation: {evaluation}")
+    return SourceResult(
+        reply=reply,
+        evaluation=evaluation,
+        is_content_insufficient=evaluation in content_insufficient_evaluations,
+    )
+
+
+def get_next_source_docs(
+    hs_data: HeatseekData, url_prefetcher: URLPrefetcher
+) -> list[Doc]:
+    """
+    Get the docs for the next source (in heatseek, we only get one full doc at a time,
+    but if it's big, it can come in parts). If there are no docs left, first wait for
+    the content of the next URLs (being prefetched, or retrieved now if allowed).
+    Return an empty list if there are no docs available.
+    """
+    if hs_data.doc_conveyer.num_available_docs == 0:
+        if not url_prefetcher.is_in_flight and not url_prefetcher.start():
+            return []
+        logger.info("Waiting for the next batch of URL content")
+        hs_data.doc_conveyer.add_docs(url_prefetcher.get_docs())
+
+    return hs_data.doc_conveyer.get_next_docs(
+        max_tokens=CONTEXT_LENGTH * 0.5, max_full_docs=1
+    )
+
+
+def roll_back_unused_urls(hs_data: HeatseekData, idx_first_url: int) -> None:
+    """
+    Make the URLs tried since idx_first_url untried again, starting from the first
+    one with content that wasn't analyzed (e.g. it was prefetched for nothing), and
+    drop their docs, so that only what was actually used is saved. They will be
+    retrieved again when needed (normally from the URL cache).
+    """
+    url_conveyer, doc_conveyer = hs_data.url_conveyer, hs_data.doc_conveyer
+    used_sources = {
+        doc.metadata["source"]
+        for doc in doc_conveyer.docs[: doc_conveyer.idx_first_not_done]
+    }
+    for idx in range(idx_first_url, url_conveyer.idx_first_not_tried):
+        url = url_conveyer.urls[idx]
+        if url not in used_sources and not url_conveyer.link_data_dict[url].error:
+            break
+    else:
+        return  # all retrieved content was used
+
+    rolled_back_urls = set(url_conveyer.roll_back(idx))
+    doc_conveyer.docs = doc_conveyer.docs[: doc_conveyer.idx_first_not_done] + [
+        doc
+        for doc in doc_conveyer.docs[doc_conveyer.idx_first_not_done :]
+        if doc.metadata["source"] not in rolled_back_urls
+    ]
+    logger.info(f"Rolled back {len(rolled_back_urls)} unused URLs")
+
+
 def run_main_heatseek_workflow(
     chat_state: ChatState, hs_data: HeatseekData, init_reply=""
 ):
     if full_reply := init_reply:
         chat_state.add_to_output(full_reply)
 
-    # Process URLs one by one (unless content is too big, then split it up)
+    # Process up to HEATSEEK_MAX_CONCURRENT_SOURCES sources at a time, each getting an
+    # answer and then its evaluation, but handle the results in the sources' order.
+    # Each item of in_flight is (DocConveyer cursor before the source's docs, source,
+    # future of the SourceResult).
+    in_flight: deque[tuple[int, str, Future]] = deque()
+    num_started_sources = 0
+    are_docs_exhausted = False
     new_checked_block = True
     source = "SOME RANDOM STRING TO THEN INITIALIZE prev_source"
-    init_num_url_retrievals = hs_data.url_conveyer.num_url_retrievals
-    for _ in range(MAX_SUB_ITERATIONS_IN_ONE_GO):
-        # Get next batch of URLs if needed
-        if hs_data.doc_conveyer.num_available_docs == 0:
-            if (
-                hs_data.url_conveyer.num_url_retrievals - init_num_url_retrievals
-                >= MAX_URL_RETRIEVALS_IN_ONE_GO
+    url_prefetcher = URLPrefetcher(
+        hs_data.url_conveyer, max_retrievals=MAX_URL_RETRIEVALS_IN_ONE_GO
+    )
+    idx_first_url = hs_data.url_conveyer.idx_first_not_tried
+    try:
+        while True:
+            # Start processing more sources if possible
+            while (
+                not are_docs_exhausted
+                and len(in_flight) < HEATSEEK_MAX_CONCURRENT_SOURCES
+                and num_started_sources < MAX_SUB_ITERATIONS_IN_ONE_GO
             ):
-                logger.info("Reached max number of URL retrievals")
+                idx_first_doc = hs_data.doc_conveyer.idx_first_not_done
+                if not (docs := get_next_source_docs(hs_data, url_prefetcher)):
+                    logger.info("No more docs available in this round")
+                    are_docs_exhausted = True
+                    break
+                new_source = docs[0].metadata["source"]
+                logger.info(
+                    f"Getting response from LLM for source: {new_source} "
+                    f"(values of part_id: {[d.metadata.get('part_id') for d in docs]}"
+                )
+                future = shared_loop.submit(
+                    aget_source_result(chat_state, hs_data.query, docs)
+                )
+                in_flight.append((idx_first_doc, new_source, future))
+                num_started_sources += 1
+
+                # Fetch more content in the background if running low on docs
+                if (
+                    hs_data.doc_conveyer.num_available_docs < HEATSEEK_MIN_READY_DOCS
+                    and num_started_sources < MAX_SUB_ITERATIONS_IN_ONE_GO
+                    and url_prefetcher.start()
+                ):
+                    logger.info("Started prefetching the next batch of URL content")
+
+            if not in_flight:
                 break
-            logger.info("Getting next batch of URL content")
-            docs = hs_data.url_conveyer.get_next_docs_with_url_retrieval()
-            hs_data.doc_conveyer.add_docs(docs)
-
-        # Get a batch of docs (in heatseek,
-        # we only get one full doc at a time, but if it's big, it can come in parts)
-        docs = hs_data.doc_conveyer.get_next_docs(
-            max_tokens=CONTEXT_LENGTH * 0.5, max_full_docs=1
-        )
-        if not docs:
-            logger.warning("No docs available")
-            break  # unlikely to happen, but just in case
-
-        prev_source = source
-        source = docs[0].metadata["source"]
-        logger.info(
-            f"Getting response from LLM for source: {source} "
-            f"(values of part_id: {[doc.metadata.get('part_id') for doc in docs]}"
-        )
 
-        # Construct the context and get response from LLM
-        context = f"SOURCE: {source}\n\n{''.join(doc.page_content for doc in docs)}"
-        logger.debug(f"Context:\n{DELIMITER40}{context}\n{DELIMITER40}")
+            # Handle the result for the earliest source
+            _, new_source, future = in_flight.popleft()
+            prev_source, source = source, new_source
+            result: SourceResult = future.result()
+            reply, evaluation = result.reply, result.evaluation
 
-        inputs = {"query": hs_data.query, "context": context}
-        reply = chat_state.get_llm_reply(
-            hs_answer_generator_prompt, inputs, to_user=False
-        )
-        logger.debug(f"LLM reply: {reply}")
-
-        # Check if content is insufficient (this can change from False to True if
-        # the evaluator gives a bad evaluation later on)
-        is_content_insufficient = "content does not contain needed information" in reply
-
-        # Parse response
-        if not is_content_insufficient:
-            # If LLM wrote a reply, evaluate it first
-            inputs = {"query": hs_data.query, "answer": reply}
-            logger.info("Getting response from evaluator")
-            evaluator_reply = chat_state.get_llm_reply(
-                answer_evaluator_prompt, inputs, to_user=False
-            )
-
-            # Parse evaluator response and decide whether to continue
-            evaluation = has_which_substring(
-                evaluator_reply, ["EXCELLENT", "GOOD", "MEDIUM", "BAD"]
-            )
-            logger.info(f"Evaluation: {evaluation}")
-
-            is_content_insufficient = evaluation in content_insufficient_evaluations
-
-            if not is_content_insufficient:
+            if not result.is_content_insufficient:
                 # If LLM omitted the source, add it
                 if source not in reply:
                     reply += f"\n\nSource: {source}"
@@ -430,19 +514,31 @@ def run_main_heatseek_workflow(
             if hs_data.is_answer_found:
                 break
 
-        if is_content_insufficient:
-            # If content is insufficient, add to the "Checked: " block
-            logger.info("Content is insufficient")
-            logger.debug(f"{source=}, {prev_source=}, {new_checked_block=}")
-            if source != prev_source:
-                if new_checked_block:
-                    piece = f"\n\n{CHECKED_STR}" if full_reply else CHECKED_STR
-                    new_checked_block = False
-                else:
-                    piece = ", "
-                piece += f"[{shorten_url(source)}]({source})"
-                full_reply += piece
-                chat_state.add_to_output(piece)
+            if result.is_content_insufficient:
+                # If content is insufficient, add to the "Checked: " block
+                logger.info("Content is insufficient")
+                logger.debug(f"{source=}, {prev_source=}, {new_checked_block=}")
+                if source != prev_source:
+                    if new_checked_block:
+                        piece = f"\n\n{CHECKED_STR}" if full_reply else CHECKED_STR
+                        new_checked_block = False
+                    else:
+                        piece = ", "
+                    piece += f"[{shorten_url(source)}]({source})"
+                    full_reply += piece
+                    chat_state.add_to_output(piece)
+    finally:
+        # Cancel the sources we won't use (e.g. the answer is found) and put their
+        # docs back, so that they are processed in the next round
+        if in_flight:
+            logger.info(f"Cancelling the processing of {len(in_flight)} sources")
+            for _, _, future in in_flight:
+                future.cancel()
+            hs_data.doc_conveyer.idx_first_not_done = in_flight[0][0]
+
+        # Only keep the retrieved content that was used
+        url_prefetcher.cancel()
+        roll_back_unused_urls(hs_data, idx_first_url)
 
     # Add final piece if needed
     piece = ""
@@ -463,6 +559,8 @@ def run_main_heatseek_workflow(
         full_reply += piece
         chat_state.add_to_output(piece)
 
+    # Drop the processed docs, so that their texts aren't saved with hs_data
+    hs_data.doc_conveyer.clear_done_docs()
     return full_reply
 
 
@@ -563,13 +661,12 @@ def get_new_heatseek_response(chat_state: ChatState) -> JSONishDict:
     vectorstore = ingest_into_collection(
         docs=[],
         collection_name=construct_new_collection_name(query, chat_state),
-        collection_metadata={
-            "agent_data": json.dumps({"hs": hs_data.model_dump_json()})
-        },
+        collection_metadata=None,
         chat_state=chat_state,
         is_new_collection=True,
         retry_with_random_name=True,
     )
+    save_hs_data_records(vectorstore.collection, hs_data)
 
     # Return response (next iteration info will be added upstream)
     return {"answer": full_reply, "vectorstore": vectorstore}
@@ -595,11 +692,8 @@ def get_heatseek_in_progress_response(
     # Perform main Heatseek workflow
     full_reply = run_main_heatseek_workflow(chat_state, hs_data, init_reply)
 
-    # Save agent state into ChromaDB
-    chat_state.save_agent_data(
-        {"hs": hs_data.model_dump_json()},
-        use_cached_metadata=True,
-    )
+    # Save agent state into ChromaDB (only what changed in this round)
+    chat_state.save_hs_data(hs_data, use_cached_metadata=True)
 
     return {"answer": full_reply}
 
@@ -609,11 +703,10 @@ def get_research_heatseek_response(chat_state: ChatState) -> Props:
     if chat_state.message:
         return get_new_heatseek_response(chat_state)
 
-    hs_data = chat_state.get_agent_data(use_cached_metadata=True).get("hs")
+    hs_data = chat_state.get_hs_data(use_cached_metadata=True)
     # NOTE: We are using use_cached_metadata=True because metadata was fetched in the
     # call to get_rr_data in the get_research_response function
     if hs_data:
-        hs_data = HeatseekData.model_validate_json(hs_data)
         return get_heatseek_in_progress_response(chat_state, hs_data)
 
     return format_nonstreaming_answer(
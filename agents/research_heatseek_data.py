@@ -0,0 +1,203 @@
+import json
+
+from chromadb import Collection
+from pydantic import BaseModel, Field, PrivateAttr
+
+from agentblocks.docconveyer import DocConveyer
+from agentblocks.staterecords import (
+    Record,
+    RecordDigests,
+    get_digest,
+    get_record_digests,
+    save_state_records,
+)
+from agentblocks.webprocess import URLConveyer
+from components.chroma_ddg import STATE_RECORD_TYPE_KEY
+from utils.prepare import get_logger
+from utils.type_utils import Doc
+
+logger = get_logger()
+
+
+class HeatseekData(BaseModel):
+    query: str
+    search_queries: list[str]
+    past_search_queries: list[str] = Field(default_factory=list)
+    url_conveyer: URLConveyer
+    doc_conveyer: DocConveyer
+    is_answer_found: bool = False
+    answers: list[str] = Field(default_factory=list)
+    evaluations: list[str] = Field(default_factory=list)
+
+    # Digests of the state records as last loaded or saved (see save_hs_data_records)
+    _record_digests: RecordDigests = PrivateAttr(default_factory=dict)
+
+
+# HeatseekData is stored in its collection as "state records" (see
+# agentblocks.staterecords) rather than in the collection metadata, so that each
+# round only writes what it changed: a core record with the cursors and other small
+# fields, a record with the URLs (changes only when they are refreshed), one record
+# per link, one record per answer (with its evaluation) and one record per doc that
+# is waiting in the DocConveyer. Docs that were processed aren't stored at all.
+HS_CORE_RECORD_TYPE = "hs-core"
+HS_URLS_RECORD_TYPE = "hs-urls"
+HS_LINK_RECORD_TYPE = "hs-link"
+HS_ANSWER_RECORD_TYPE = "hs-answer"
+HS_DOC_RECORD_TYPE = "hs-doc"
+
+HS_CORE_RECORD_ID = "hs-state-core"
+HS_URLS_RECORD_ID = "hs-state-urls"
+HS_FIELDS_NOT_IN_CORE_RECORD = {
+    "url_conveyer": {"urls", "link_data_dict"},
+    "doc_conveyer": {"docs"},
+    "answers": True,
+    "evaluations": True,
+}
+
+
+def _get_link_record_id(url: str) -> str:
+    return f"hs-state-link-{get_digest(url)}"
+
+
+def _get_answer_record_id(idx: int) -> str:
+    return f"hs-state-answer-{idx}"
+
+
+def _get_doc_record_id(doc: Doc) -> str:
+    return f"hs-state-doc-{get_digest(doc.model_dump_json())}"
+
+
+def _get_records(hs_data: HeatseekData) -> dict[str, Record]:
+    """Get the state records for HeatseekData, by record id."""
+    docs = hs_data.doc_conveyer.docs[hs_data.doc_conveyer.idx_first_not_done :]
+    doc_record_ids = [_get_doc_record_id(doc) for doc in docs]
+    core = hs_data.model_dump(exclude=HS_FIELDS_NOT_IN_CORE_RECORD)
+    core["doc_conveyer"]["idx_first_not_done"] = 0  # only the pending docs are saved
+
+    records: dict[str, Record] = {
+        HS_CORE_RECORD_ID: (
+            json.dumps(core | {"doc_record_ids": doc_record_ids}),
+            {
+                STATE_RECORD_TYPE_KEY: HS_CORE_RECORD_TYPE,
+                "num_answers": len(hs_data.answers),
+            },
+        ),
+        HS_URLS_RECORD_ID: (
+            json.dumps(hs_data.url_conveyer.urls),
+            {STATE_RECORD_TYPE_KEY: HS_URLS_RECORD_TYPE},
+        ),
+    }
+    for url, link_data in hs_data.url_conveyer.link_data_dict.items():
+        # NOTE: the text is dropped once the URLConveyer turns it into a doc
+        records[_get_link_record_id(url)] = (
+            "" if link_data.error else link_data.text or "",
+            {
+                STATE_RECORD_TYPE_KEY: HS_LINK_RECORD_TYPE,
+                "link": url,
+                "link_data": link_data.model_dump_json(exclude={"text"}),
+            },
+        )
+    for i, (answer, evaluation) in enumerate(
+        zip(hs_data.answers, hs_data.evaluations)
+    ):
+        records[_get_answer_record_id(i)] = (
+            answer,
+            {STATE_RECORD_TYPE_KEY: HS_ANSWER_RECORD_TYPE, "evaluation": evaluation},
+        )
+    for doc_record_id, doc in zip(doc_record_ids, docs):
+        records[doc_record_id] = (
+            doc.page_content,
+            {
+                STATE_RECORD_TYPE_KEY: HS_DOC_RECORD_TYPE,
+                "doc_metadata": json.dumps(doc.metadata),
+            },
+        )
+    return records
+
+
+def load_hs_data_records(collection: Collection) -> HeatseekData | None:
+    """
+    Load HeatseekData from the state records in the collection, or return None if
+    there are none.
+    """
+    rsp = collection.get(
+        [HS_CORE_RECORD_ID, HS_URLS_RECORD_ID], include=["documents", "metadatas"]
+    )
+    document_by_id = dict(zip(rsp["ids"], rsp["documents"]))
+    try:
+        core_metadata = rsp["metadatas"][rsp["ids"].index(HS_CORE_RECORD_ID)]
+    except ValueError:
+        return None
+    core = json.loads(document_by_id[HS_CORE_RECORD_ID])
+    doc_record_ids = core.pop("doc_record_ids")
+
+    # Get the link data (texts are fetched below, only if still needed)
+    rsp = collection.get(
+        where={STATE_RECORD_TYPE_KEY: HS_LINK_RECORD_TYPE}, include=["metadatas"]
+    )
+    link_data_dict = {
+        metadata["link"]: json.loads(metadata["link_data"])
+        for metadata in rsp["metadatas"]
+    }
+
+    # Get the answers and the pending docs
+    answer_record_ids = [
+        _get_answer_record_id(i) for i in range(core_metadata["num_answers"])
+    ]
+    rsp = collection.get(
+        answer_record_ids + doc_record_ids, include=["documents", "metadatas"]
+    )
+    record_by_id = {
+        id: (text, metadata)
+        for id, text, metadata in zip(rsp["ids"], rsp["documents"], rsp["metadatas"])
+    }
+    answer_records = [record_by_id[id] for id in answer_record_ids]
+    doc_records = [record_by_id[id] for id in doc_record_ids]
+
+    core["url_conveyer"] |= {
+        "urls": json.loads(document_by_id[HS_URLS_RECORD_ID]),
+        "link_data_dict": link_data_dict,
+    }
+    core["doc_conveyer"]["docs"] = [
+        {"page_content": text, "metadata": json.loads(metadata["doc_metadata"])}
+        for text, metadata in doc_records
+    ]
+    hs_data = HeatseekData.model_validate(
+        core
+        | {
+            "answers": [answer for answer, _ in answer_records],
+            "evaluations": [metadata["evaluation"] for _, metadata in answer_records],
+        }
+    )
+
+    # Get the texts of the links that were fetched but not yet turned into docs
+    url_conveyer = hs_data.url_conveyer
+    link_record_ids = [
+        _get_link_record_id(url)
+        for url in url_conveyer.urls[
+            url_conveyer.idx_first_not_done : url_conveyer.idx_first_not_tried
+        ]
+        if not url_conveyer.link_data_dict[url].error
+    ]
+    if link_record_ids:
+        rsp = collection.get(link_record_ids, include=["documents", "metadatas"])
+        for text, metadata in zip(rsp["documents"], rsp["metadatas"]):
+            url_conveyer.link_data_dict[metadata["link"]].text = text or None
+
+    # Remember what's stored, so that saving only writes what changed
+    hs_data._record_digests = get_record_digests(_get_records(hs_data))
+    logger.info(
+        f"Loaded hs_data with {len(url_conveyer.urls)} URLs, "
+        f"{len(hs_data.answers)} answers and {len(doc_records)} pending docs"
+    )
+    return hs_data
+
+
+def save_hs_data_records(collection: Collection, hs_data: HeatseekData) -> None:
+    """
+    Save HeatseekData as state records in the collection, writing only the records
+    that changed since it was loaded or last saved.
+    """
+    hs_data._record_digests = save_state_records(
+        collection, _get_records(hs_data), hs_data._record_digests
+    )
@@ -1,5 +1,6 @@
 import json
 import os
+import uuid
 from datetime import datetime
 from enum import Enum
 
@@ -16,7 +17,12 @@ from agents.dbmanager import (
     get_user_facing_collection_name,
 )
 from agents.research_heatseek import get_research_heatseek_response
-from agents.researcher_data import Report, ResearchReportData
+from agents.researcher_data import (
+    Report,
+    ResearchReportData,
+    load_link_texts,
+    save_rr_data_records,
+)
 from agents.websearcher_quick import get_websearcher_response_quick
 from components.llm import get_prompt_llm_chain
 from utils.chat_state import ChatState
@@ -309,20 +315,23 @@ def get_initial_researcher_response(chat_state: ChatState) -> Props:
     for link in links_to_include:
         link_data = rr_data.link_data_dict[link]
         link_data.is_ingested = True  # this will be saved in rr_data
+        link_data.doc_id = str(uuid.uuid4())  # so rr_data doesn't store the text
         metadata = {"source": link}
         if link_data.num_tokens is not None:
             metadata["num_tokens"] = link_data.num_tokens
         docs.append(Document(page_content=link_data.text, metadata=metadata))
 
-    # Ingest documents into ChromaDB
+    # Ingest documents into ChromaDB and save rr_data in the new collection
     vectorstore = ingest_into_collection(
         collection_name=construct_new_collection_name(rr_data.query, chat_state),
         docs=docs,
-        collection_metadata={"rr_data": rr_data.model_dump_json()},
+        collection_metadata=None,
         chat_state=chat_state,
         is_new_collection=True,
         retry_with_random_name=True,
+        ids=[rr_data.link_data_dict[link].doc_id for link in links_to_include],
     )
+    save_rr_data_records(vectorstore.collection, rr_data)
 
     return response | {"vectorstore": vectorstore}
 
@@ -442,6 +451,7 @@ def get_iterative_researcher_response(chat_state: ChatState) -> Props:
         if rr_data.link_data_dict[link].num_tokens is None:
             links_to_count_tokens_for.append(link)
 
+    load_link_texts(chat_state.vectorstore.collection, rr_data, links_to_include)
     texts_to_include = [rr_data.link_data_dict[x].text for x in links_to_include]
 
     # Update rr_data once again to reflect the links about to be processed
@@ -557,33 +567,32 @@ def get_iterative_researcher_response(chat_state: ChatState) -> Props:
     # Prepare new documents for ingestion
     # NOTE: links_to_include is non-empty if we got here
     docs: list[Document] = []
+    doc_ids: list[str] = []
     for link in links_to_include:
         link_data = rr_data.link_data_dict[link]
         if link_data.is_ingested:
             continue
         link_data.is_ingested = True
+        link_data.doc_id = str(uuid.uuid4())
         metadata = {"source": link}
         if link_data.num_tokens is not None:
             metadata["num_tokens"] = link_data.num_tokens
         docs.append(Document(page_content=link_data.text, metadata=metadata))
+        doc_ids.append(link_data.doc_id)
 
     # Ingest documents into collection
     if docs:
-        logger.info("Ingesting new documents and saving rr_data.")
-        collection_metadata = chat_state.get_cached_collection_metadata()
-        collection_metadata["rr_data"] = rr_data.model_dump_json()
+        logger.info("Ingesting new documents.")
         ingest_into_collection(
             collection_name=chat_state.collection_name,
             docs=docs,
-            collection_metadata=collection_metadata,
+            collection_metadata=None,
             chat_state=chat_state,
             is_new_collection=False,
+            ids=doc_ids,
         )
-    else:
-        logger.info("No new documents to ingest. Saving rr_data.")
-        chat_state.save_rr_data(rr_data)  # this updates "updated_at" field
-        # NOTE: could also save a metadata fetch if we used the cached metadata and
-        # used ingest_into_collection like above
+    logger.info("Saving rr_data.")
+    chat_state.save_rr_data(rr_data, use_cached_metadata=True)  # updates "updated_at"
     logger.info("Finished saving data.")
 
     return {"answer": answer, "source_links": links_to_include}
@@ -1,7 +1,21 @@
-from pydantic import BaseModel, Field, model_validator
+import json
 
+from chromadb import Collection
+from pydantic import BaseModel, Field, PrivateAttr, model_validator
+
+from agentblocks.staterecords import (
+    Record,
+    RecordDigests,
+    get_digest,
+    get_record_digests,
+    save_state_records,
+)
+from components.chroma_ddg import STATE_RECORD_TYPE_KEY
+from utils.prepare import get_logger
 from utils.web import LinkData
 
+logger = get_logger()
+
 
 class Report(BaseModel):
     report_text: str
@@ -28,6 +42,9 @@ class ResearchReportData(BaseModel):
     num_links_from_latest_queries: int | None = None
     evaluation: str | None = None
 
+    # Digests of the state records as last loaded or saved (see save_rr_data_records)
+    _record_digests: RecordDigests = PrivateAttr(default_factory=dict)
+
     @model_validator(mode="after")
     def validate(self):
         if self.num_links_from_latest_queries is None:
@@ -70,3 +87,152 @@ class ResearchReportData(BaseModel):
         for parent_report in self.get_parent_reports(report):
             res.extend(self.get_sources(parent_report))
         return res
+
+
+# ResearchReportData is stored in its collection as "state records" (see
+# agentblocks.staterecords) rather than in the collection metadata: a core record
+# with the other fields, one record per report and one record per link. A link's
+# text is the document of its record only until the link is ingested: after that,
+# the text is in the ingested full doc (see LinkData.doc_id). Link texts are only
+# loaded when needed (see load_link_texts).
+RR_CORE_RECORD_TYPE = "rr-core"
+RR_REPORT_RECORD_TYPE = "rr-report"
+RR_LINK_RECORD_TYPE = "rr-link"
+
+RR_CORE_RECORD_ID = "rr-state-core"
+RR_FIELDS_NOT_IN_CORE_RECORD = {"link_data_dict", "base_reports", "combined_reports"}
+
+
+def _get_report_record_id(report_id: str) -> str:
+    return f"rr-state-report-{report_id}"
+
+
+def _get_link_record_id(link: str) -> str:
+    return f"rr-state-link-{get_digest(link)}"
+
+
+def _get_records(rr_data: ResearchReportData) -> dict[str, Record]:
+    """Get the state records for ResearchReportData, by record id."""
+    records: dict[str, Record] = {
+        RR_CORE_RECORD_ID: (
+            rr_data.model_dump_json(exclude=RR_FIELDS_NOT_IN_CORE_RECORD),
+            {
+                STATE_RECORD_TYPE_KEY: RR_CORE_RECORD_TYPE,
+                "num_base_reports": len(rr_data.base_reports),
+                "num_combined_reports": len(rr_data.combined_reports),
+            },
+        )
+    }
+    for prefix, reports in (
+        ("", rr_data.base_reports),
+        ("c", rr_data.combined_reports),
+    ):
+        for i, report in enumerate(reports):
+            records[_get_report_record_id(f"{prefix}{i}")] = (
+                report.model_dump_json(),
+                {STATE_RECORD_TYPE_KEY: RR_REPORT_RECORD_TYPE},
+            )
+    for link, link_data in rr_data.link_data_dict.items():
+        # NOTE: if the text wasn't loaded, the stored text is kept (see below)
+        records[_get_link_record_id(link)] = (
+            "" if link_data.doc_id or link_data.error else link_data.text,
+            {
+                STATE_RECORD_TYPE_KEY: RR_LINK_RECORD_TYPE,
+                "link": link,
+                "link_data": link_data.model_dump_json(exclude={"text"}),
+            },
+        )
+    return records
+
+
+def load_rr_data_records(collection: Collection) -> ResearchReportData | None:
+    """
+    Load ResearchReportData from the state records in the collection, or return
+    None if there are none. Link texts are not loaded (see load_link_texts).
+    """
+    rsp = collection.get(
+        where={
+            STATE_RECORD_TYPE_KEY: {"$in": [RR_CORE_RECORD_TYPE, RR_REPORT_RECORD_TYPE]}
+        },
+        include=["documents", "metadatas"],
+    )
+    document_by_id = dict(zip(rsp["ids"], rsp["documents"]))
+    try:
+        core_metadata = rsp["metadatas"][rsp["ids"].index(RR_CORE_RECORD_ID)]
+    except ValueError:
+        return None
+
+    # Get the link data, without the texts
+    rsp = collection.get(
+        where={STATE_RECORD_TYPE_KEY: RR_LINK_RECORD_TYPE}, include=["metadatas"]
+    )
+    rr_data = ResearchReportData.model_validate(
+        json.loads(document_by_id[RR_CORE_RECORD_ID])
+        | {
+            "link_data_dict": {
+                metadata["link"]: json.loads(metadata["link_data"])
+                for metadata in rsp["metadatas"]
+            },
+            "base_reports": [
+                json.loads(document_by_id[_get_report_record_id(str(i))])
+                for i in range(core_metadata["num_base_reports"])
+            ],
+            "combined_reports": [
+                json.loads(document_by_id[_get_report_record_id(f"c{i}")])
+                for i in range(core_metadata["num_combined_reports"])
+            ],
+        }
+    )
+
+    # Remember what's stored, so that saving only writes what changed
+    rr_data._record_digests = get_record_digests(_get_records(rr_data))
+    logger.info(f"Loaded rr_data with {len(rr_data.link_data_dict)} links")
+    return rr_data
+
+
+def load_link_texts(
+    collection: Collection, rr_data: ResearchReportData, links: list[str]
+) -> None:
+    """
+    Load the texts of the given links (those that aren't loaded yet and have no
+    errors) into rr_data.link_data_dict: from the ingested full docs for ingested
+    links and from the links' state records for the rest.
+    """
+    link_by_doc_id: dict[str, str] = {}
+    link_by_record_id: dict[str, str] = {}
+    for link in links:
+        link_data = rr_data.link_data_dict[link]
+        if link_data.text is not None or link_data.error:
+            continue
+        if link_data.doc_id:
+            link_by_doc_id[link_data.doc_id] = link
+        else:
+            link_by_record_id[_get_link_record_id(link)] = link
+
+    for link_by_id in (link_by_doc_id, link_by_record_id):
+        if not link_by_id:
+            continue
+        rsp = collection.get(list(link_by_id), include=["documents"])
+        for id, text in zip(rsp["ids"], rsp["documents"]):
+            rr_data.link_data_dict[link_by_id[id]].text = text
+
+    # The loaded texts are already stored, so saving shouldn't rewrite them
+    for record_id, link in link_by_record_id.items():
+        text = rr_data.link_data_dict[link].text
+        if text is not None and record_id in rr_data._record_digests:
+            metadata_digest, _ = rr_data._record_digests[record_id]
+            rr_data._record_digests[record_id] = (metadata_digest, get_digest(text))
+    logger.info(
+        f"Loaded {len(link_by_doc_id)} texts from ingested docs and "
+        f"{len(link_by_record_id)} from state records"
+    )
+
+
+def save_rr_data_records(collection: Collection, rr_data: ResearchReportData) -> None:
+    """
+    Save ResearchReportData as state records in the collection, writing only the
+    records that changed since it was loaded or last saved.
+    """
+    rr_data._record_digests = save_state_records(
+        collection, _get_records(rr_data), rr_data._record_digests
+    )
@@ -1,8 +1,8 @@
 from datetime import datetime
 
-from agentblocks.websearch import get_links_from_search_results
+from agentblocks.websearch import get_links_from_search_results, get_search_results
 from components.llm import get_prompt_llm_chain
-from utils.async_utils import gather_tasks_sync, make_sync
+from utils.async_utils import make_sync, make_sync_in_shared_loop
 from utils.chat_state import ChatState
 from utils.lang_utils import get_num_tokens, limit_tokens_in_texts
 from utils.prepare import CONTEXT_LENGTH
@@ -12,12 +12,10 @@ from utils.web import (
     get_text_from_html,
     remove_failed_fetches,
 )
-from langchain_community.utilities import GoogleSerperAPIWrapper
 
 
 def get_related_websearch_queries(message: str):
-    search = GoogleSerperAPIWrapper()
-    search_results = search.results(message)
+    search_results = get_search_results([message])[0]
     # print("search results:", json.dumps(search_results, indent=4))
     related_searches = [x["query"] for x in search_results.get("relatedSearches", [])]
     people_also_ask = [x["question"] for x in search_results.get("peopleAlsoAsk", [])]
@@ -48,9 +46,7 @@ def get_websearcher_response_quick(
     print("queries:", queries)
 
     # Get links
-    search = GoogleSerperAPIWrapper()
-    search_tasks = [search.aresults(query) for query in queries]
-    search_results = gather_tasks_sync(search_tasks)
+    search_results = get_search_results(queries)
     links = get_links_from_search_results(search_results)[:max_total_links]
     print("Links:", links)
 
@@ -58,7 +54,7 @@ def get_websearcher_response_quick(
     t_start = datetime.now()
     print("Fetching content from links...")
     # htmls = make_sync(afetch_urls_in_parallel_chromium_loader)(links)
-    htmls = make_sync(afetch_urls_in_parallel_playwright)(links)
+    htmls = make_sync_in_shared_loop(afetch_urls_in_parallel_playwright)(links)
     # htmls = make_sync(afetch_urls_in_parallel_html_loader)(links)
     # htmls = fetch_urls_with_lc_html_loader(links) # takes ~20s, slow
     t_fetch_end = datetime.now()
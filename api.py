@@ -2,15 +2,18 @@
 The FastAPI server that enables API access to DocDocGo.
 """
 
+import asyncio
 import json
 import os
+import threading
 import traceback
 from typing import Annotated
 
-from fastapi import Body, FastAPI, File, Form, HTTPException, UploadFile
+from fastapi import Body, FastAPI, File, Form, HTTPException, Request, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
 from icecream import ic
 from pydantic import BaseModel
+from sse_starlette.sse import EventSourceResponse
 
 from _prepare_env import is_env_loaded
 from agents.dbmanager import (
@@ -19,11 +22,25 @@ from agents.dbmanager import (
     get_user_facing_collection_name,
 )
 from components.chroma_ddg import get_vectorstore_using_openai_api_key
-from docdocgo import get_bot_response, get_source_links
+from components.llm import (
+    CallbackHandlerDDGCancellation,
+    CallbackHandlerDDGConsole,
+    CallbackHandlerDDGQueue,
+)
+from docdocgo import (
+    aget_bot_response,
+    get_bot_response,
+    get_source_links,
+    supports_async_bot_response,
+)
 from utils.chat_state import AgentDataDict, ChatState, ScheduledQueries
 from utils.helpers import DELIMITER
 from utils.ingest import extract_text, format_ingest_failure
 from utils.prepare import (
+    API_MAX_CONCURRENT_ASYNC_REQUESTS,
+    API_MAX_CONCURRENT_REQUESTS,
+    API_MAX_QUEUED_REQUESTS,
+    API_QUEUE_TIMEOUT_S,
     BYPASS_SETTINGS_RESTRICTIONS,
     BYPASS_SETTINGS_RESTRICTIONS_PASSWORD,
     DEFAULT_COLLECTION_NAME,
@@ -33,6 +50,11 @@ from utils.prepare import (
     get_logger,
 )
 from utils.query_parsing import parse_query
+from utils.request_pool import (
+    RequestCancelledError,
+    RequestWorkerPool,
+    ServerOverloadedError,
+)
 from utils.type_utils import (
     INSTRUCT_AUTO_RUN_NEXT_QUERY,
     AccessRole,
@@ -59,6 +81,18 @@ app.add_middleware(
 
 is_env_loaded = is_env_loaded  # see explanation at the end of docdocgo.py
 
+# Most requests are processed synchronously (LLM calls, fetching, Chroma), so they
+# are run in worker threads to keep the event loop responsive
+request_pool = RequestWorkerPool(
+    API_MAX_CONCURRENT_REQUESTS, API_MAX_QUEUED_REQUESTS, API_QUEUE_TIMEOUT_S
+)
+
+# Chatting with docs (/kb etc.) is processed natively in the event loop, so many
+# more such requests can run at the same time (see aget_bot_response)
+async_request_pool = RequestWorkerPool(
+    API_MAX_CONCURRENT_ASYNC_REQUESTS, API_MAX_QUEUED_REQUESTS, API_QUEUE_TIMEOUT_S
+)
+
 
 # Define Pydantic models for request and response
 RoleBasedChatMessage = dict[str, str]  # {"role": "user" | "assistant", "content": str}
@@ -130,145 +164,153 @@ def decode_param(param: str | None) -> str | dict | list | None:
     return None if param is None else json.loads(param)
 
 
-async def handle_chat_or_ingest_request(
-    data: ChatRequestData, files: list[UploadFile] = []
-):
-    try:
-        # Process the request data for constructing the chat state
-        message = data.message.strip()
-        api_key = data.api_key  # DocDocGo API key
-
-        # If admin pwd is sent, treat it as if the default key was sent
-        if (
-            BYPASS_SETTINGS_RESTRICTIONS_PASSWORD
-            and data.openai_api_key
-            and data.openai_api_key.strip() == BYPASS_SETTINGS_RESTRICTIONS_PASSWORD
-            and DEFAULT_OPENAI_API_KEY  # only do this if the default key is configured
-        ):
-            data.openai_api_key = DEFAULT_OPENAI_API_KEY
-        # Same story if no key is sent but BYPASS_SETTINGS_RESTRICTIONS is set
-        elif not data.openai_api_key and BYPASS_SETTINGS_RESTRICTIONS:
-            data.openai_api_key = DEFAULT_OPENAI_API_KEY
-
-        # If no key is specified, use the default key (but set is_community_key to True)
-        openai_api_key: str = data.openai_api_key or DEFAULT_OPENAI_API_KEY
-        is_community_key = not data.openai_api_key
-
-        # User id is determined from the OpenAI API key (or None if community key)
-        user_id: str | None = get_short_user_id(data.openai_api_key)
-        # TODO: use full api key as user id (but show only the short version)
-
-        chat_history = convert_chat_history(data.chat_history)
-        data.collection_name = data.collection_name or DEFAULT_COLLECTION_NAME
-        collection_name = data.collection_name
-        access_codes_cache: dict[str, str] | None = data.access_codes_cache
-
-        scheduled_queries, session_data = data.parse_curr_state()
-
-        # Validate the user's API key
-        if api_key != os.getenv("DOCDOCGO_API_KEY"):
-            print(f"Invalid API key: {api_key}")
-            return ChatResponseData(content="Invalid API key.")
-
-        # Validate the provided bot settings
-
-        if data.bot_settings and is_community_key:
-            # Enforce default settings for community key
-            if data.bot_settings != BotSettings():
-                return ChatResponseData(
-                    content="Apologies, you can customize your model settings (e.g. model name, "
-                    "temperature) only when using your own OpenAI API key."
-                )
+def _prepare_chat_state(
+    data: ChatRequestData, files: list[UploadFile], callbacks: list
+) -> ChatState | ChatResponseData:
+    """
+    Validate the request and construct the chat state for it (blocking). If the
+    request can't be processed, return the response to send instead.
+    """
+    # Process the request data for constructing the chat state
+    message = data.message.strip()
+    api_key = data.api_key  # DocDocGo API key
+
+    # If admin pwd is sent, treat it as if the default key was sent
+    if (
+        BYPASS_SETTINGS_RESTRICTIONS_PASSWORD
+        and data.openai_api_key
+        and data.openai_api_key.strip() == BYPASS_SETTINGS_RESTRICTIONS_PASSWORD
+        and DEFAULT_OPENAI_API_KEY  # only do this if the default key is configured
+    ):
+        data.openai_api_key = DEFAULT_OPENAI_API_KEY
+    # Same story if no key is sent but BYPASS_SETTINGS_RESTRICTIONS is set
+    elif not data.openai_api_key and BYPASS_SETTINGS_RESTRICTIONS:
+        data.openai_api_key = DEFAULT_OPENAI_API_KEY
 
-        # Extract text from the files and convert to list of Document
-        docs, failed_files, unsupported_ext_files = extract_text(
-            files, allow_all_ext=True
-        )  # returns quickly if no files
+    # If no key is specified, use the default key (but set is_community_key to True)
+    openai_api_key: str = data.openai_api_key or DEFAULT_OPENAI_API_KEY
+    is_community_key = not data.openai_api_key
 
-        # Print and validate the user's message and successful upload
-        if files:
-            print(f"GOT {len(files)} FILES, {len(docs)} DOCUMENTS")
-        if failed_files or unsupported_ext_files:
-            return ChatResponseData(
-                content=format_ingest_failure(failed_files, unsupported_ext_files)
-            )
+    # User id is determined from the OpenAI API key (or None if community key)
+    user_id: str | None = get_short_user_id(data.openai_api_key)
+    # TODO: use full api key as user id (but show only the short version)
 
-        # Parse the query (or get the next scheduled query if message/docs are empty)
-        if message or docs:
-            # If docs uploaded with empty message, interpret as "/upload"
-            parsed_query = parse_query(message or "/upload")
-        else:
-            parsed_query = scheduled_queries.pop()
-            if not parsed_query:
-                return ChatResponseData(
-                    content="Apologies, I received an empty message from you."
-                )
+    chat_history = convert_chat_history(data.chat_history)
+    data.collection_name = data.collection_name or DEFAULT_COLLECTION_NAME
+    collection_name = data.collection_name
+    access_codes_cache: dict[str, str] | None = data.access_codes_cache
 
-        # If there are files but command is not ingest or summarize, postpone it till after ingestion
-        if docs and parsed_query.chat_mode not in (
-            ChatMode.INGEST_COMMAND_ID,
-            ChatMode.SUMMARIZE_COMMAND_ID,
-        ):
-            scheduled_queries.add_to_front(parsed_query)
-            parsed_query = parse_query("/upload")
+    scheduled_queries, session_data = data.parse_curr_state()
 
-        # Initialize vectorstore and chat state
-        try:
-            vectorstore = get_vectorstore_using_openai_api_key(
-                collection_name, openai_api_key=openai_api_key
-            )
-        except Exception as e:
+    # Validate the user's API key
+    if api_key != os.getenv("DOCDOCGO_API_KEY"):
+        print(f"Invalid API key: {api_key}")
+        return ChatResponseData(content="Invalid API key.")
+
+    # Validate the provided bot settings
+
+    if data.bot_settings and is_community_key:
+        # Enforce default settings for community key
+        if data.bot_settings != BotSettings():
             return ChatResponseData(
-                content="Apologies, I could not load the vector database. This "
-                "could be due to a misconfiguration of the environment variables "
-                f"or missing files. The error reads: \n\n{e}"
+                content="Apologies, you can customize your model settings (e.g. model name, "
+                "temperature) only when using your own OpenAI API key."
             )
 
-        access_code_by_coll_by_user_id = (
-            {user_id: access_codes_cache} if access_codes_cache else None
-        )
+    # Extract text from the files and convert to list of Document
+    docs, failed_files, unsupported_ext_files = extract_text(
+        files, allow_all_ext=True
+    )  # returns quickly if no files
 
-        chat_state = ChatState(
-            operation_mode=OperationMode.FASTAPI,
-            vectorstore=vectorstore,
-            is_community_key=is_community_key,
-            chat_history=chat_history,
-            openai_api_key=openai_api_key,
-            user_id=user_id,
-            parsed_query=parsed_query,
-            scheduled_queries=scheduled_queries,
-            session_data=session_data,
-            access_code_by_coll_by_user_id=access_code_by_coll_by_user_id,
-            uploaded_docs=docs,
-            bot_settings=data.bot_settings,
+    # Print and validate the user's message and successful upload
+    if files:
+        print(f"GOT {len(files)} FILES, {len(docs)} DOCUMENTS")
+    if failed_files or unsupported_ext_files:
+        return ChatResponseData(
+            content=format_ingest_failure(failed_files, unsupported_ext_files)
         )
 
-        # Validate (and cache, for this request) the user's access level
-        access_role = get_access_role(chat_state)
-        if access_role.value <= AccessRole.NONE.value:
+    # Parse the query (or get the next scheduled query if message/docs are empty)
+    if message or docs:
+        # If docs uploaded with empty message, interpret as "/upload"
+        parsed_query = parse_query(message or "/upload")
+    else:
+        parsed_query = scheduled_queries.pop()
+        if not parsed_query:
             return ChatResponseData(
-                content="Apologies, you do not have access to the collection."
+                content="Apologies, I received an empty message from you."
             )
 
-        # Get the bot's response
-        result = get_bot_response(chat_state)
-    except DDGError as e:
-        print(traceback.format_exc())
-        user_msg = (
-            e.user_facing_message_full
-            if INCLUDE_ERROR_IN_USER_FACING_ERROR_MSG
-            else e.user_facing_message
+    # If there are files but command is not ingest or summarize, postpone it till after ingestion
+    if docs and parsed_query.chat_mode not in (
+        ChatMode.INGEST_COMMAND_ID,
+        ChatMode.SUMMARIZE_COMMAND_ID,
+    ):
+        scheduled_queries.add_to_front(parsed_query)
+        parsed_query = parse_query("/upload")
+
+    # Initialize vectorstore and chat state
+    try:
+        vectorstore = get_vectorstore_using_openai_api_key(
+            collection_name, openai_api_key=openai_api_key
+        )
+    except Exception as e:
+        return ChatResponseData(
+            content="Apologies, I could not load the vector database. This "
+            "could be due to a misconfiguration of the environment variables "
+            f"or missing files. The error reads: \n\n{e}"
         )
-        print("User message:", user_msg)
-        return ChatResponseData(content=user_msg)  # NOTE: think about http status codes
-    except Exception:
-        print(traceback.format_exc())
 
+    access_code_by_coll_by_user_id = (
+        {user_id: access_codes_cache} if access_codes_cache else None
+    )
+
+    chat_state = ChatState(
+        operation_mode=OperationMode.FASTAPI,
+        vectorstore=vectorstore,
+        is_community_key=is_community_key,
+        chat_history=chat_history,
+        openai_api_key=openai_api_key,
+        user_id=user_id,
+        parsed_query=parsed_query,
+        scheduled_queries=scheduled_queries,
+        session_data=session_data,
+        access_code_by_coll_by_user_id=access_code_by_coll_by_user_id,
+        uploaded_docs=docs,
+        bot_settings=data.bot_settings,
+        callbacks=callbacks,
+    )
+
+    # Validate (and cache, for this request) the user's access level
+    access_role = get_access_role(chat_state)
+    if access_role.value <= AccessRole.NONE.value:
+        return ChatResponseData(
+            content="Apologies, you do not have access to the collection."
+        )
+
+    return chat_state
+
+
+def _get_error_response_data(e: Exception) -> ChatResponseData:
+    print(traceback.format_exc())
+    if not isinstance(e, DDGError):
         return ChatResponseData(
             content="Apologies, I encountered an error while trying to "
             "compose a response to you."
         )
+    user_msg = (
+        e.user_facing_message_full
+        if INCLUDE_ERROR_IN_USER_FACING_ERROR_MSG
+        else e.user_facing_message
+    )
+    print("User message:", user_msg)
+    return ChatResponseData(content=user_msg)  # NOTE: think about http status codes
+
 
+def _get_response_data(
+    chat_state: ChatState, result: dict, collection_name: str
+) -> ChatResponseData:
+    """Prepare the response from the result of get_bot_response."""
     # print("AI:", reply) - no need, we are streaming to stdout now
     print(DELIMITER)
 
@@ -311,6 +353,113 @@ async def handle_chat_or_ingest_request(
     return rsp
 
 
+def _handle_chat_or_ingest_request(
+    data: ChatRequestData,
+    files: list[UploadFile],
+    cancel_event: threading.Event,
+    extra_callbacks: list | None = None,
+):
+    """Process a request (blocking, runs in a worker thread)."""
+    callbacks = [
+        CallbackHandlerDDGConsole(),
+        CallbackHandlerDDGCancellation(cancel_event),
+    ] + (extra_callbacks or [])
+    try:
+        chat_state = _prepare_chat_state(data, files, callbacks)
+        if isinstance(chat_state, ChatResponseData):
+            return chat_state
+
+        # Get the bot's response
+        result = get_bot_response(chat_state)
+    except Exception as e:
+        return _get_error_response_data(e)
+
+    return _get_response_data(chat_state, result, data.collection_name)
+
+
+async def _ahandle_chat_request(
+    data: ChatRequestData, extra_callbacks: list | None = None
+):
+    """
+    Process a chat request natively in the event loop (see aget_bot_response). It's
+    stopped by cancelling its task, so no cancellation callback is needed.
+    """
+    callbacks = [CallbackHandlerDDGConsole()] + (extra_callbacks or [])
+    try:
+        # NOTE: loading the vectorstore and checking access make blocking calls to
+        # Chroma, so they run in the default executor
+        chat_state = await asyncio.to_thread(_prepare_chat_state, data, [], callbacks)
+        if isinstance(chat_state, ChatResponseData):
+            return chat_state
+
+        # Get the bot's response
+        result = await aget_bot_response(chat_state)
+    except Exception as e:
+        return _get_error_response_data(e)
+
+    return _get_response_data(chat_state, result, data.collection_name)
+
+
+def _can_handle_natively_async(data: ChatRequestData, files: list[UploadFile]) -> bool:
+    """
+    Return True if the request can be handled by _ahandle_chat_request, i.e. it
+    has no files and its command is supported by aget_bot_response.
+    """
+    if files:
+        return False
+    try:
+        if message := data.message.strip():
+            parsed_query = parse_query(message)
+        else:
+            parsed_query = data.parse_curr_state()[0].pop()  # next scheduled query
+    except Exception:
+        return False  # let the regular handler deal with it
+    return parsed_query is not None and supports_async_bot_response(
+        parsed_query.chat_mode
+    )
+
+
+async def handle_chat_or_ingest_request(
+    request: Request, data: ChatRequestData, files: list[UploadFile] = []
+):
+    """
+    Process a request natively in the event loop if possible, otherwise in the
+    worker pool. Returns 429 if the server is overloaded. If the client
+    disconnects, the request is cancelled (see RequestWorkerPool).
+    """
+    cancel_event = threading.Event()
+    try:
+        if _can_handle_natively_async(data, files):
+            return await async_request_pool.arun_coroutine(
+                _ahandle_chat_request, data, ais_disconnected=request.is_disconnected
+            )
+        return await request_pool.arun(
+            _handle_chat_or_ingest_request,
+            data,
+            files,
+            cancel_event,
+            ais_disconnected=request.is_disconnected,
+            on_disconnect=cancel_event.set,
+        )
+    except ServerOverloadedError as e:
+        _raise_http_exception_for_rejected_request(e)
+    except RequestCancelledError as e:
+        logger.info(f"Request cancelled: {e}")
+        raise HTTPException(status_code=e.http_status_code, detail=str(e))
+
+
+def _raise_http_exception_for_rejected_request(e: DDGError):
+    logger.warning(
+        f"Rejecting request: {e} (threads: {request_pool.get_stats()}, "
+        f"async: {async_request_pool.get_stats()})"
+    )
+    raise HTTPException(
+        status_code=e.http_status_code,
+        detail=e.user_facing_message,
+        headers={"Retry-After": str(int(API_QUEUE_TIMEOUT_S))},
+    )
+
+
 @app.get("/")
 async def root():
     ic("/ endpoint hit: Hello from DocDocGo API!")
@@ -325,6 +474,7 @@ async def health():
 
 @app.post("/ingest/", response_model=ChatResponseData)
 async def ingest(
+    request: Request,
     files: Annotated[list[UploadFile], File()],
     message: Annotated[str, Form()],
     api_key: Annotated[str, Form()],
@@ -381,14 +531,78 @@ async def ingest(
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Invalid request data: {e}")
 
-    return await handle_chat_or_ingest_request(data, files)
+    return await handle_chat_or_ingest_request(request, data, files)
 
 
 @app.post("/chat/", response_model=ChatResponseData)
-async def chat(data: ChatRequestData = Body(...)):
+async def chat(request: Request, data: ChatRequestData = Body(...)):
     """Handle a chat message from the user and return a response from the bot"""
     ic("Chat endpoint hit")
-    return await handle_chat_or_ingest_request(data)
+    return await handle_chat_or_ingest_request(request, data)
+
+
+@app.post("/chat/stream")
+async def chat_stream(request: Request, data: ChatRequestData = Body(...)):
+    """
+    Handle a chat message from the user and stream the response as server-sent
+    events: "status" events (e.g. "retrieving", "generating"), "token" events with
+    the tokens of the response as they are generated, and a final "response" event
+    with the full ChatResponseData (including sources, instructions and the agentic
+    flow state). The data of every event is JSON.
+    """
+    ic("Chat stream endpoint hit")
+    cancel_event = threading.Event()
+    queue: asyncio.Queue[dict] = asyncio.Queue()
+    queue_callback_handler = CallbackHandlerDDGQueue(queue, asyncio.get_running_loop())
+
+    # Wait for a worker before starting the stream, so that we can still return 429
+    is_async = _can_handle_natively_async(data, [])
+    pool = async_request_pool if is_async else request_pool
+    try:
+        await pool.aacquire_worker(request.is_disconnected)
+    except ServerOverloadedError as e:
+        _raise_http_exception_for_rejected_request(e)
+    except RequestCancelledError as e:
+        raise HTTPException(status_code=e.http_status_code, detail=str(e))
+    if is_async:
+        future = pool.submit_coroutine(
+            _ahandle_chat_request(data, [queue_callback_handler])
+        )
+        cancel = future.cancel
+    else:
+        future = pool.submit(
+            _handle_chat_or_ingest_request,
+            data,
+            [],
+            cancel_event,
+            [queue_callback_handler],
+        )
+        cancel = cancel_event.set
+
+    async def generate_events():
+        try:
+            yield {"event": "status", "data": json.dumps("started")}
+            while True:
+                get_event_task = asyncio.ensure_future(queue.get())
+                await asyncio.wait(
+                    {get_event_task, future}, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not get_event_task.done():
+                    get_event_task.cancel()
+                    break  # the response is ready
+                yield get_event_task.result()
+
+            # Events are queued before the response is ready, but may not be consumed
+            while not queue.empty():
+                yield queue.get_nowait()
+            yield {"event": "response", "data": future.result().model_dump_json()}
+        finally:
+            # If the client disconnected, stop the request (see RequestWorkerPool)
+            if not future.done():
+                logger.info("Cancelling a running request")
+                cancel()
+
+    return EventSourceResponse(generate_events())
 
 
 if __name__ == "__main__":
@@ -1,7 +1,8 @@
 """Chain for chatting with a vector database."""
 from __future__ import annotations
 
-import inspect
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 from typing import Any, Callable
 from langchain.chains.base import Chain
@@ -10,7 +11,9 @@ from langchain.chains.llm import LLMChain
 from components.llm import get_llm_from_prompt_llm_chain
 from utils import lang_utils
 from utils.helpers import DELIMITER
-from utils.prepare import CONTEXT_LENGTH
+from utils.output import format_exception
+from utils.prepare import CONTEXT_LENGTH, get_logger
+from utils.strings import get_text_similarity
 from utils.type_utils import CallbacksOrNone, JSONish, PairwiseChatHistory
 from langchain_core.callbacks import AsyncCallbackManagerForChainRun, CallbackManagerForChainRun
 from langchain_core.documents import Document
@@ -18,6 +21,29 @@ from langchain_core.language_models import BaseLanguageModel
 from langchain_core.messages import BaseMessage
 from langchain_core.retrievers import BaseRetriever
 
+# Threads for retrieving docs while the standalone query is being generated
+# (only used by the sync version of the chain)
+_speculative_retrieval_executor = ThreadPoolExecutor(
+    max_workers=8, thread_name_prefix="speculative-retrieval"
+)
+
+logger = get_logger()
+
+
+def _log_speculative_retrieval_error(future: Future | asyncio.Future) -> None:
+    if not future.cancelled() and (e := future.exception()) is not None:
+        logger.warning(f"Unused speculative retrieval failed: {format_exception(e)}")
+
+
+def _discard_speculative_retrieval(future: Future | asyncio.Future) -> None:
+    """
+    Cancel a speculative retrieval whose docs won't be used. If it's already
+    running (or done), its result is collected when it's done, so that its error,
+    if any, is logged rather than silently dropped.
+    """
+    future.cancel()
+    future.add_done_callback(_log_speculative_retrieval_error)
+
 
 class ChatWithDocsChain(Chain):
     """
@@ -52,6 +78,14 @@ class ChatWithDocsChain(Chain):
             question as part of the final result. Default is False.
         get_chat_history (Callable[[PairwiseChatHistory], str] | None): An optional
             function to get a string of the chat history. Default is None.
+        speculative_retrieval (bool): Whether to retrieve docs for the user's
+            question while the standalone question is being generated, and reuse
+            them if the two questions are nearly identical (if they aren't, the
+            embedding of the user's question was computed for nothing). Default
+            is True.
+        min_similarity_to_reuse_docs (float): Minimum similarity (see
+            get_text_similarity) between the user's question and the standalone
+            question to reuse the docs from speculative retrieval. Default is 0.9.
     """
 
     qa_from_docs_chain: Any  # res of get_prompt_llm_chain (Chain causes pydantic error)
@@ -75,6 +109,9 @@ class ChatWithDocsChain(Chain):
     return_generated_question: bool = False
     format_chat_history: Callable[[PairwiseChatHistory], Any] | None = None
 
+    speculative_retrieval: bool = True
+    min_similarity_to_reuse_docs: float = 0.9
+
     class Config:
         """Configuration for this pydantic object."""
 
@@ -129,24 +166,14 @@ class ChatWithDocsChain(Chain):
 
         return docs[:num_docs], token_count
 
-    def _call(
-        self,
-        inputs: JSONish,
-        run_manager: CallbackManagerForChainRun | None = None,  # TODO consider removing
-    ) -> JSONish:
-        """Run the chain."""
-
-        # _run_manager = run_manager or CallbackManagerForChainRun.get_noop_manager()
-        callbacks = run_manager.get_child() if run_manager else (self.callbacks or [])
-
-        _format_chat_history = (
-            self.format_chat_history or lang_utils.pairwise_chat_history_to_string
-        )
-
-        # Get user's query and chat history from inputs
-        user_query = inputs["question"]
+    def _prepare_chat_history(
+        self, inputs: JSONish, llm_for_token_counting: BaseLanguageModel
+    ) -> tuple[PairwiseChatHistory, list[int]]:
+        """
+        Convert the chat history to PairwiseChatHistory, initially limit it and
+        calculate the token counts in each message pair.
+        """
         chat_history = inputs["chat_history"]
-        search_kwargs = inputs.get("search_params", {})  # e.g. {"filter": {...}}
 
         # Convert chat history to unified format (PairwiseChatHistory)
         # (it could instead be a list of messages, in which case we convert it)
@@ -161,40 +188,57 @@ class ChatWithDocsChain(Chain):
         chat_history_token_limit = max(
             self.max_tokens_limit_rephrase, self.max_tokens_limit_qa
         )
-        llm_for_token_counting = get_llm_from_prompt_llm_chain(self.qa_from_docs_chain)
-
-        chat_history, chat_history_token_counts = lang_utils.limit_chat_history(
+        return lang_utils.limit_chat_history(
             chat_history,
             max_token_limit=chat_history_token_limit,
             llm_for_token_counting=llm_for_token_counting,
         )
 
-        # Generate a standalone query using chat history
-        if not chat_history:
-            standalone_query = user_query  # no chat history to rephrase
-        else:
-            chat_history_for_rephrasing, _ = lang_utils.limit_chat_history(
-                chat_history,
-                max_token_limit=self.max_tokens_limit_rephrase,
-                cached_token_counts=chat_history_token_counts,
-                llm_for_token_counting=llm_for_token_counting,
-            )
-
-            standalone_query = self.query_generator_chain.invoke(
-                {
-                    "question": user_query,
-                    "chat_history": _format_chat_history(chat_history_for_rephrasing),
-                }
-                # callbacks=_run_manager.get_child(),
-            )["text"]
-
-        # Get relevant documents using the standalone query
-        docs = self.retriever.get_relevant_documents(
-            standalone_query,
-            # callbacks=_run_manager.get_child(),
-            **search_kwargs,
+    def _get_query_generator_inputs(
+        self,
+        user_query: str,
+        chat_history: PairwiseChatHistory,
+        chat_history_token_counts: list[int],
+        llm_for_token_counting: BaseLanguageModel,
+    ) -> JSONish:
+        """Get the inputs for generating a standalone query using chat history."""
+        _format_chat_history = (
+            self.format_chat_history or lang_utils.pairwise_chat_history_to_string
         )
+        chat_history_for_rephrasing, _ = lang_utils.limit_chat_history(
+            chat_history,
+            max_token_limit=self.max_tokens_limit_rephrase,
+            cached_token_counts=chat_history_token_counts,
+            llm_for_token_counting=llm_for_token_counting,
+        )
+        return {
+            "question": user_query,
+            "chat_history": _format_chat_history(chat_history_for_rephrasing),
+        }
+
+    def _can_reuse_speculative_docs(
+        self, user_query: str, standalone_query: str
+    ) -> bool:
+        """
+        Return True if the docs retrieved for the user's query can be used for the
+        standalone query, i.e. the two queries are nearly identical.
+        """
+        similarity = get_text_similarity(user_query, standalone_query)
+        print(f"SIMILARITY OF STANDALONE QUERY TO USER'S QUERY: {similarity:.2f}")
+        return similarity >= self.min_similarity_to_reuse_docs
 
+    def _get_qa_inputs(
+        self,
+        inputs: JSONish,
+        docs: list[Document],
+        chat_history: PairwiseChatHistory,
+        chat_history_token_counts: list[int],
+        llm_for_token_counting: BaseLanguageModel,
+    ) -> tuple[JSONish, list[Document]]:
+        """
+        Limit the docs and chat history to fit in the token limits and prepare the
+        inputs for the chat/qa chain. Returns the inputs and the docs that were kept.
+        """
         # Find limited token number for chat history
         # token_count_chat = 0
         # for token_count in reversed(chat_history_token_counts):
@@ -228,7 +272,7 @@ class ChatWithDocsChain(Chain):
 
         # Prepare inputs for the chat_with_docs prompt
         qa_inputs = {
-            "question": user_query,
+            "question": inputs["question"],
             "coll_name": inputs.get("coll_name", "<UNKNOWN>"),
             "chat_history": lang_utils.pairwise_chat_history_to_msg_list(
                 chat_history_for_qa
@@ -243,11 +287,11 @@ class ChatWithDocsChain(Chain):
                 context += ":"
             context += f"\n\n{doc.page_content}\n-------------\n\n"
         qa_inputs["context"] = context
+        return qa_inputs, docs
 
-        # Submit limited docs and chat history to the chat/qa chain
-        answer = self.qa_from_docs_chain.invoke(qa_inputs, {"callbacks": callbacks})
-
-        # Format and return the answer
+    def _get_output(
+        self, answer: str, docs: list[Document], standalone_query: str
+    ) -> JSONish:
         output = {self.output_key: answer}
         if self.return_source_documents:
             output["source_documents"] = docs
@@ -255,46 +299,148 @@ class ChatWithDocsChain(Chain):
             output["generated_question"] = standalone_query
         return output
 
-    async def _acall(
+    def _call(
         self,
-        inputs: dict[str, Any],
-        run_manager: AsyncCallbackManagerForChainRun | None = None,
-    ) -> dict[str, Any]:
-        raise NotImplementedError("Async version (_acall) not implemented yet.")
-        _run_manager = run_manager or AsyncCallbackManagerForChainRun.get_noop_manager()
-        question = inputs["question"]
-        get_chat_history = (
-            self.format_chat_history or lang_utils.pairwise_chat_history_to_string
+        inputs: JSONish,
+        run_manager: CallbackManagerForChainRun | None = None,  # TODO consider removing
+    ) -> JSONish:
+        """Run the chain."""
+
+        # _run_manager = run_manager or CallbackManagerForChainRun.get_noop_manager()
+        callbacks = run_manager.get_child() if run_manager else (self.callbacks or [])
+
+        # Get user's query, chat history and search params from inputs
+        user_query = inputs["question"]
+        search_kwargs = inputs.get("search_params", {})  # e.g. {"filter": {...}}
+        llm_for_token_counting = get_llm_from_prompt_llm_chain(self.qa_from_docs_chain)
+        chat_history, chat_history_token_counts = self._prepare_chat_history(
+            inputs, llm_for_token_counting
         )
-        chat_history_str = get_chat_history(inputs["chat_history"])
-        if chat_history_str:
-            callbacks = _run_manager.get_child()
-            new_question = await self.query_generator_chain.arun(
-                question=question, chat_history=chat_history_str, callbacks=callbacks
+
+        def get_docs(query: str) -> list[Document]:
+            return self.retriever.get_relevant_documents(
+                query,
+                # callbacks=_run_manager.get_child(),
+                **search_kwargs,
             )
+
+        # Generate a standalone query using chat history
+        if not chat_history:
+            standalone_query = user_query  # no chat history to rephrase
+            docs = None
         else:
-            new_question = question
-        accepts_run_manager = (
-            "run_manager" in inspect.signature(self._aget_docs).parameters
+            # Meanwhile, speculatively retrieve docs using the user's query
+            speculative_docs_future = (
+                _speculative_retrieval_executor.submit(get_docs, user_query)
+                if self.speculative_retrieval
+                else None
+            )
+            try:
+                standalone_query = self.query_generator_chain.invoke(
+                    self._get_query_generator_inputs(
+                        user_query,
+                        chat_history,
+                        chat_history_token_counts,
+                        llm_for_token_counting,
+                    )
+                    # callbacks=_run_manager.get_child(),
+                )["text"]
+            except BaseException:
+                if speculative_docs_future:
+                    _discard_speculative_retrieval(speculative_docs_future)
+                raise
+
+            docs = None
+            if speculative_docs_future:
+                if self._can_reuse_speculative_docs(user_query, standalone_query):
+                    docs = speculative_docs_future.result()
+                else:
+                    _discard_speculative_retrieval(speculative_docs_future)
+
+        # Get relevant documents using the standalone query (if not already done)
+        if docs is None:
+            docs = get_docs(standalone_query)
+
+        # Limit docs and chat history and submit them to the chat/qa chain
+        qa_inputs, docs = self._get_qa_inputs(
+            inputs, docs, chat_history, chat_history_token_counts, llm_for_token_counting
+        )
+        answer = self.qa_from_docs_chain.invoke(qa_inputs, {"callbacks": callbacks})
+
+        # Format and return the answer
+        return self._get_output(answer, docs, standalone_query)
+
+    async def _acall(
+        self,
+        inputs: JSONish,
+        run_manager: AsyncCallbackManagerForChainRun | None = None,
+    ) -> JSONish:
+        """
+        Run the chain asynchronously. The LLM calls, embedding and streaming are
+        natively async (see ChromaDDGRetriever for the Chroma calls), so this can
+        run in the event loop without tying up a thread.
+        """
+        callbacks = run_manager.get_child() if run_manager else (self.callbacks or [])
+
+        # Get user's query, chat history and search params from inputs
+        user_query = inputs["question"]
+        search_kwargs = inputs.get("search_params", {})  # e.g. {"filter": {...}}
+        llm_for_token_counting = get_llm_from_prompt_llm_chain(self.qa_from_docs_chain)
+        chat_history, chat_history_token_counts = self._prepare_chat_history(
+            inputs, llm_for_token_counting
         )
-        if accepts_run_manager:
-            docs = await self._aget_docs(new_question, inputs, run_manager=_run_manager)
+
+        async def aget_docs(query: str) -> list[Document]:
+            return await self.retriever.aget_relevant_documents(query, **search_kwargs)
+
+        # Generate a standalone query using chat history
+        if not chat_history:
+            standalone_query = user_query  # no chat history to rephrase
+            docs = None
         else:
-            docs = await self._aget_docs(new_question, inputs)  # type: ignore[call-arg]
-
-        new_inputs = inputs.copy()
-        if self.rephrase_question:
-            new_inputs["question"] = new_question
-        new_inputs["chat_history"] = chat_history_str
-        answer = await self.qa_from_docs_chain.arun(
-            input_documents=docs, callbacks=_run_manager.get_child(), **new_inputs
+            # Meanwhile, speculatively retrieve docs using the user's query
+            speculative_docs_task = (
+                asyncio.ensure_future(aget_docs(user_query))
+                if self.speculative_retrieval
+                else None
+            )
+            try:
+                standalone_query = (
+                    await self.query_generator_chain.ainvoke(
+                        self._get_query_generator_inputs(
+                            user_query,
+                            chat_history,
+                            chat_history_token_counts,
+                            llm_for_token_counting,
+                        )
+                    )
+                )["text"]
+            except BaseException:
+                if speculative_docs_task:
+                    _discard_speculative_retrieval(speculative_docs_task)
+                raise
+
+            docs = None
+            if speculative_docs_task:
+                if self._can_reuse_speculative_docs(user_query, standalone_query):
+                    docs = await speculative_docs_task
+                else:
+                    _discard_speculative_retrieval(speculative_docs_task)
+
+        # Get relevant documents using the standalone query (if not already done)
+        if docs is None:
+            docs = await aget_docs(standalone_query)
+
+        # Limit docs and chat history and submit them to the chat/qa chain
+        qa_inputs, docs = self._get_qa_inputs(
+            inputs, docs, chat_history, chat_history_token_counts, llm_for_token_counting
         )
-        output: dict[str, Any] = {self.output_key: answer}
-        if self.return_source_documents:
-            output["source_documents"] = docs
-        if self.return_generated_question:
-            output["generated_question"] = new_question
-        return output
+        answer = await self.qa_from_docs_chain.ainvoke(
+            qa_inputs, {"callbacks": callbacks}
+        )
+
+        # Format and return the answer
+        return self._get_output(answer, docs, standalone_query)
 
     def save(self, file_path: Path | str) -> None:
         if self.format_chat_history:
@@ -1,3 +1,4 @@
+import asyncio
 import os
 from typing import Any, Callable, Optional
 
@@ -22,6 +23,14 @@ from langchain_core.documents import Document
 
 logger = get_logger()
 
+# Metadata key of the records that store an agent's state in its collection (such
+# as ResearchReportData) rather than a document. They must be skipped in retrieval.
+STATE_RECORD_TYPE_KEY = "ddg_state_record_type"
+
+
+def is_state_record(metadata: dict | None) -> bool:
+    return bool(metadata) and STATE_RECORD_TYPE_KEY in metadata
+
 
 class CollectionDoesNotExist(DDGError):
     """Exception raised when a collection does not exist."""
@@ -146,6 +155,44 @@ class ChromaDDG(Chroma):
             the query text and cosine distance in float for each.
         """
 
+        # Query by text or embedding, depending on whether an embedding function is present
+        if self._embedding_function is None:
+            results = self._query_collection_ddg(query, k, filter, kwargs)
+        else:
+            query_embedding = self._embedding_function.embed_query(query)
+            results = self._query_collection_ddg(query_embedding, k, filter, kwargs)
+
+        return _results_to_docs_and_scores(results)
+
+    async def asimilarity_search_with_score(
+        self,
+        query: str,
+        k: int,  # = DEFAULT_K,
+        filter: Where | None = None,
+        **kwargs: Any,
+    ) -> list[tuple[Document, float]]:
+        """
+        Asynchronous version of similarity_search_with_score. The query is embedded
+        asynchronously, but chromadb's client is synchronous, so the query to the
+        collection is run in the default executor.
+        """
+        if self._embedding_function is None:
+            query_or_embedding = query
+        else:
+            query_or_embedding = await self._embedding_function.aembed_query(query)
+
+        results = await asyncio.to_thread(
+            self._query_collection_ddg, query_or_embedding, k, filter, kwargs
+        )
+        return _results_to_docs_and_scores(results)
+
+    def _query_collection_ddg(
+        self,
+        query_or_embedding: str | list[float],
+        k: int,
+        filter: Where | None,
+        kwargs: dict[str, Any],
+    ) -> Any:
         # Determine if the passed kwargs contain a 'where_document' parameter
         # If so, we'll pass it to the __query_collection method
         try:
@@ -153,24 +200,16 @@ class ChromaDDG(Chroma):
         except KeyError:
             possible_where_document_kwarg = {}
 
-        # Query by text or embedding, depending on whether an embedding function is present
-        if self._embedding_function is None:
-            results = self._Chroma__query_collection(
-                query_texts=[query],
-                n_results=k,
-                where=filter,
-                **possible_where_document_kwarg,
-            )
+        if isinstance(query_or_embedding, str):
+            query_kwarg = {"query_texts": [query_or_embedding]}
         else:
-            query_embedding = self._embedding_function.embed_query(query)
-            results = self._Chroma__query_collection(
-                query_embeddings=[query_embedding],
-                n_results=k,
-                where=filter,
-                **possible_where_document_kwarg,
-            )
-
-        return _results_to_docs_and_scores(results)
+            query_kwarg = {"query_embeddings": [query_or_embedding]}
+        return self._Chroma__query_collection(
+            **query_kwarg,
+            n_results=k,
+            where=filter,
+            **possible_where_document_kwarg,
+        )
 
 
 def exists_collection(
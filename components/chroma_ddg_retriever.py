@@ -1,11 +1,12 @@
+import asyncio
 from typing import Any, ClassVar
 
 from chromadb.api.types import Where, WhereDocument
 from langchain_core.documents import Document
-from pydantic import Field
 
+from components.chroma_ddg import is_state_record
 from utils.helpers import DELIMITER, lin_interpolate
-from utils.lang_utils import expand_chunks
+from utils.lang_utils import expand_chunks, token_count_cache
 from utils.prepare import CONTEXT_LENGTH, EMBEDDINGS_MODEL_NAME
 from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
 from langchain_core.language_models import BaseLanguageModel
@@ -47,9 +48,6 @@ class ChromaDDGRetriever(VectorStoreRetriever):
     max_total_tokens = int(CONTEXT_LENGTH * 0.5)  # consistent with ChatWithDocsChain
     max_average_tokens_per_chunk = int(max_total_tokens / k_max)
 
-    # get_relevant_documents() must return only docs, but we'll save scores here
-    similarities: list = Field(default_factory=list)
-
     allowed_search_types: ClassVar[tuple[str]] = (
         "similarity",
         # "similarity_score_threshold", # NOTE can add at some point
@@ -57,32 +55,23 @@ class ChromaDDGRetriever(VectorStoreRetriever):
         "similarity_ddg",
     )
 
-    def _get_relevant_documents(
+    def _get_search_kwargs(
         self,
-        query: str,
-        *,
-        run_manager: CallbackManagerForRetrieverRun,
-        filter: Where | None = None,  # For metadata (Langchain naming convention)
-        where_document: WhereDocument | None = None,  # Filter by text in document
-        **kwargs: Any,  # For additional search params
-    ) -> list[Document]:
+        filter: Where | None,
+        where_document: WhereDocument | None,
+        kwargs: dict[str, Any],
+    ) -> dict[str, Any]:
         # Combine global search kwargs with per-query search params passed here
         search_kwargs = self.search_kwargs | kwargs
         if filter is not None:
             search_kwargs["filter"] = filter
         if where_document is not None:
             search_kwargs["where_document"] = where_document
+        return search_kwargs
 
-        # Perform search depending on search type
-        if self.search_type == "similarity":
-            return self.vectorstore.similarity_search(query, **search_kwargs)
-        elif self.search_type == "mmr":
-            return self.vectorstore.max_marginal_relevance_search(
-                query, **search_kwargs
-            )
-
-        # Main search method used by DocDocGo
-        assert self.search_type == "similarity_ddg", "Invalid search type"
+    def _get_overshot_search_kwargs(
+        self, search_kwargs: dict[str, Any]
+    ) -> dict[str, Any]:
         assert str(type(self.vectorstore)).endswith("ChromaDDG'>"), "Bad vectorstore"
 
         # First, get more docs than we need, then we'll pare them down
@@ -93,28 +82,33 @@ class ChromaDDGRetriever(VectorStoreRetriever):
         #     score_threshold := search_kwargs["score_threshold"],
         #     self.score_threshold_overshot,
         # )  # usually simply 0
+        return search_kwargs | {
+            "k": self.k_overshot,
+            "score_threshold": self.score_threshold_overshot,
+        }
 
-        docs_and_similarities_overshot = (
-            self.vectorstore.similarity_search_with_relevance_scores(
-                query,
-                **(
-                    search_kwargs
-                    | {
-                        "k": self.k_overshot,
-                        "score_threshold": self.score_threshold_overshot,
-                    }
-                ),
-            )
-        )
+    def _pare_down(
+        self, docs_and_similarities_overshot: list[tuple[Document, float]]
+    ) -> tuple[list[Document], list[float]]:
+        """
+        Keep the most relevant chunks, depending on their similarity scores. Return
+        the chunks and their similarities. (The similarities are returned rather
+        than stored on the retriever, since it can be used by concurrent retrievals.)
+        """
+        # Skip records that store agent state rather than documents
+        docs_and_similarities_overshot = [
+            (doc, sim)
+            for doc, sim in docs_and_similarities_overshot
+            if not is_state_record(doc.metadata)
+        ]
 
         if self.verbose:
             for doc, sim in docs_and_similarities_overshot:
                 print(f"[SIMILARITY: {sim:.2f}] {repr(doc.page_content[:60])}")
             print(f"Before paring down: {len(docs_and_similarities_overshot)} docs.")
 
-        # Now, pare down the results
         chunks: list[Document] = []
-        self.similarities: list[float] = []
+        similarities: list[float] = []
         for k, (doc, sim) in enumerate(docs_and_similarities_overshot, start=1):
             # If we've already found enough docs, stop
             if k > self.k_max:
@@ -135,36 +129,40 @@ class ChromaDDGRetriever(VectorStoreRetriever):
 
             # Otherwise, add the doc to the list and keep going
             chunks.append(doc)
-            self.similarities.append(sim)
+            similarities.append(sim)
 
         if self.verbose:
             print(f"After paring down: {len(chunks)} docs.")
             if chunks:
                 print(
-                    f"Similarities from {self.similarities[-1]:.2f} to {self.similarities[0]:.2f}"
+                    f"Similarities from {similarities[-1]:.2f} to {similarities[0]:.2f}"
                 )
             print(DELIMITER)
+        return chunks, similarities
 
-        # Get the parent documents for the chunks
+    def _get_parent_ids(self, chunks: list[Document]) -> list[str] | None:
+        """Get the ids of the parent docs, or None if it's an older collection."""
         try:
             print("METADATAS:")
             for chunk in chunks:
                 print(chunk.metadata)
-            parent_ids = [chunk.metadata["parent_id"] for chunk in chunks]
+            return list({chunk.metadata["parent_id"] for chunk in chunks})
         except KeyError:
-            # If it's an older collection, without parent docs, just return the chunks
-            return chunks
-        unique_parent_ids = list(set(parent_ids))
-        rsp = self.vectorstore.collection.get(unique_parent_ids)
+            return None
 
-        parent_docs_by_id = {
+    def _get_parent_docs(self, parent_ids: list[str]) -> dict[str, Document]:
+        rsp = self.vectorstore.collection.get(parent_ids)
+        return {
             id: Document(page_content=text, metadata=metadata)
             for id, text, metadata in zip(
                 rsp["ids"], rsp["documents"], rsp["metadatas"]
             )
         }
 
-        # Expand chunks using the parent docs
+    def _expand_chunks(
+        self, chunks: list[Document], parent_docs_by_id: dict[str, Document]
+    ) -> list[Document]:
+        """Expand chunks using the parent docs."""
         max_total_tokens = min(
             self.max_total_tokens, self.max_average_tokens_per_chunk * len(chunks)
         )
@@ -174,9 +172,85 @@ class ChromaDDGRetriever(VectorStoreRetriever):
             max_total_tokens,
             llm_for_token_counting=self.llm_for_token_counting,
         )
+        if self.verbose:
+            print("Token count cache:", token_count_cache.get_stats())
         return expanded_chunks
 
+    def _get_relevant_documents(
+        self,
+        query: str,
+        *,
+        run_manager: CallbackManagerForRetrieverRun,
+        filter: Where | None = None,  # For metadata (Langchain naming convention)
+        where_document: WhereDocument | None = None,  # Filter by text in document
+        **kwargs: Any,  # For additional search params
+    ) -> list[Document]:
+        search_kwargs = self._get_search_kwargs(filter, where_document, kwargs)
+
+        # Perform search depending on search type
+        if self.search_type == "similarity":
+            return self.vectorstore.similarity_search(query, **search_kwargs)
+        elif self.search_type == "mmr":
+            return self.vectorstore.max_marginal_relevance_search(
+                query, **search_kwargs
+            )
+
+        # Main search method used by DocDocGo
+        assert self.search_type == "similarity_ddg", "Invalid search type"
+        docs_and_similarities_overshot = (
+            self.vectorstore.similarity_search_with_relevance_scores(
+                query, **self._get_overshot_search_kwargs(search_kwargs)
+            )
+        )
+
+        # Now, pare down the results
+        chunks, _ = self._pare_down(docs_and_similarities_overshot)
+
+        # Get the parent documents for the chunks
+        if (parent_ids := self._get_parent_ids(chunks)) is None:
+            return chunks  # older collection, without parent docs
+        parent_docs_by_id = self._get_parent_docs(parent_ids)
+
+        # Expand chunks using the parent docs
+        return self._expand_chunks(chunks, parent_docs_by_id)
+
     async def _aget_relevant_documents(
-        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+        self,
+        query: str,
+        *,
+        run_manager: AsyncCallbackManagerForRetrieverRun,
+        filter: Where | None = None,
+        where_document: WhereDocument | None = None,
+        **kwargs: Any,
     ) -> list[Document]:
-        raise NotImplementedError("Asynchronous retrieval not yet supported.")
+        # NOTE: the query is embedded asynchronously, but chromadb's client is
+        # synchronous, so the Chroma calls (and the CPU-bound chunk expansion)
+        # are run in the default executor to keep the event loop responsive.
+        search_kwargs = self._get_search_kwargs(filter, where_document, kwargs)
+
+        # Perform search depending on search type
+        if self.search_type == "similarity":
+            return await self.vectorstore.asimilarity_search(query, **search_kwargs)
+        elif self.search_type == "mmr":
+            return await self.vectorstore.amax_marginal_relevance_search(
+                query, **search_kwargs
+            )
+
+        # Main search method used by DocDocGo
+        assert self.search_type == "similarity_ddg", "Invalid search type"
+        docs_and_similarities_overshot = (
+            await self.vectorstore.asimilarity_search_with_relevance_scores(
+                query, **self._get_overshot_search_kwargs(search_kwargs)
+            )
+        )
+
+        # Now, pare down the results
+        chunks, _ = self._pare_down(docs_and_similarities_overshot)
+
+        # Get the parent documents for the chunks
+        if (parent_ids := self._get_parent_ids(chunks)) is None:
+            return chunks  # older collection, without parent docs
+        parent_docs_by_id = await asyncio.to_thread(self._get_parent_docs, parent_ids)
+
+        # Expand chunks using the parent docs
+        return await asyncio.to_thread(self._expand_chunks, chunks, parent_docs_by_id)
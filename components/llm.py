@@ -1,8 +1,10 @@
-from typing import Any
+import asyncio
+import json
+import threading
+from typing import TYPE_CHECKING, Any
 from uuid import UUID
 from langchain_core.outputs import ChatGenerationChunk, GenerationChunk, LLMResult
 from langchain_openai import AzureChatOpenAI, ChatOpenAI
-from streamlit.delta_generator import DeltaGenerator
 
 from utils.helpers import DELIMITER, MAIN_BOT_PREFIX
 from utils.lang_utils import msg_list_chat_history_to_string
@@ -11,7 +13,8 @@ from utils.prepare import (
     IS_AZURE,
     LLM_REQUEST_TIMEOUT,
 )
-from utils.streamlit.helpers import fix_markdown
+from utils.request_pool import RequestCancelledError
+from utils.strings import fix_markdown
 from utils.type_utils import BotSettings, CallbacksOrNone
 from langchain_core.callbacks import BaseCallbackHandler
 from langchain_core.language_models import BaseChatModel
@@ -19,9 +22,12 @@ from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompt_values import ChatPromptValue
 from langchain_core.prompts import PromptTemplate
 
+if TYPE_CHECKING:
+    from streamlit.delta_generator import DeltaGenerator  # slow to import
+
 
 class CallbackHandlerDDGStreamlit(BaseCallbackHandler):
-    def __init__(self, container: DeltaGenerator, end_str: str = ""):
+    def __init__(self, container: "DeltaGenerator", end_str: str = ""):
         self.container = container
         self.buffer = ""
         self.end_str = end_str
@@ -53,7 +59,66 @@ class CallbackHandlerDDGStreamlit(BaseCallbackHandler):
             self.container.markdown(fix_markdown(self.buffer + self.end_str))
 
 
+class CallbackHandlerDDGQueue(BaseCallbackHandler):
+    """
+    Callback handler that puts the streamed tokens (and status updates) as
+    server-sent events into an asyncio queue. It can be used from any thread: the
+    events are put into the queue in the queue's event loop.
+    """
+
+    run_inline = True  # in async runs, call it in the event loop, not an executor
+
+    def __init__(self, queue: asyncio.Queue, loop: asyncio.AbstractEventLoop):
+        self.queue = queue
+        self.loop = loop
+
+    def _put(self, event: str, data: Any) -> None:
+        self.loop.call_soon_threadsafe(
+            self.queue.put_nowait, {"event": event, "data": json.dumps(data)}
+        )
+
+    def on_retriever_start(self, *args, **kwargs) -> None:
+        self._put("status", "retrieving")
+
+    def on_llm_start(self, *args, **kwargs) -> None:
+        self._put("status", "generating")
+
+    def on_chat_model_start(self, *args, **kwargs) -> None:
+        self._put("status", "generating")
+
+    def on_llm_new_token(self, token: str, **kwargs) -> None:
+        self._put("token", token)
+
+
+class CallbackHandlerDDGCancellation(BaseCallbackHandler):
+    """
+    Callback handler that aborts the run (by raising RequestCancelledError) at the
+    next LLM event once cancel_event is set, e.g. because the client disconnected.
+    """
+
+    raise_error = True  # so that LangChain doesn't just log the exception
+    run_inline = True
+
+    def __init__(self, cancel_event: threading.Event):
+        self.cancel_event = cancel_event
+
+    def _raise_if_cancelled(self) -> None:
+        if self.cancel_event.is_set():
+            raise RequestCancelledError("The request was cancelled")
+
+    def on_llm_start(self, *args, **kwargs) -> None:
+        self._raise_if_cancelled()
+
+    def on_chat_model_start(self, *args, **kwargs) -> None:
+        self._raise_if_cancelled()
+
+    def on_llm_new_token(self, *args, **kwargs) -> None:
+        self._raise_if_cancelled()
+
+
 class CallbackHandlerDDGConsole(BaseCallbackHandler):
+    run_inline = True
+
     def __init__(self, init_str: str = MAIN_BOT_PREFIX):
         self.init_str = init_str
 
@@ -1,31 +1,139 @@
+import asyncio
 import os
+from functools import lru_cache
 
 from langchain_core.embeddings import Embeddings
 from langchain_openai import OpenAIEmbeddings
 
+from utils.embedding_cache import EmbeddingCache, get_embedding_cache
 from utils.prepare import EMBEDDINGS_DIMENSIONS, EMBEDDINGS_MODEL_NAME, IS_AZURE
 
 
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings that look up the embeddings of texts in an EmbeddingCache and only
+    use the underlying embeddings object for texts that aren't cached (each unique
+    text is embedded once). Queries and documents share the cache, since OpenAI
+    embeds them the same way.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        cache: EmbeddingCache,
+        model_name: str,
+        dimensions: int,
+    ):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model_name = model_name
+        self.dimensions = dimensions
+
+    def _get_cached(self, texts: list[str]) -> list[list[float] | None]:
+        return self.cache.get_many(self.model_name, self.dimensions, texts)
+
+    def _put(self, texts: list[str], embeddings: list[list[float]]) -> None:
+        self.cache.put_many(self.model_name, self.dimensions, texts, embeddings)
+
+    @staticmethod
+    def _get_texts_to_embed(
+        texts: list[str], cached_embeddings: list[list[float] | None]
+    ) -> list[str]:
+        return list(
+            dict.fromkeys(  # unique, in order
+                text for text, emb in zip(texts, cached_embeddings) if emb is None
+            )
+        )
+
+    @staticmethod
+    def _fill_in(
+        texts: list[str],
+        cached_embeddings: list[list[float] | None],
+        new_texts: list[str],
+        new_embeddings: list[list[float]],
+    ) -> list[list[float]]:
+        new_embedding_by_text = dict(zip(new_texts, new_embeddings))
+        return [
+            new_embedding_by_text[text] if emb is None else emb
+            for text, emb in zip(texts, cached_embeddings)
+        ]
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        cached_embeddings = self._get_cached(texts)
+        if new_texts := self._get_texts_to_embed(texts, cached_embeddings):
+            new_embeddings = self.embeddings.embed_documents(new_texts)
+            self._put(new_texts, new_embeddings)
+        else:
+            new_embeddings = []
+        return self._fill_in(texts, cached_embeddings, new_texts, new_embeddings)
+
+    def embed_query(self, text: str) -> list[float]:
+        if (embedding := self._get_cached([text])[0]) is None:
+            embedding = self.embeddings.embed_query(text)
+            self._put([text], [embedding])
+        return embedding
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        # NOTE: SQLite is synchronous, so the cache is accessed in the default executor
+        cached_embeddings = await asyncio.to_thread(self._get_cached, texts)
+        if new_texts := self._get_texts_to_embed(texts, cached_embeddings):
+            new_embeddings = await self.embeddings.aembed_documents(new_texts)
+            await asyncio.to_thread(self._put, new_texts, new_embeddings)
+        else:
+            new_embeddings = []
+        return self._fill_in(texts, cached_embeddings, new_texts, new_embeddings)
+
+    async def aembed_query(self, text: str) -> list[float]:
+        [embedding] = await asyncio.to_thread(self._get_cached, [text])
+        if embedding is None:
+            embedding = await self.embeddings.aembed_query(text)
+            await asyncio.to_thread(self._put, [text], [embedding])
+        return embedding
+
+
 def get_openai_embeddings(
     api_key: str | None = None,
     embeddings_model_name: str = EMBEDDINGS_MODEL_NAME,
     embeddings_dimensions: int = EMBEDDINGS_DIMENSIONS,
 ) -> Embeddings:
-    # Create the embeddings object, pulling current values of env vars
+    """
+    Get the embeddings object for the given settings (with caching of embeddings,
+    unless the embedding cache is disabled). The object is reused across calls
+    with the same settings, so that its HTTP connections are reused as well.
+    """
+    if IS_AZURE:
+        # (the settings are determined by the env vars, which may be changed)
+        embeddings_model_name = os.getenv("EMBEDDINGS_DEPLOYMENT_NAME") or ""
+        embeddings_dimensions = 0  # use the deployment's default dimensions
+    elif embeddings_model_name == "text-embeddings-ada-002":
+        embeddings_dimensions = 0  # the model doesn't support setting dimensions
+    return _get_openai_embeddings(
+        api_key or "", embeddings_model_name, embeddings_dimensions
+    )
+
+
+@lru_cache(maxsize=64)
+def _get_openai_embeddings(
+    api_key: str, embeddings_model_name: str, embeddings_dimensions: int
+) -> Embeddings:
+    # Create the embeddings object
     # (as of Aug 8, 2023, max chunk size for Azure API is 16)
-    return (
+    embeddings = (
         OpenAIEmbeddings(  # NOTE: should be able to simplify this
-            deployment=os.getenv("EMBEDDINGS_DEPLOYMENT_NAME"), chunk_size=16
+            deployment=embeddings_model_name or None, chunk_size=16
         )
         if IS_AZURE
         else OpenAIEmbeddings(
-            api_key=api_key or "",
+            api_key=api_key,
             model=embeddings_model_name,
-            dimensions=None
-            if embeddings_model_name == "text-embeddings-ada-002"
-            else embeddings_dimensions,
+            dimensions=embeddings_dimensions or None,
         )  # NOTE: if empty API key, will throw
     )
+    if (cache := get_embedding_cache()) is None:
+        return embeddings
+    return CachedEmbeddings(
+        embeddings, cache, embeddings_model_name, embeddings_dimensions
+    )
 
 
 # class OpenAIEmbeddingsDDG(Embeddings):
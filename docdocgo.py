@@ -1,3 +1,4 @@
+import asyncio
 import os
 from typing import Any
 
@@ -40,18 +41,29 @@ logger = get_logger()
 
 default_vectorstore = None  # can move to chat_state
 
+# QA prompts for the chat modes that chat with the docs (see get_docs_chat_chain)
+QA_PROMPT_BY_DOCS_CHAT_MODE_VAL = {
+    ChatMode.CHAT_WITH_DOCS_COMMAND_ID.value: CHAT_WITH_DOCS_PROMPT,  # /kb
+    ChatMode.DETAILS_COMMAND_ID.value: QA_PROMPT_SUMMARIZE_KB,  # /details
+    ChatMode.QUOTES_COMMAND_ID.value: QA_PROMPT_QUOTES,  # /quotes
+}
+
+
+def get_docs_chat_qa_prompt(chat_mode_val: str):
+    """
+    Return the QA prompt for a chat mode (given by its value) that chats with the
+    docs (/kb, /details, /quotes), or None if the chat mode doesn't.
+    """
+    return QA_PROMPT_BY_DOCS_CHAT_MODE_VAL.get(chat_mode_val)
+
 
 def get_bot_response(chat_state: ChatState):
     global default_vectorstore
     chat_mode_val = (
         chat_state.chat_mode.value
     )  # use value due to Streamlit code reloading
-    if chat_mode_val == ChatMode.CHAT_WITH_DOCS_COMMAND_ID.value:  # /kb command
-        chat_chain = get_docs_chat_chain(chat_state)
-    elif chat_mode_val == ChatMode.DETAILS_COMMAND_ID.value:  # /details command
-        chat_chain = get_docs_chat_chain(chat_state, prompt_qa=QA_PROMPT_SUMMARIZE_KB)
-    elif chat_mode_val == ChatMode.QUOTES_COMMAND_ID.value:  # /quotes command
-        chat_chain = get_docs_chat_chain(chat_state, prompt_qa=QA_PROMPT_QUOTES)
+    if prompt_qa := get_docs_chat_qa_prompt(chat_mode_val):  # /kb, /details, /quotes
+        chat_chain = get_docs_chat_chain(chat_state, prompt_qa=prompt_qa)
     elif chat_mode_val == ChatMode.WEB_COMMAND_ID.value:  # /web command
         return get_websearcher_response(chat_state)
     elif chat_mode_val == ChatMode.SUMMARIZE_COMMAND_ID.value:  # /summarize command
@@ -120,16 +132,43 @@ def get_bot_response(chat_state: ChatState):
         # Should never happen
         raise ValueError(f"Invalid chat mode: {chat_state.chat_mode}")
 
-    return chat_chain.invoke(
-        {
-            "question": chat_state.message,
-            "coll_name": get_user_facing_collection_name(
-                chat_state.user_id, chat_state.vectorstore.name
-            ),
-            "chat_history": chat_state.chat_history,
-            "search_params": chat_state.search_params,
-        }
-    )
+    return chat_chain.invoke(get_docs_chat_chain_inputs(chat_state))
+
+
+def supports_async_bot_response(chat_mode: ChatMode) -> bool:
+    """
+    Return True if aget_bot_response can handle the chat mode without a thread.
+    """
+    return get_docs_chat_qa_prompt(chat_mode.value) is not None
+
+
+async def aget_bot_response(chat_state: ChatState):
+    """
+    Asynchronous version of get_bot_response. The commands that chat with the
+    docs (/kb, /details, /quotes) run natively in the event loop (condensing the
+    question, retrieval and streaming the answer); other commands are run by
+    get_bot_response in a thread.
+    """
+    prompt_qa = get_docs_chat_qa_prompt(chat_state.chat_mode.value)
+    if prompt_qa is None:
+        return await asyncio.to_thread(get_bot_response, chat_state)
+
+    chat_chain = get_docs_chat_chain(chat_state, prompt_qa=prompt_qa)
+    return await chat_chain.ainvoke(get_docs_chat_chain_inputs(chat_state))
+
+
+def get_docs_chat_chain_inputs(chat_state: ChatState) -> dict[str, Any]:
+    """
+    Get the inputs for the chain returned by get_docs_chat_chain.
+    """
+    return {
+        "question": chat_state.message,
+        "coll_name": get_user_facing_collection_name(
+            chat_state.user_id, chat_state.vectorstore.name
+        ),
+        "chat_history": chat_state.chat_history,
+        "search_params": chat_state.search_params,
+    }
 
 
 def get_source_links(result_from_chain: dict[str, Any]) -> list[str]:
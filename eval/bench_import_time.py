@@ -0,0 +1,74 @@
+"""
+Benchmark for the startup (import) time of the app's entry points, based on
+`python -X importtime`. For each module, it reports the median total import time
+over several runs, the top-level packages that take the most time to import, and
+which of the heavy optional packages (only needed for some features) got imported.
+
+Usage (from the repo root, with the same environment as the app):
+    python -m eval.bench_import_time [MODULE ...] [--runs N] [--top N]
+
+By default, it measures `api` (the FastAPI server) and `docdocgo` (the CLI).
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+
+DEFAULT_MODULES = ["api", "docdocgo"]
+
+# Packages that should only be imported on first use
+LAZY_PACKAGES = ["playwright", "streamlit", "trafilatura", "pypdf", "docx2txt"]
+
+
+def parse_importtime(stderr: str) -> dict[str, tuple[int, int]]:
+    """
+    Parse the output of `python -X importtime` into {module: (self_us, cumulative_us)}.
+    """
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def measure(module: str) -> dict[str, tuple[int, int]]:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Could not import {module}:\n{result.stderr[-2000:]}")
+    return parse_importtime(result.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("modules", nargs="*", default=DEFAULT_MODULES)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    for module in args.modules:
+        runs = [measure(module) for _ in range(args.runs)]
+        total_ms = statistics.median(run[module][1] / 1000 for run in runs)
+        print(f"{module}: {total_ms:.0f} ms (median of {args.runs} runs)")
+
+        # Attribute each module's own time to its top-level package (last run)
+        ms_by_package = defaultdict(float)
+        for name, (self_us, _) in runs[-1].items():
+            ms_by_package[name.split(".")[0]] += self_us / 1000
+        heaviest = sorted(ms_by_package.items(), key=lambda x: x[1], reverse=True)
+        for package, ms in heaviest[: args.top]:
+            print(f"    {package:<32} {ms:8.0f} ms")
+
+        imported_lazy_packages = [p for p in LAZY_PACKAGES if p in runs[-1]]
+        print(f"    Heavy optional packages imported: {imported_lazy_packages or 'none'}")
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Benchmark for limit_tokens_in_text: the single-pass implementation (encode once,
+cut at a token boundary) vs the previous one (count tokens word by word for an
+initial guess, then re-encode the joined words until under the limit).
+
+Usage (from the repo root):
+    python -m eval.bench_limit_tokens [NUM_WORDS] [NUM_DOCS]
+"""
+import random
+import sys
+import time
+
+from utils.lang_utils import get_tiktoken_encoding, limit_tokens_in_text
+
+WORDS = (
+    "the of and to in is that for it as with was on be by this are from at or an "
+    "research results model data analysis performance system approach method "
+    "significant however therefore résumé naïve coöperate 東京 données über "
+    "2024 3.14 e.g. (see above) — well-known state-of-the-art"
+).split()
+
+
+def count_tokens(text: str) -> int:
+    # NOTE: not get_num_tokens, whose cache would make the per-word version look
+    # faster than it was (it didn't have the cache) and skew the token counts
+    return len(get_tiktoken_encoding().encode_ordinary(text))
+
+
+def limit_tokens_in_text_per_word(text: str, max_tokens: int, slow_down_factor=1.0):
+    """The previous implementation of limit_tokens_in_text, for comparison."""
+    words = text.split(" ")
+    num_tokens = 0
+    at_most_words = len(words)
+    for i, word in enumerate(words):
+        num_tokens += count_tokens(word)
+        if num_tokens > max_tokens:
+            at_most_words = i
+            break
+    while True:
+        text = " ".join(words[:at_most_words])
+        true_num_tokens = count_tokens(text)
+        if true_num_tokens <= max_tokens:
+            return text, true_num_tokens
+        at_most_words = int(
+            at_most_words
+            * (max_tokens / true_num_tokens + slow_down_factor)
+            / (1 + slow_down_factor)
+        )
+
+
+def make_doc(num_words: int, rng: random.Random) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(num_words))
+
+
+def run_benchmark(name: str, func, docs: list[str], max_tokens: int):
+    start = time.perf_counter()
+    results = [func(doc, max_tokens) for doc in docs]
+    elapsed = time.perf_counter() - start
+    avg_num_tokens = sum(count_tokens(text) for text, _ in results) / len(results)
+    print(
+        f"{name:<16} {elapsed / len(docs) * 1000:9.1f} ms/doc "
+        f"(avg {avg_num_tokens:.0f} tokens kept, limit {max_tokens})"
+    )
+
+
+def main():
+    num_words = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    num_docs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    rng = random.Random(0)
+    docs = [make_doc(num_words, rng) for _ in range(num_docs)]
+    count_tokens("warm up")  # load the encoding before timing
+
+    for max_tokens in (2000, 15000):
+        run_benchmark("per word", limit_tokens_in_text_per_word, docs, max_tokens)
+        run_benchmark("single pass", limit_tokens_in_text, docs, max_tokens)
+
+
+if __name__ == "__main__":
+    main()
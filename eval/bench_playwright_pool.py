@@ -0,0 +1,86 @@
+"""
+Benchmark for fetching URLs with playwright: a browser launch per URL (the path
+taken outside the shared event loop) vs the shared browser pool.
+
+Usage (from the repo root):
+    python -m eval.bench_playwright_pool [NUM_URLS] [NUM_ROUNDS]
+
+The pages are served by a local HTTP server, so that the numbers reflect the
+browser overhead rather than the network.
+"""
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import utils.url_cache
+from utils.async_utils import make_sync, make_sync_in_shared_loop
+from utils.web import afetch_urls_in_parallel_playwright
+
+utils.url_cache.URL_CACHE_DIR = ""  # disable the URL cache, we want to measure fetching
+
+PAGE_HTML = (
+    "<html><head><title>Page {idx}</title></head><body>"
+    + "<p>Some reasonably long paragraph of text for page {idx}.</p>" * 50
+    + "</body></html>"
+)
+
+
+class PageHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = PAGE_HTML.format(idx=self.path).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def run_benchmark(name: str, fetcher, urls: list[str], num_rounds: int):
+    # Several rounds (batches), as when the researcher fetches URLs in batches
+    start = time.perf_counter()
+    num_errors = 0
+    for _ in range(num_rounds):
+        htmls = fetcher(urls)
+        num_errors += sum(html.startswith("Error: ") for html in htmls)
+    elapsed = time.perf_counter() - start
+    num_fetched = len(urls) * num_rounds
+    print(
+        f"{name:<28} {num_fetched / elapsed:8.2f} URLs/s "
+        f"({num_fetched} URLs in {elapsed:.2f}s, {num_errors} errors)"
+    )
+
+
+def main():
+    num_urls = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    num_rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+    urls = [f"http://127.0.0.1:{port}/page-{i}" for i in range(num_urls)]
+
+    try:
+        # Outside the shared loop, a browser is launched for each URL
+        run_benchmark(
+            "browser per URL",
+            make_sync(afetch_urls_in_parallel_playwright),
+            urls,
+            num_rounds,
+        )
+        # In the shared loop, pages come from the shared browser pool
+        run_benchmark(
+            "shared browser pool",
+            make_sync_in_shared_loop(afetch_urls_in_parallel_playwright),
+            urls,
+            num_rounds,
+        )
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
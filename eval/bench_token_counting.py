@@ -0,0 +1,96 @@
+"""
+Benchmark for counting tokens in a list of texts: one by one, with a new thread
+pool per call (the previous implementation of get_num_tokens_in_texts), and with
+tiktoken's batch encoding. Used to choose MIN_CHARS_FOR_BATCH_TOKENIZATION in
+utils.lang_utils: the total length above which the batch encoding is faster.
+
+Usage (from the repo root):
+    python -m eval.bench_token_counting [NUM_ROUNDS]
+"""
+import random
+import sys
+import time
+
+from utils.async_utils import execute_func_map_in_threads
+from utils.lang_utils import NUM_TOKENIZATION_THREADS, get_tiktoken_encoding
+
+WORDS = (
+    "the of and to in is that for it as with was on be by this are from at or an "
+    "research results model data analysis performance system approach method "
+    "significant however therefore 2024 3.14 e.g. (see above) state-of-the-art"
+).split()
+
+# (number of texts, number of chars per text)
+CASES = [
+    (2, 1000),
+    (10, 1000),
+    (10, 5000),
+    (20, 5000),
+    (10, 20000),
+    (20, 20000),
+    (50, 20000),
+    (20, 100000),
+]
+
+
+def make_text(num_chars: int, rng: random.Random) -> str:
+    words = []
+    length = 0
+    while length < num_chars:
+        words.append(rng.choice(WORDS))
+        length += len(words[-1]) + 1
+    return " ".join(words)[:num_chars]
+
+
+def time_func(func, texts: list[str], num_rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(num_rounds):
+        func(texts)
+    return (time.perf_counter() - start) / num_rounds * 1000
+
+
+def main():
+    num_rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    encoding = get_tiktoken_encoding()
+    encoding.encode_ordinary("warm up")
+
+    def count_inline(texts):
+        return [len(encoding.encode_ordinary(text)) for text in texts]
+
+    def count_in_threads(texts):
+        return execute_func_map_in_threads(
+            lambda text: len(encoding.encode_ordinary(text)), texts
+        )
+
+    def count_batch(texts):
+        return [
+            len(token_ids)
+            for token_ids in encoding.encode_ordinary_batch(
+                texts, num_threads=NUM_TOKENIZATION_THREADS
+            )
+        ]
+
+    print(f"Batch encoding with {NUM_TOKENIZATION_THREADS} threads")
+    print(f"{'texts':>6} {'chars':>10} {'inline':>10} {'threads':>10} {'batch':>10}")
+    rng = random.Random(0)
+    min_chars_batch_faster = None
+    for num_texts, num_chars in CASES:
+        texts = [make_text(num_chars, rng) for _ in range(num_texts)]
+        ms_inline = time_func(count_inline, texts, num_rounds)
+        ms_threads = time_func(count_in_threads, texts, num_rounds)
+        ms_batch = time_func(count_batch, texts, num_rounds)
+        print(
+            f"{num_texts:>6} {num_texts * num_chars:>10} {ms_inline:>8.2f}ms "
+            f"{ms_threads:>8.2f}ms {ms_batch:>8.2f}ms"
+        )
+        if ms_batch < ms_inline and min_chars_batch_faster is None:
+            min_chars_batch_faster = num_texts * num_chars
+        elif ms_batch >= ms_inline:
+            min_chars_batch_faster = None
+
+    print(f"Batch encoding is consistently faster from {min_chars_batch_faster} chars")
+
+
+if __name__ == "__main__":
+    main()
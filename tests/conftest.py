@@ -0,0 +1,15 @@
+import os
+import sys
+import tempfile
+
+# NOTE: the app expects to be run from the repo root (e.g. for config/logging.json)
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(REPO_ROOT)
+sys.path.insert(0, REPO_ROOT)
+
+# Allow importing the app's modules without real API keys or a vector database
+os.environ.setdefault("IGNORE_LACK_OF_SERPER_API_KEY", "1")
+os.environ.setdefault("DEFAULT_OPENAI_API_KEY", "sk-test")
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+if not os.getenv("USE_CHROMA_VIA_HTTP"):
+    os.environ.setdefault("VECTORDB_DIR", tempfile.mkdtemp(prefix="ddg-test-vdb-"))
@@ -0,0 +1,42 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock
+
+import components.chat_with_docs_chain
+from components.chat_with_docs_chain import _discard_speculative_retrieval
+
+
+def test_discarded_running_retrieval_error_is_logged(monkeypatch):
+    logger = Mock()
+    monkeypatch.setattr(components.chat_with_docs_chain, "logger", logger)
+    can_fail = threading.Event()
+
+    def retrieve():
+        can_fail.wait()
+        raise ValueError("retrieval failed")
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(retrieve)
+        _discard_speculative_retrieval(future)  # too late to cancel
+        can_fail.set()
+
+    logger.warning.assert_called_once()
+    assert "retrieval failed" in logger.warning.call_args.args[0]
+
+
+def test_discarded_retrieval_task_is_cancelled(monkeypatch):
+    logger = Mock()
+    monkeypatch.setattr(components.chat_with_docs_chain, "logger", logger)
+
+    async def main():
+        task = asyncio.ensure_future(asyncio.sleep(10))
+        await asyncio.sleep(0)
+        _discard_speculative_retrieval(task)
+        await asyncio.sleep(0)
+        return task
+
+    task = asyncio.run(main())
+
+    assert task.cancelled()
+    logger.warning.assert_not_called()
@@ -0,0 +1,16 @@
+from langchain_core.documents import Document
+
+from components.chroma_ddg_retriever import ChromaDDGRetriever
+
+
+def test_pare_down_returns_similarities():
+    retriever = ChromaDDGRetriever.construct(verbose=False)
+    docs_and_similarities = [
+        (Document(page_content=f"doc {i}"), 0.9 - i * 0.05) for i in range(12)
+    ]
+
+    chunks, similarities = retriever._pare_down(docs_and_similarities)
+
+    assert len(chunks) == retriever.k_max
+    assert [doc.page_content for doc in chunks] == [f"doc {i}" for i in range(10)]
+    assert similarities == [sim for _, sim in docs_and_similarities[:10]]
@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+import utils.domain_stats
+from utils.domain_stats import (
+    DomainStatsRegistry,
+    categorize_fetch_error,
+    get_domain_stats_registry,
+)
+
+URL = "https://www.example.com/page"
+
+
+@pytest.mark.parametrize(
+    "error, category",
+    [
+        ("UNACCEPTABLE_EXTRACTED_TEXT", "bad_content"),
+        ("Error: ClientResponseError: 403, message='Forbidden', url=...", "blocked"),
+        ("Error: ClientResponseError: 404, message='Not Found', url=...", "not_found"),
+        ("Error: TimeoutError: ", "timeout"),
+        ("Error: ServerDisconnectedError: Server disconnected", "connection_error"),
+        ("Error: net::ERR_NAME_NOT_RESOLVED at https://example.com", "dns_error"),
+        ("Error: NameError: name 'foo' is not defined", None),
+        ("Error: KeyError: 'foo'", None),
+    ],
+)
+def test_categorize_fetch_error(error, category):
+    assert categorize_fetch_error(error) == category
+
+
+def test_errors_from_our_code_are_not_recorded():
+    registry = DomainStatsRegistry()
+    registry.record_fetch(URL, "Error: NameError: name 'foo' is not defined", 0.1)
+
+    assert registry.stats_by_domain == {}
+    assert registry.total_stats.num_failed == 0
+
+
+def test_fetch_failures_are_recorded():
+    registry = DomainStatsRegistry()
+    registry.record_fetch(URL, None, 0.1)
+    registry.record_fetch(URL, "Error: TimeoutError: ", 0.2)
+
+    stats = registry.stats_by_domain["example.com"]
+    assert stats.num_ok == 1
+    assert stats.failures_by_category == {"timeout": 1}
+
+
+def test_domain_stats_registry_with_default_path(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(utils.domain_stats, "_domain_stats_registry", None)
+    monkeypatch.setattr(
+        utils.domain_stats, "DOMAIN_HEALTH_DB_PATH", "domain-health.sqlite3"
+    )
+    registry = get_domain_stats_registry()
+    registry.record_fetch(URL, None, 0.1)
+
+    assert os.path.isfile(tmp_path / "domain-health.sqlite3")
+    assert DomainStatsRegistry("domain-health.sqlite3").stats_by_domain.keys() == {
+        "example.com"
+    }
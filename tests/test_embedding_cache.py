@@ -0,0 +1,46 @@
+import os
+
+import pytest
+
+import utils.embedding_cache
+from components.openai_embeddings_ddg import CachedEmbeddings, _get_openai_embeddings
+from utils.embedding_cache import EmbeddingCache, get_embedding_cache
+
+
+@pytest.fixture
+def fresh_embedding_cache(monkeypatch):
+    """Make get_embedding_cache open a new cache (at the default path)."""
+    monkeypatch.setattr(utils.embedding_cache, "_embedding_cache", None)
+    monkeypatch.setattr(utils.embedding_cache, "_is_embedding_cache_unavailable", False)
+    monkeypatch.setattr(
+        utils.embedding_cache, "EMBEDDING_CACHE_DB_PATH", "embedding-cache.sqlite3"
+    )
+    _get_openai_embeddings.cache_clear()
+    yield
+    if utils.embedding_cache._embedding_cache is not None:
+        utils.embedding_cache._embedding_cache.db.close()
+    _get_openai_embeddings.cache_clear()
+
+
+def test_embedding_cache_with_default_path(
+    tmp_path, monkeypatch, fresh_embedding_cache
+):
+    monkeypatch.chdir(tmp_path)
+    cache = get_embedding_cache()
+
+    assert isinstance(cache, EmbeddingCache)
+    assert os.path.isfile(tmp_path / "embedding-cache.sqlite3")
+    cache.put_many("model", 2, ["hello"], [[0.5, 0.25]])
+    assert cache.get_many("model", 2, ["hello", "bye"]) == [[0.5, 0.25], None]
+    assert isinstance(_get_openai_embeddings("sk-test", "model", 2), CachedEmbeddings)
+
+
+def test_embeddings_uncached_if_cache_cant_be_opened(
+    tmp_path, monkeypatch, fresh_embedding_cache
+):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir(tmp_path / "embedding-cache.sqlite3")  # can't be opened as a database
+
+    assert get_embedding_cache() is None
+    embeddings = _get_openai_embeddings("sk-test", "model", 2)
+    assert not isinstance(embeddings, CachedEmbeddings)
@@ -0,0 +1,40 @@
+import pytest
+import tiktoken
+
+import utils.lang_utils
+from utils.lang_utils import limit_tokens_in_text
+
+
+@pytest.fixture
+def byte_encoding(monkeypatch) -> tiktoken.Encoding:
+    """A tiny byte-level encoding (one token per byte, plus a few merges)."""
+    ranks = {bytes([i]): i for i in range(256)}
+    for i, merge in enumerate(["th", "he", "the", " the"]):
+        ranks[merge.encode()] = 256 + i
+    encoding = tiktoken.Encoding(
+        "test-bytes",
+        pat_str=r""" ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+""",
+        mergeable_ranks=ranks,
+        special_tokens={},
+    )
+    monkeypatch.setattr(utils.lang_utils, "get_tiktoken_encoding", lambda *_: encoding)
+    return encoding
+
+
+def test_text_within_limit_is_unchanged(byte_encoding):
+    assert limit_tokens_in_text("the end", 100) == ("the end", 5)
+
+
+def test_text_is_cut_at_token_boundary(byte_encoding):
+    text, num_tokens = limit_tokens_in_text("the theme", 3)
+
+    assert text == "the them"  # "the", " the", "m"
+    assert num_tokens == len(byte_encoding.encode_ordinary(text)) == 3
+
+
+def test_partial_character_is_dropped_and_not_counted(byte_encoding):
+    # Each of these characters is 3 bytes, i.e. 3 tokens
+    text, num_tokens = limit_tokens_in_text("東京", 4)
+
+    assert text == "東"
+    assert num_tokens == len(byte_encoding.encode_ordinary(text)) == 3
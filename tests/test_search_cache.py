@@ -0,0 +1,37 @@
+import os
+
+import pytest
+
+import utils.search_cache
+from utils.search_cache import SearchResultsCache, get_search_cache
+
+
+@pytest.fixture
+def fresh_search_cache(tmp_path, monkeypatch):
+    """Make get_search_cache open a new cache at the default path, in tmp_path."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(utils.search_cache, "_search_cache", None)
+    monkeypatch.setattr(utils.search_cache, "_is_search_cache_unavailable", False)
+    monkeypatch.setattr(
+        utils.search_cache, "SEARCH_CACHE_DB_PATH", "search-cache.sqlite3"
+    )
+    yield
+    if utils.search_cache._search_cache is not None:
+        utils.search_cache._search_cache.db.close()
+
+
+def test_search_cache_with_default_path(tmp_path, fresh_search_cache):
+    cache = get_search_cache()
+
+    assert isinstance(cache, SearchResultsCache)
+    assert os.path.isfile(tmp_path / "search-cache.sqlite3")
+    cache.put("Some  Query", 10, {"organic": []})
+    assert cache.get("some query", 10) == {"organic": []}
+    assert cache.get("some query", 5) is None
+    assert cache.get_stats() == {"hits": 1, "misses": 1}
+
+
+def test_no_search_cache_if_it_cant_be_opened(tmp_path, fresh_search_cache):
+    os.mkdir(tmp_path / "search-cache.sqlite3")  # can't be opened as a database
+
+    assert get_search_cache() is None
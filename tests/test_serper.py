@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+
+from utils.serper import SerperClient
+
+
+def make_client(monkeypatch, batch_response) -> tuple[SerperClient, list]:
+    """
+    Return a client whose requests go to a fake endpoint, and the list of payloads
+    it receives. Batches get batch_response (raised if it's an exception), single
+    queries get a result with their query.
+    """
+    payloads = []
+
+    async def apost(payload):
+        payloads.append(payload)
+        if not isinstance(payload, list):
+            return 200, {"searchParameters": {"q": payload["q"]}, "organic": []}
+        if isinstance(batch_response, Exception):
+            raise batch_response
+        return batch_response
+
+    client = SerperClient(api_key="test")
+    monkeypatch.setattr(client, "_apost", apost)
+    return client, payloads
+
+
+def test_batch_results_are_returned(monkeypatch):
+    results = [{"organic": [1]}, {"organic": [2]}]
+    client, payloads = make_client(monkeypatch, (200, results))
+
+    assert asyncio.run(client.asearch(["q1", "q2"])) == results
+    assert len(payloads) == 1
+
+
+@pytest.mark.parametrize(
+    "batch_response",
+    [
+        (400, {"message": "Batch not supported"}),
+        (200, {"message": "Not a list"}),
+        (200, [{"organic": []}]),  # not one result per query
+        (200, None),  # not JSON
+    ],
+)
+def test_rejected_or_malformed_batch_falls_back(monkeypatch, batch_response):
+    client, payloads = make_client(monkeypatch, batch_response)
+
+    results = asyncio.run(client.asearch(["q1", "q2"]))
+
+    assert [r["searchParameters"]["q"] for r in results] == ["q1", "q2"]
+    assert len(payloads) == 3
+
+
+def test_batch_timeout_is_not_resent_per_query(monkeypatch):
+    client, payloads = make_client(monkeypatch, asyncio.TimeoutError())
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(client.asearch(["q1", "q2"]))
+    assert len(payloads) == 1
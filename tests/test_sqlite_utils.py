@@ -0,0 +1,20 @@
+import os
+
+from utils.sqlite_utils import SQLiteDB
+
+
+def test_sqlite_db_with_bare_filename(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    db = SQLiteDB("test.sqlite3", "CREATE TABLE t (x INTEGER);")
+    db.execute("INSERT INTO t VALUES (?)", (1,))
+
+    assert db.execute("SELECT x FROM t") == [(1,)]
+    db.close()
+
+
+def test_sqlite_db_creates_parent_dirs(tmp_path):
+    path = os.path.join(tmp_path, "a", "b", "test.sqlite3")
+    db = SQLiteDB(path, "CREATE TABLE t (x INTEGER);")
+
+    assert db.execute("SELECT COUNT(*) FROM t") == [(0,)]
+    db.close()
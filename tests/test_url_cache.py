@@ -0,0 +1,98 @@
+import pytest
+
+import utils.url_cache
+from utils.url_cache import URLCache, get_url_cache, normalize_url
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self) -> float:
+        self.now += 1  # so that every access has its own timestamp
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(utils.url_cache, "time", clock)
+    return clock
+
+
+def test_normalize_url():
+    assert (
+        normalize_url("HTTPS://Example.com:443/a?b=2&a=1#frag")
+        == "https://example.com/a?a=1&b=2"
+    )
+
+
+def test_get_and_put(tmp_path, clock):
+    cache = URLCache(str(tmp_path), ttl_s=60, max_bytes=10**6)
+    assert cache.get("https://example.com/a", "aiohttp") is None
+
+    cache.put("https://example.com/a", "aiohttp", "content", etag='"v1"')
+    cached = cache.get("https://EXAMPLE.com/a#frag", "aiohttp")
+
+    assert cached.content == "content"
+    assert cached.etag == '"v1"'
+    assert cached.is_fresh
+    assert cache.get("https://example.com/a", "playwright") is None  # other namespace
+    assert cache.get_stats()["hits"] == 1
+
+
+def test_stale_entry_is_revalidated(tmp_path, clock):
+    cache = URLCache(str(tmp_path), ttl_s=60, max_bytes=10**6)
+    cache.put(
+        "https://example.com",
+        "aiohttp",
+        "content",
+        etag='"v1"',
+        last_modified="Wed, 21 Oct 2015 07:28:00 GMT",
+    )
+    clock.now += 120
+
+    stale = cache.get("https://example.com", "aiohttp")
+    assert not stale.is_fresh
+    assert stale.etag == '"v1"'
+    assert stale.last_modified == "Wed, 21 Oct 2015 07:28:00 GMT"
+
+    cache.mark_revalidated("https://example.com", "aiohttp")
+    assert cache.get("https://example.com", "aiohttp").is_fresh
+    stats = cache.get_stats()
+    assert (stats["stale"], stats["revalidated"], stats["hits"]) == (1, 1, 1)
+
+
+def test_identical_content_is_stored_once(tmp_path, clock):
+    cache = URLCache(str(tmp_path), ttl_s=60, max_bytes=10**6)
+    cache.put("https://a.com", "aiohttp", "same")
+    cache.put("https://b.com", "aiohttp", "same")
+
+    assert cache.total_bytes == len("same")
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, clock):
+    cache = URLCache(str(tmp_path), ttl_s=60, max_bytes=25)
+    cache.put("https://a.com", "aiohttp", "a" * 10)
+    cache.put("https://b.com", "aiohttp", "b" * 10)
+    cache.get("https://a.com", "aiohttp")  # a is now more recently used than b
+
+    cache.put("https://c.com", "aiohttp", "c" * 10)
+
+    assert cache.get("https://b.com", "aiohttp") is None
+    assert cache.get("https://a.com", "aiohttp").content == "a" * 10
+    assert cache.get("https://c.com", "aiohttp").content == "c" * 10
+    assert cache.total_bytes == 20
+    assert cache.get_stats()["evictions"] == 1
+    blob_paths = [path for path in (tmp_path / "blobs").rglob("*") if path.is_file()]
+    assert len(blob_paths) == 2
+
+
+def test_no_url_cache_if_it_cant_be_opened(tmp_path, monkeypatch):
+    (tmp_path / "url-cache").write_text("")  # a file where the dir should be
+    monkeypatch.setattr(utils.url_cache, "_url_cache", None)
+    monkeypatch.setattr(utils.url_cache, "_is_url_cache_unavailable", False)
+    monkeypatch.setattr(utils.url_cache, "URL_CACHE_DIR", str(tmp_path / "url-cache"))
+
+    assert get_url_cache() is None
+    assert get_url_cache() is None  # and it isn't retried
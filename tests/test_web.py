@@ -0,0 +1,118 @@
+import asyncio
+import os
+import threading
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+import utils.url_cache
+import utils.web
+from utils.async_utils import discard_process_pool
+from utils.url_cache import URLCache
+from utils.web import _arun_in_extraction_pool, afetch_url_aiohttp
+
+
+class FakeResponse:
+    def __init__(self, text: str, status: int = 200, headers: dict | None = None):
+        self.status = status
+        self.headers = {"Content-Type": "text/html"} | (headers or {})
+        self._text = text
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    async def text(self):
+        return self._text
+
+
+class FakeSession:
+    def __init__(self, text: str, status: int = 200, headers: dict | None = None):
+        self.text = text
+        self.status = status
+        self.headers = headers
+        self.requests = []
+
+    def get(self, url, headers=None):
+        self.requests.append((url, headers))
+        return FakeResponse(self.text, self.status, self.headers)
+
+
+def test_afetch_url_aiohttp_returns_text(monkeypatch):
+    monkeypatch.setattr(utils.web, "get_url_cache", lambda: None)
+    session = FakeSession("<html><body>Hello</body></html>")
+
+    content = asyncio.run(afetch_url_aiohttp(session, "https://example.com"))
+
+    assert content == "<html><body>Hello</body></html>"
+    [(url, headers)] = session.requests
+    assert url == "https://example.com"
+    assert headers["User-Agent"]
+
+
+def test_afetch_url_aiohttp_revalidates_stale_cached_content(tmp_path, monkeypatch):
+    url_cache = URLCache(str(tmp_path), ttl_s=60, max_bytes=10**6)
+    monkeypatch.setattr(utils.web, "get_url_cache", lambda: url_cache)
+    url_cache.put("https://example.com", "aiohttp", "old", etag='"v1"')
+    now = utils.url_cache.time.time()
+    monkeypatch.setattr(utils.url_cache.time, "time", lambda: now + 120)  # stale
+
+    session = FakeSession("", status=304)
+    content = asyncio.run(afetch_url_aiohttp(session, "https://example.com"))
+
+    assert content == "old"
+    [(_, headers)] = session.requests
+    assert headers["If-None-Match"] == '"v1"'
+    assert url_cache.get("https://example.com", "aiohttp").is_fresh
+    assert url_cache.get_stats()["revalidated"] == 1
+
+
+def _die_on_first_call(marker_path: str) -> str:
+    # Runs in a worker process: kill the worker unless it was already killed once
+    if not os.path.exists(marker_path):
+        open(marker_path, "w").close()
+        os._exit(1)
+    return "extracted"
+
+
+def _always_die() -> str:
+    os._exit(1)
+
+
+@pytest.fixture
+def extraction_pool(monkeypatch):
+    monkeypatch.setattr(utils.web, "TEXT_EXTRACTION_WORKERS", 1)
+    monkeypatch.setattr(utils.web, "TEXT_EXTRACTION_POOL_NAME", "test-extraction")
+    yield
+    discard_process_pool("test-extraction")
+
+
+def test_extraction_is_retried_in_a_new_pool(tmp_path, extraction_pool):
+    marker_path = str(tmp_path / "killed-once")
+    result = asyncio.run(_arun_in_extraction_pool(_die_on_first_call, marker_path))
+
+    assert result == "extracted"
+
+
+def test_extraction_fails_if_the_new_pool_breaks_too(extraction_pool):
+    with pytest.raises(BrokenProcessPool):
+        asyncio.run(_arun_in_extraction_pool(_always_die))
+
+    # The broken pool was discarded, so the next extraction works
+    assert asyncio.run(_arun_in_extraction_pool(str.upper, "ok")) == "OK"
+
+
+def test_extraction_without_workers_runs_off_the_event_loop(monkeypatch):
+    monkeypatch.setattr(utils.web, "TEXT_EXTRACTION_WORKERS", 0)
+
+    async def main():
+        extraction_thread_id = await _arun_in_extraction_pool(threading.get_ident)
+        return extraction_thread_id, threading.get_ident()
+
+    extraction_thread_id, loop_thread_id = asyncio.run(main())
+    assert extraction_thread_id != loop_thread_id
@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+
+import agentblocks.webretrieve
+from agentblocks.webretrieve import aget_content_from_urls
+from utils.domain_stats import DomainStatsRegistry
+from utils.web import LinkData
+
+
+@pytest.fixture
+def fetch_delays(monkeypatch):
+    """
+    Fake fetching: each url's LinkData arrives after the url's delay (in seconds).
+    Return the dict of delays (to fill in) and the list of cancelled urls.
+    """
+    delays: dict[str, float] = {}
+    cancelled: list[str] = []
+
+    async def afetch_link_data(url: str) -> LinkData:
+        try:
+            await asyncio.sleep(delays[url])
+        except asyncio.CancelledError:
+            cancelled.append(url)
+            raise
+        return LinkData(text=f"text of {url}")
+
+    monkeypatch.setattr(agentblocks.webretrieve, "afetch_link_data", afetch_link_data)
+    monkeypatch.setattr(
+        agentblocks.webretrieve, "get_domain_stats_registry", DomainStatsRegistry
+    )
+    monkeypatch.setattr(agentblocks.webretrieve, "get_url_cache", lambda: None)
+    monkeypatch.setattr(agentblocks.webretrieve, "get_search_cache", lambda: None)
+    return delays, cancelled
+
+
+def test_early_stop_leaves_cancelled_urls_for_later(fetch_delays):
+    delays, cancelled = fetch_delays
+    delays |= {"https://a.com": 0, "https://b.com": 0, "https://c.com": 10}
+    urls = list(delays)
+
+    res = asyncio.run(aget_content_from_urls(urls, min_ok_urls=2, init_batch_size=3))
+
+    assert list(res.link_data_dict) == ["https://a.com", "https://b.com"]
+    assert res.num_ok_urls == 2
+    assert res.idx_first_not_tried == 2  # c.com will be fetched in a later round
+    assert cancelled == ["https://c.com"]
+
+
+def test_early_stop_waits_for_slow_url_before_fetched_ones(fetch_delays):
+    delays, cancelled = fetch_delays
+    delays |= {
+        "https://slow.com": 0.2,
+        "https://a.com": 0,
+        "https://b.com": 0,
+        "https://never.com": 10,
+    }
+    urls = list(delays)
+
+    res = asyncio.run(aget_content_from_urls(urls, min_ok_urls=2, init_batch_size=4))
+
+    assert list(res.link_data_dict) == [
+        "https://slow.com",
+        "https://a.com",
+        "https://b.com",
+    ]
+    assert not any(link_data.error for link_data in res.link_data_dict.values())
+    assert res.num_ok_urls == 3
+    assert res.idx_first_not_tried == 3
+    assert cancelled == ["https://never.com"]
@@ -1,4 +1,6 @@
 import asyncio
+import atexit
+import threading
 from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 # NOTE: consider using async_to_sync from asgiref.sync library
@@ -52,6 +54,124 @@ def gather_tasks_sync(tasks):
     return run_task_sync(coroutine_from_tasks())
 
 
+class SharedEventLoop:
+    """
+    An event loop that runs forever in a daemon thread and is shared by the whole
+    process. Unlike run_task_sync, which creates a new thread and event loop for every
+    call, it lets loop-bound resources (such as an aiohttp session with its pool of
+    keep-alive connections) be reused across calls.
+    """
+
+    def __init__(self, name: str = "ddg-shared-loop"):
+        self.name = name
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """The underlying event loop (started on first access)."""
+        with self._lock:
+            if self._loop is None or self._loop.is_closed():
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(
+                    target=self._loop.run_forever, name=self.name, daemon=True
+                )
+                self._thread.start()
+            return self._loop
+
+    def is_current(self) -> bool:
+        """Return True if called from within the shared loop's thread."""
+        return self._thread is not None and threading.current_thread() is self._thread
+
+    def submit(self, task):
+        """
+        Schedule a coroutine object on the shared loop and return a
+        concurrent.futures.Future for its result.
+        """
+        return asyncio.run_coroutine_threadsafe(task, self.loop)
+
+    def run(self, task):
+        """
+        Run a coroutine object on the shared loop and wait for its result.
+        """
+        if self.is_current():
+            # Waiting for the result here would block the very loop that runs the task
+            task.close()
+            raise RuntimeError("Can't wait for a task from within the shared loop.")
+        return self.submit(task).result()
+
+    def stop(self):
+        with self._lock:
+            if self._loop is None or self._loop.is_closed():
+                return
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            if self._thread is not None:
+                self._thread.join(timeout=5)
+
+
+shared_loop = SharedEventLoop()
+atexit.register(shared_loop.stop)
+
+
+def run_task_in_shared_loop(task):
+    """
+    Run an asyncio task (a coroutine object) synchronously on the process-wide
+    shared event loop (see SharedEventLoop).
+    """
+    return shared_loop.run(task)
+
+
+def make_sync_in_shared_loop(async_func):
+    """
+    Make an asynchronous function synchronous, running it on the shared event loop.
+    """
+
+    def wrapper(*args, **kwargs):
+        return run_task_in_shared_loop(async_func(*args, **kwargs))
+
+    return wrapper
+
+
+_process_pools: dict[str, ProcessPoolExecutor] = {}
+_process_pools_lock = threading.Lock()
+
+
+def get_process_pool(name: str, max_workers: int) -> ProcessPoolExecutor:
+    """
+    Return the persistent process pool with the given name, creating it if needed.
+    Unlike execute_func_map_in_processes, the worker processes are reused across
+    calls, so the cost of starting them is paid only once.
+    """
+    with _process_pools_lock:
+        if (pool := _process_pools.get(name)) is None:
+            pool = _process_pools[name] = ProcessPoolExecutor(max_workers=max_workers)
+        return pool
+
+
+def discard_process_pool(name: str, pool: ProcessPoolExecutor | None = None):
+    """
+    Shut down the process pool with the given name (e.g. if it's broken because
+    a worker died), so that the next call to get_process_pool creates a new one.
+    If pool is given, the pool is only discarded if it's still the one with this
+    name (i.e. it hasn't already been replaced by another caller).
+    """
+    with _process_pools_lock:
+        if pool is not None and _process_pools.get(name) is not pool:
+            return
+        pool = _process_pools.pop(name, None)
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _shut_down_process_pools():
+    for name in list(_process_pools):
+        discard_process_pool(name)
+
+
+atexit.register(_shut_down_process_pools)
+
+
 def execute_func_map_in_processes(func, inputs, max_workers=None):
     """
     Execute a function on a list of inputs in a separate process for each input.
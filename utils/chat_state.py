@@ -4,7 +4,16 @@ from typing import Callable
 from chromadb import Collection
 from pydantic import BaseModel, Field
 
-from agents.researcher_data import ResearchReportData
+from agents.research_heatseek_data import (
+    HeatseekData,
+    load_hs_data_records,
+    save_hs_data_records,
+)
+from agents.researcher_data import (
+    ResearchReportData,
+    load_rr_data_records,
+    save_rr_data_records,
+)
 from components.chroma_ddg import (
     ChromaDDG,
     CollectionDoesNotExist,
@@ -233,26 +242,66 @@ class ChatState:
         self, use_cached_metadata: bool = False
     ) -> ResearchReportData | None:
         """
-        Extract ResearchReportData from the currently selected collection's metadata
+        Load ResearchReportData from the currently selected collection's state records.
+        If the collection has it in its metadata instead (the way it used to be
+        stored), migrate it to state records.
         """
         logger.info("Getting rr_data")
+        rr_data = load_rr_data_records(self.vectorstore.collection)
+        if rr_data is not None:
+            logger.info("rr_data retrieved.")
+            return rr_data
+
         coll_metadata = self.get_collection_metadata(use_cached_metadata)
         try:
             rr_data_json = coll_metadata["rr_data"]
         except (TypeError, KeyError):
             logger.info("No rr_data found")
             return None
-        logger.info("rr_data retrieved.")
-        return ResearchReportData.model_validate_json(rr_data_json)
+        logger.info("Migrating rr_data from the collection metadata to state records")
+        rr_data = ResearchReportData.model_validate_json(rr_data_json)
+        self.save_rr_data(rr_data, use_cached_metadata=True)
+        return rr_data
 
     def save_rr_data(
         self, rr_data: ResearchReportData, use_cached_metadata: bool = False
     ) -> None:
         """
-        Update the currently selected collection's metadata with the given ResearchReportData
+        Save the changes to the given ResearchReportData in the currently selected
+        collection's state records and update the collection's "updated_at" field.
         """
+        save_rr_data_records(self.vectorstore.collection, rr_data)
         coll_metadata = self.get_collection_metadata(use_cached_metadata) or {}
-        coll_metadata["rr_data"] = rr_data.model_dump_json()
+        coll_metadata.pop("rr_data", None)  # where it used to be stored
+        self.save_collection_metadata(coll_metadata)
+
+    def get_hs_data(self, use_cached_metadata: bool = False) -> HeatseekData | None:
+        """
+        Load HeatseekData from the currently selected collection's state records.
+        If the collection has it in its agent data instead (the way it used to be
+        stored), migrate it to state records.
+        """
+        hs_data = load_hs_data_records(self.vectorstore.collection)
+        if hs_data is not None:
+            return hs_data
+
+        if not (hs_data_json := self.get_agent_data(use_cached_metadata).get("hs")):
+            return None
+        logger.info("Migrating hs_data from the agent data to state records")
+        hs_data = HeatseekData.model_validate_json(hs_data_json)
+        self.save_hs_data(hs_data, use_cached_metadata=True)
+        return hs_data
+
+    def save_hs_data(
+        self, hs_data: HeatseekData, use_cached_metadata: bool = False
+    ) -> None:
+        """
+        Save the changes to the given HeatseekData in the currently selected
+        collection's state records and update the collection's "updated_at" field.
+        """
+        save_hs_data_records(self.vectorstore.collection, hs_data)
+        coll_metadata = self.get_collection_metadata(use_cached_metadata) or {}
+        coll_metadata.pop("agent_data", None)  # where it used to be stored
         self.save_collection_metadata(coll_metadata)
 
     def get_collection_permissions(
@@ -416,3 +465,6 @@ class ChatState:
 
     def get_llm_reply(self, prompt, inputs, *, to_user: bool):
         return self.get_prompt_llm_chain(prompt, to_user=to_user).invoke(inputs)
+
+    async def aget_llm_reply(self, prompt, inputs, *, to_user: bool):
+        return await self.get_prompt_llm_chain(prompt, to_user=to_user).ainvoke(inputs)
@@ -8,6 +8,7 @@ from langchain_community.document_loaders import GitbookLoader
 
 from components.chroma_ddg import ChromaDDG
 from components.openai_embeddings_ddg import get_openai_embeddings
+from utils.lang_utils import add_chunk_num_tokens
 from utils.prepare import EMBEDDINGS_DIMENSIONS, get_logger
 from utils.rag import rag_text_splitter
 from langchain_core.documents import Document
@@ -68,6 +69,9 @@ def prepare_chunks(
     snippets = rag_text_splitter.create_documents(texts, metadatas)
     logger.info(f"Obtained {len(snippets)} chunks.")
 
+    # Store the chunks' token counts, so they are not recounted on every retrieval
+    add_chunk_num_tokens(snippets)
+
     # Restore original metadata
     for metadata in metadatas:
         del metadata["parent_id"]
@@ -87,11 +91,15 @@ def ingest_into_chroma(
     chroma_client: ClientAPI | None = None,
     save_dir: str | None = None,
     collection_metadata: dict[str, str] | None = None,
+    ids: list[str] | None = None,
 ) -> ChromaDDG:
     """
     Load documents and/or collection metadata into a Chroma collection, return a vectorstore
     object.
 
+    The full documents are stored with the given ids (random ones if ids is None), so that
+    the caller can refer to them later. Their chunks get the id in the "parent_id" field.
+
     If collection_metadata is passed and the collection exists, the metadata will be
     replaced with the passed metadata, according to the Chroma docs.
 
@@ -112,7 +120,8 @@ def ingest_into_chroma(
         )
 
     # Prepare full texts, metadatas and ids
-    full_doc_ids = [str(uuid.uuid4()) for _ in range(len(docs))]
+    full_doc_ids = ids or [str(uuid.uuid4()) for _ in range(len(docs))]
+    assert len(full_doc_ids) == len(docs), "Number of ids must match number of docs"
     texts = [doc.page_content for doc in docs]
     metadatas = [doc.metadata for doc in docs]
 
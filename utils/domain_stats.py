@@ -0,0 +1,338 @@
+import json
+import math
+import os
+import re
+import threading
+import time
+
+from pydantic import BaseModel, Field
+
+from utils.output import format_exception
+from utils.prepare import get_logger
+from utils.sqlite_utils import SQLiteDB
+
+logger = get_logger()
+
+# Set DOMAIN_HEALTH_DB_PATH to an empty string to keep the stats in memory only
+DOMAIN_HEALTH_DB_PATH = os.getenv("DOMAIN_HEALTH_DB_PATH", "domain-health.sqlite3")
+# Old outcomes fade with this half-life, so that domains can recover
+DOMAIN_HEALTH_HALF_LIFE_S = 7 * 24 * 60 * 60
+
+# Prior for a domain's success rate: as if we had seen this many fetches from the
+# domain, with the success rate of all domains so far
+PRIOR_STRENGTH = 2
+INIT_GLOBAL_SUCCESS_RATE = 0.5  # before we have seen any fetches
+LATENCY_EWMA_ALPHA = 0.3  # weight of the newest latency in the moving average
+
+# A domain is skipped if its success rate is this low after this many failures
+MAX_SUCCESS_RATE_TO_SKIP_DOMAIN = 0.1
+MIN_FAILURES_TO_SKIP_DOMAIN = 5
+
+# A domain's links are moved to the end of search results if its success rate is
+# this low after this many failures
+MAX_SUCCESS_RATE_TO_DEPRIORITIZE_DOMAIN = 0.3
+MIN_FAILURES_TO_DEPRIORITIZE_DOMAIN = 3
+
+# How much a failure of each category counts against a domain: some failures say
+# more about the domain (e.g. it blocks us) than others (e.g. a missing page)
+FAILURE_WEIGHTS = {
+    "blocked": 1.0,
+    "bad_content": 1.0,
+    "dns_error": 1.0,
+    "timeout": 0.5,
+    "server_error": 0.5,
+    "connection_error": 0.5,
+    "not_found": 0.25,
+    "other": 1.0,
+}
+
+# Start of the error for a PDF that is too large to download (see utils.web)
+PDF_TOO_LARGE_ERROR = "Error: PDF is larger than"
+
+TOTAL_STATS_KEY = "*"  # key under which the stats for all domains are persisted
+
+DOMAIN_HEALTH_SCHEMA = """
+CREATE TABLE IF NOT EXISTS domain_health (
+    domain TEXT PRIMARY KEY,
+    num_ok REAL NOT NULL,
+    num_failed REAL NOT NULL,
+    latency_ewma_s REAL,
+    failures_by_category TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+def extract_domain(url: str):
+    try:
+        full_domain = url.split("://")[-1].split("/")[0]  # blah.blah.domain.com
+        return ".".join(full_domain.split(".")[-2:])  # domain.com
+    except Exception:
+        return ""
+
+
+def categorize_fetch_error(error: str) -> str | None:
+    """
+    Return the category of the error of a LinkData (see FAILURE_WEIGHTS), or None
+    if the error isn't an HTTP or content failure (e.g. it's an exception raised by
+    our own code), in which case it says nothing about the domain.
+    """
+    if error == "UNACCEPTABLE_EXTRACTED_TEXT" or error.startswith(PDF_TOO_LARGE_ERROR):
+        return "bad_content"
+    # ClientResponseError and its subclasses (e.g. TooManyRedirects)
+    if match := re.search(r"^Error: \w+: (\d{3}), message=", error):
+        status = int(match.group(1))
+        if status in (401, 403, 407, 451):
+            return "blocked"
+        if status in (404, 410):
+            return "not_found"
+        if status == 429 or status >= 500:
+            return "server_error"
+        return "other"
+    error = error.lower()
+    if "timeout" in error or "timed out" in error:
+        return "timeout"
+    if "name or service not known" in error or "err_name_not_resolved" in error:
+        return "dns_error"
+    # Other aiohttp errors (e.g. ClientConnectorError) and Playwright's net::ERR_*
+    if re.search(r"^error: (client|server)\w*error:", error) or "net::err_" in error:
+        return "connection_error"
+    if re.search(r"^error: pdf\w*error:", error):  # pypdf couldn't read the PDF
+        return "bad_content"
+    return None
+
+
+class DomainStats(BaseModel):
+    num_ok: float = 0  # floats because of time decay and failure weights
+    num_failed: float = 0
+    latency_ewma_s: float | None = None  # moving average of the fetch time
+    failures_by_category: dict[str, float] = Field(default_factory=dict)
+    updated_at: float = Field(default_factory=time.time)
+
+    def decay(self, now: float) -> None:
+        """Make older outcomes count less (see DOMAIN_HEALTH_HALF_LIFE_S)."""
+        if now - self.updated_at < 60:
+            return  # not worth it (and keeps counts whole in quick succession)
+        factor = 0.5 ** ((now - self.updated_at) / DOMAIN_HEALTH_HALF_LIFE_S)
+        self.num_ok *= factor
+        self.num_failed *= factor
+        for category in self.failures_by_category:
+            self.failures_by_category[category] *= factor
+        self.updated_at = now
+
+
+class DomainStatsRegistry:
+    """
+    Thread-safe registry of per-domain fetch outcomes: how often fetching a URL
+    from a domain gives usable content, how it fails, and how long it typically
+    takes. If db_path is given, the stats are persisted in a SQLite database, so
+    that they carry over between sessions (they are loaded on creation and
+    written through on every update).
+    """
+
+    def __init__(self, db_path: str = ""):
+        self.lock = threading.Lock()
+        self.stats_by_domain: dict[str, DomainStats] = {}
+        self.total_stats = DomainStats()
+
+        self.db = SQLiteDB(db_path, DOMAIN_HEALTH_SCHEMA) if db_path else None
+        if self.db:
+            self._load()
+
+    def _load(self) -> None:
+        rows = self.db.execute(
+            "SELECT domain, num_ok, num_failed, latency_ewma_s, "
+            "failures_by_category, updated_at FROM domain_health"
+        )
+        now = time.time()
+        for domain, num_ok, num_failed, latency, failures, updated_at in rows:
+            stats = DomainStats(
+                num_ok=num_ok,
+                num_failed=num_failed,
+                latency_ewma_s=latency,
+                failures_by_category=json.loads(failures),
+                updated_at=updated_at,
+            )
+            stats.decay(now)
+            if domain == TOTAL_STATS_KEY:
+                self.total_stats = stats
+            else:
+                self.stats_by_domain[domain] = stats
+        logger.info(f"Loaded fetch stats for {len(self.stats_by_domain)} domains")
+
+    def _save(self, stats_by_key: dict[str, DomainStats]) -> None:
+        self.db.executemany(
+            "INSERT OR REPLACE INTO domain_health (domain, num_ok, num_failed, "
+            "latency_ewma_s, failures_by_category, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    key,
+                    stats.num_ok,
+                    stats.num_failed,
+                    stats.latency_ewma_s,
+                    json.dumps(stats.failures_by_category),
+                    stats.updated_at,
+                )
+                for key, stats in stats_by_key.items()
+            ],
+        )
+
+    def _record(
+        self, url: str, category: str | None, is_completed: bool, latency_s: float
+    ) -> None:
+        domain = extract_domain(url)
+        now = time.time()
+        with self.lock:
+            domain_stats = self.stats_by_domain.setdefault(domain, DomainStats())
+            for stats in (domain_stats, self.total_stats):
+                stats.decay(now)
+                if not is_completed:
+                    pass  # only the latency is known
+                elif category is None:
+                    stats.num_ok += 1
+                else:
+                    stats.num_failed += FAILURE_WEIGHTS[category]
+                    stats.failures_by_category[category] = (
+                        stats.failures_by_category.get(category, 0) + 1
+                    )
+                if stats.latency_ewma_s is None:
+                    stats.latency_ewma_s = latency_s
+                else:
+                    stats.latency_ewma_s += LATENCY_EWMA_ALPHA * (
+                        latency_s - stats.latency_ewma_s
+                    )
+            # Copy, so that we can save outside the lock
+            stats_to_save = {
+                domain: domain_stats.model_copy(deep=True),
+                TOTAL_STATS_KEY: self.total_stats.model_copy(deep=True),
+            }
+
+        if self.db:
+            try:
+                self._save(stats_to_save)
+            except Exception as e:
+                logger.warning(f"Could not save fetch stats for {domain}: {e}")
+
+    def record_fetch(self, url: str, error: str | None, latency_s: float) -> None:
+        """
+        Record the outcome of fetching a URL (error is the LinkData's error). Errors
+        that aren't HTTP or content failures (see categorize_fetch_error) aren't
+        recorded at all, since they don't come from the domain.
+        """
+        category = None
+        if error and (category := categorize_fetch_error(error)) is None:
+            logger.info(f"Not recording fetch outcome for {url}, error: {error}")
+            return
+        self._record(url, category, True, latency_s)
+
+    def record_cancelled_fetch(self, url: str, latency_s: float) -> None:
+        """
+        Record a fetch that was cancelled before it completed, with the time until
+        cancellation. That's a lower bound on the latency, but still worth recording,
+        otherwise domains that are too slow to ever complete would never seem slow.
+        """
+        self._record(url, None, False, latency_s)
+
+    def get_global_success_rate(self) -> float:
+        with self.lock:
+            stats = self.total_stats
+            num_tries = stats.num_ok + stats.num_failed
+            return (stats.num_ok + PRIOR_STRENGTH * INIT_GLOBAL_SUCCESS_RATE) / (
+                num_tries + PRIOR_STRENGTH
+            )
+
+    def get_success_rate(self, url: str) -> float:
+        """
+        Return the estimated probability that fetching the URL gives usable
+        content, based on the outcomes for its domain (shrunk towards the success
+        rate of all domains, so that a domain isn't judged on one or two fetches).
+        """
+        global_success_rate = self.get_global_success_rate()
+        with self.lock:
+            stats = self.stats_by_domain.get(extract_domain(url))
+            if stats is None:
+                return global_success_rate
+            num_tries = stats.num_ok + stats.num_failed
+            return (stats.num_ok + PRIOR_STRENGTH * global_success_rate) / (
+                num_tries + PRIOR_STRENGTH
+            )
+
+    def get_latency_factor(self, url: str) -> float:
+        """
+        Return the ratio of the typical latency for all domains to the typical
+        latency for the URL's domain, capped at 1. It's the rough fraction of the
+        URL's expected success that arrives within a typical round trip.
+        """
+        with self.lock:
+            stats = self.stats_by_domain.get(extract_domain(url))
+            typical_latency = self.total_stats.latency_ewma_s
+            if not stats or not stats.latency_ewma_s or not typical_latency:
+                return 1.0
+            return min(1.0, typical_latency / stats.latency_ewma_s)
+
+    def _is_failing(
+        self, url: str, min_failures: float, max_success_rate: float
+    ) -> bool:
+        with self.lock:
+            stats = self.stats_by_domain.get(extract_domain(url))
+            if stats is None or stats.num_failed < min_failures:
+                return False
+        return self.get_success_rate(url) <= max_success_rate
+
+    def should_skip(self, url: str) -> bool:
+        """Return True if the URL's domain keeps failing, so it's not worth trying."""
+        return self._is_failing(
+            url, MIN_FAILURES_TO_SKIP_DOMAIN, MAX_SUCCESS_RATE_TO_SKIP_DOMAIN
+        )
+
+    def should_deprioritize(self, url: str) -> bool:
+        """Return True if the URL's domain often fails, so it should be tried last."""
+        return self._is_failing(
+            url,
+            MIN_FAILURES_TO_DEPRIORITIZE_DOMAIN,
+            MAX_SUCCESS_RATE_TO_DEPRIORITIZE_DOMAIN,
+        )
+
+    def get_num_urls_to_fetch(
+        self, urls: list[str], num_ok_needed: int, max_num_urls: int
+    ) -> int:
+        """
+        Return how many of the URLs (taken in order) to fetch at once so that the
+        number of URLs with usable content in a single round trip is likely to be
+        at least num_ok_needed. Specifically, take URLs until the expected number
+        of successes minus one standard deviation reaches num_ok_needed.
+        """
+        if num_ok_needed <= 0:
+            return 0
+        expected_num_ok = variance = 0.0
+        for i, url in enumerate(urls[:max_num_urls]):
+            success_rate = self.get_success_rate(url) * self.get_latency_factor(url)
+            expected_num_ok += success_rate
+            variance += success_rate * (1 - success_rate)
+            if expected_num_ok - math.sqrt(variance) >= num_ok_needed:
+                return i + 1
+        return min(len(urls), max_num_urls)
+
+
+_domain_stats_registry: DomainStatsRegistry | None = None
+_domain_stats_registry_lock = threading.Lock()
+
+
+def get_domain_stats_registry() -> DomainStatsRegistry:
+    """
+    Return the process-wide domain stats registry, creating it if needed. If the
+    database can't be opened, the stats are kept in memory only.
+    """
+    global _domain_stats_registry
+    with _domain_stats_registry_lock:
+        if _domain_stats_registry is None:
+            try:
+                _domain_stats_registry = DomainStatsRegistry(DOMAIN_HEALTH_DB_PATH)
+            except Exception as e:
+                logger.error(
+                    f"Could not open the domain stats at {DOMAIN_HEALTH_DB_PATH}, "
+                    f"keeping them in memory only: {format_exception(e)}"
+                )
+                _domain_stats_registry = DomainStatsRegistry()
+    return _domain_stats_registry
@@ -0,0 +1,163 @@
+import hashlib
+import os
+import threading
+import time
+from array import array
+
+from utils.output import format_exception
+from utils.prepare import get_logger
+from utils.sqlite_utils import SQLiteDB
+
+logger = get_logger()
+
+# Set EMBEDDING_CACHE_DB_PATH to an empty string to disable the cache
+EMBEDDING_CACHE_DB_PATH = os.getenv(
+    "EMBEDDING_CACHE_DB_PATH", "embedding-cache.sqlite3"
+)
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", 200000))
+
+# Check whether to evict entries every this many new entries
+EVICTION_CHECK_INTERVAL = 1000
+
+# Max number of texts to look up in one query (SQLite limits the number of params)
+MAX_TEXTS_PER_LOOKUP = 500
+
+EMBEDDING_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS embeddings (
+    model TEXT NOT NULL,
+    dimensions INTEGER NOT NULL,
+    text_hash BLOB NOT NULL,
+    embedding BLOB NOT NULL,
+    last_used_at REAL NOT NULL,
+    PRIMARY KEY (model, dimensions, text_hash)
+);
+CREATE INDEX IF NOT EXISTS embeddings_last_used_at ON embeddings (last_used_at);
+"""
+
+
+def get_text_hash(text: str) -> bytes:
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+
+class EmbeddingCache:
+    """
+    SQLite-backed cache of embeddings, keyed by the embeddings model, the number
+    of dimensions and a hash of the text. Embeddings are stored as float32 arrays.
+    When there are more than max_entries embeddings, the least recently used ones
+    are evicted.
+    """
+
+    def __init__(self, db_path: str, max_entries: int):
+        self.max_entries = max_entries
+        self.db = SQLiteDB(db_path, EMBEDDING_CACHE_SCHEMA)
+        self.num_hits = 0
+        self.num_misses = 0
+        self._num_puts_since_eviction_check = EVICTION_CHECK_INTERVAL  # check soon
+        self._stats_lock = threading.Lock()
+
+    def get_many(
+        self, model: str, dimensions: int, texts: list[str]
+    ) -> list[list[float] | None]:
+        """
+        Return the cached embedding for each text (None if not cached), in the
+        same order as the texts.
+        """
+        text_hashes = [get_text_hash(text) for text in texts]
+        embedding_by_hash: dict[bytes, list[float]] = {}
+        for i in range(0, len(text_hashes), MAX_TEXTS_PER_LOOKUP):
+            batch = list(set(text_hashes[i : i + MAX_TEXTS_PER_LOOKUP]))
+            rows = self.db.execute(
+                "SELECT text_hash, embedding FROM embeddings "
+                "WHERE model = ? AND dimensions = ? AND text_hash IN "
+                f"({', '.join('?' * len(batch))})",
+                (model, dimensions, *batch),
+            )
+            for text_hash, embedding_bytes in rows:
+                embedding_by_hash[text_hash] = array("f", embedding_bytes).tolist()
+
+        # Mark the found embeddings as recently used
+        if embedding_by_hash:
+            now = time.time()
+            self.db.executemany(
+                "UPDATE embeddings SET last_used_at = ? "
+                "WHERE model = ? AND dimensions = ? AND text_hash = ?",
+                [(now, model, dimensions, h) for h in embedding_by_hash],
+            )
+
+        embeddings = [embedding_by_hash.get(h) for h in text_hashes]
+        num_hits = sum(embedding is not None for embedding in embeddings)
+        with self._stats_lock:
+            self.num_hits += num_hits
+            self.num_misses += len(texts) - num_hits
+        return embeddings
+
+    def put_many(
+        self,
+        model: str,
+        dimensions: int,
+        texts: list[str],
+        embeddings: list[list[float]],
+    ) -> None:
+        """Store the embeddings of the texts."""
+        now = time.time()
+        self.db.executemany(
+            "INSERT OR REPLACE INTO embeddings "
+            "(model, dimensions, text_hash, embedding, last_used_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [
+                (model, dimensions, get_text_hash(text), array("f", emb).tobytes(), now)
+                for text, emb in zip(texts, embeddings)
+            ],
+        )
+
+        with self._stats_lock:
+            self._num_puts_since_eviction_check += len(texts)
+            if self._num_puts_since_eviction_check < EVICTION_CHECK_INTERVAL:
+                return
+            self._num_puts_since_eviction_check = 0
+        self.evict()
+
+    def evict(self) -> None:
+        """Evict the least recently used embeddings above max_entries."""
+        with self.db.transaction() as conn:
+            (num_entries,) = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+            if num_entries <= self.max_entries:
+                return
+            conn.execute(
+                "DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings "
+                "ORDER BY last_used_at LIMIT ?)",
+                (num_entries - self.max_entries,),
+            )
+        logger.info(f"Evicted {num_entries - self.max_entries} cached embeddings")
+
+    def get_stats(self) -> dict[str, int]:
+        with self._stats_lock:
+            return {"hits": self.num_hits, "misses": self.num_misses}
+
+
+_embedding_cache: EmbeddingCache | None = None
+_embedding_cache_lock = threading.Lock()
+_is_embedding_cache_unavailable = False
+
+
+def get_embedding_cache() -> EmbeddingCache | None:
+    """
+    Return the process-wide embedding cache, or None if it's disabled or couldn't
+    be opened (in which case embeddings are simply not cached).
+    """
+    global _embedding_cache, _is_embedding_cache_unavailable
+    if not EMBEDDING_CACHE_DB_PATH:
+        return None
+    with _embedding_cache_lock:
+        if _embedding_cache is None and not _is_embedding_cache_unavailable:
+            try:
+                _embedding_cache = EmbeddingCache(
+                    EMBEDDING_CACHE_DB_PATH, EMBEDDING_CACHE_MAX_ENTRIES
+                )
+            except Exception as e:
+                _is_embedding_cache_unavailable = True  # don't retry on every call
+                logger.error(
+                    f"Could not open the embedding cache at {EMBEDDING_CACHE_DB_PATH}, "
+                    f"embeddings won't be cached: {format_exception(e)}"
+                )
+    return _embedding_cache
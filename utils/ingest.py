@@ -1,14 +1,14 @@
+import io
 import os
 import re
 
-import docx2txt
-from bs4 import BeautifulSoup
 from icecream import ic
-from pypdf import PdfReader
 from starlette.datastructures import UploadFile  # err if "from fastapi"
-from streamlit.runtime.uploaded_file_manager import UploadedFile
 from langchain_core.documents import Document
 
+# NOTE: the parsers for specific file types (pypdf, docx2txt, bs4) are imported on
+# first use, to keep the startup fast
+
 allowed_extensions = [
     "",
     ".txt",
@@ -22,22 +22,53 @@ allowed_extensions = [
 ]
 
 
+def iter_page_texts_from_pdf(file):
+    """
+    Lazily extract the text of each page of a PDF, one page at a time.
+    """
+    from pypdf import PdfReader
+
+    reader = PdfReader(file, strict=False)
+    for page in reader.pages:
+        yield page.extract_text()
+
+
 def get_page_texts_from_pdf(file):
-    reader = PdfReader(file)
-    return [page.extract_text() for page in reader.pages]
+    return list(iter_page_texts_from_pdf(file))
 
 
 DEFAULT_PAGE_START = "PAGE {page_num}:\n"
 DEFAULT_PAGE_SEP = "\n" + "-" * 3 + "\n\n"
 
 
-def get_text_from_pdf(file, page_start=DEFAULT_PAGE_START, page_sep=DEFAULT_PAGE_SEP):
-    return page_sep.join(
-        [
-            page_start.replace("{page_num}", str(i)) + x
-            for i, x in enumerate(get_page_texts_from_pdf(file), start=1)
-        ]
-    )
+def get_text_from_pdf(
+    file,
+    page_start=DEFAULT_PAGE_START,
+    page_sep=DEFAULT_PAGE_SEP,
+    max_chars: int | None = None,
+):
+    """
+    Extract the text from a PDF. If max_chars is given, stop extracting pages once
+    the text has at least max_chars characters (the rest of the pages are not even
+    parsed, which matters for long PDFs).
+    """
+    page_texts = []
+    num_chars = 0
+    for i, text in enumerate(iter_page_texts_from_pdf(file), start=1):
+        page_texts.append(page_start.replace("{page_num}", str(i)) + text)
+        num_chars += len(page_texts[-1]) + len(page_sep)
+        if max_chars is not None and num_chars >= max_chars:
+            break
+    return page_sep.join(page_texts)
+
+
+def get_text_from_pdf_bytes(pdf_bytes: bytes, max_chars: int | None = None):
+    """
+    Extract the text from a PDF given as bytes (see get_text_from_pdf). Module-level
+    function, so that it can be run in a worker process.
+    """
+    with io.BytesIO(pdf_bytes) as pdf_file:
+        return get_text_from_pdf(pdf_file, max_chars=max_chars)
 
 
 def extract_text(files, allow_all_ext):
@@ -56,13 +87,17 @@ def extract_text(files, allow_all_ext):
                 unsupported_ext_files.append(file_name)
                 continue
             if extension == ".pdf":
-                for i, text in enumerate(get_page_texts_from_pdf(file)):
+                for i, text in enumerate(iter_page_texts_from_pdf(file)):
                     metadata = {"source": f"{file_name} (page {i + 1})"}
                     docs.append(Document(page_content=text, metadata=metadata))
             else:
                 if extension == ".docx":
+                    import docx2txt
+
                     text = docx2txt.process(file)
                 elif extension in [".html", ".htm"]:
+                    from bs4 import BeautifulSoup
+
                     soup = BeautifulSoup(file, "html.parser")
                     # Remove script and style elements
                     for script_or_style in soup(["script", "style"]):
@@ -73,7 +108,7 @@ def extract_text(files, allow_all_ext):
                     print(text)
                 else:
                     # Treat as text file
-                    if isinstance(file, UploadedFile):
+                    if hasattr(file, "getvalue"):  # e.g. Streamlit's UploadedFile
                         text = file.getvalue().decode("utf-8")
                         # NOTE: not sure what the advantage is for Streamlit's UploadedFile
                     else:
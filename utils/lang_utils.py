@@ -1,9 +1,13 @@
+import hashlib
+import os
+import threading
 from bisect import bisect_right
+from collections import OrderedDict
+
+import tiktoken
 from langchain_core.documents import Document
-from langchain_openai import ChatOpenAI
 
 from utils.algo import insert_interval
-from utils.async_utils import execute_func_map_in_threads
 from utils.output import ConditionalLogger
 from utils.prepare import get_logger
 from utils.rag import rag_text_splitter
@@ -13,7 +17,10 @@ from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, get_bu
 
 logger = get_logger()
 
-default_llm_for_token_counting = ChatOpenAI(api_key="DUMMY")  # "DUMMY" to avoid error
+# Model whose tokenizer is used when no LLM is given (ChatOpenAI's default model)
+DEFAULT_MODEL_FOR_TOKEN_COUNTING = "gpt-3.5-turbo"
+# Encoding for models unknown to tiktoken (same fallback as in LangChain)
+FALLBACK_TIKTOKEN_ENCODING = "cl100k_base"
 
 ## https://gptforwork.com/guides/openai-gpt3-tokens
 # English: 1 word ≈ 1.3 tokens
@@ -28,33 +35,195 @@ default_llm_for_token_counting = ChatOpenAI(api_key="DUMMY")  # "DUMMY" to avoid
 
 ROUGH_UPPER_LIMIT_AVG_CHARS_PER_TOKEN = 4  # English: 1 word ≈ 1.3 tokens
 
+# In limit_tokens_in_text, only this many chars per allowed token are encoded at
+# first, since only the beginning of the text can fit (generous, to rarely need more)
+MAX_CHARS_PER_TOKEN_TO_ENCODE = 10
+
+
+_tiktoken_encodings_by_model: dict[str, tiktoken.Encoding] = {}
+_tiktoken_encodings_lock = threading.Lock()
+
+
+def get_tiktoken_encoding_for_model(model_name: str) -> tiktoken.Encoding:
+    """
+    Get the tiktoken encoding for a model. The encoding is loaded on first use and
+    then cached, so this is cheap to call for every token count.
+    """
+    try:
+        return _tiktoken_encodings_by_model[model_name]
+    except KeyError:
+        pass
+    with _tiktoken_encodings_lock:
+        if model_name not in _tiktoken_encodings_by_model:
+            try:
+                tiktoken_encoding = tiktoken.encoding_for_model(model_name)
+            except KeyError:
+                tiktoken_encoding = tiktoken.get_encoding(FALLBACK_TIKTOKEN_ENCODING)
+            _tiktoken_encodings_by_model[model_name] = tiktoken_encoding
+        return _tiktoken_encodings_by_model[model_name]
+
+
+def get_tiktoken_encoding(llm_for_token_counting: BaseLanguageModel | None = None):
+    """Get the tiktoken encoding used to count tokens for an LLM."""
+    if llm_for_token_counting is None:
+        return get_tiktoken_encoding_for_model(DEFAULT_MODEL_FOR_TOKEN_COUNTING)
+    model_name = getattr(llm_for_token_counting, "tiktoken_model_name", None) or (
+        getattr(llm_for_token_counting, "model_name", None)
+    )
+    if model_name:
+        return get_tiktoken_encoding_for_model(model_name)
+    _, tiktoken_encoding = llm_for_token_counting._get_encoding_model()
+    return tiktoken_encoding
+
 
 def get_token_ids(text: str, llm_for_token_counting: BaseLanguageModel | None = None):
     """Get the token IDs for a text."""
-    llm = llm_for_token_counting or default_llm_for_token_counting
     # return llm.get_token_ids(text) # can result in:
     # ValueError: Encountered text corresponding to disallowed special token '<|endoftext|>'
-    _, tiktoken_encoding = llm._get_encoding_model()
+    tiktoken_encoding = get_tiktoken_encoding(llm_for_token_counting)
     return tiktoken_encoding.encode_ordinary(text)  # LC uses encode instead
 
 
+class TokenCountCache:
+    """
+    Thread-safe LRU cache of token counts, keyed by the tokenizer's encoding name
+    and a hash of the text (so the texts themselves are not kept in memory).
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.counts: OrderedDict[tuple[str, bytes], int] = OrderedDict()
+        self.num_hits = 0
+        self.num_misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_key(encoding_name: str, text: str) -> tuple[str, bytes]:
+        text_bytes = text.encode("utf-8", errors="surrogatepass")
+        return encoding_name, hashlib.blake2b(text_bytes, digest_size=16).digest()
+
+    def get(self, key: tuple[str, bytes]) -> int | None:
+        with self.lock:
+            num_tokens = self.counts.get(key)
+            if num_tokens is None:
+                self.num_misses += 1
+            else:
+                self.num_hits += 1
+                self.counts.move_to_end(key)
+            return num_tokens
+
+    def put(self, key: tuple[str, bytes], num_tokens: int) -> None:
+        with self.lock:
+            self.counts[key] = num_tokens
+            self.counts.move_to_end(key)
+            if len(self.counts) > self.max_size:
+                self.counts.popitem(last=False)
+
+    def get_stats(self) -> dict[str, int | float]:
+        with self.lock:
+            num_lookups = self.num_hits + self.num_misses
+            return {
+                "hits": self.num_hits,
+                "misses": self.num_misses,
+                "hit_rate": self.num_hits / num_lookups if num_lookups else 0.0,
+                "size": len(self.counts),
+            }
+
+
+# In get_num_tokens_in_texts, texts are tokenized in parallel (with this many threads)
+# only if their total length is at least this many chars, since otherwise the
+# overhead of the threads is not worth it (see eval/bench_token_counting.py)
+MIN_CHARS_FOR_BATCH_TOKENIZATION = 50000
+NUM_TOKENIZATION_THREADS = min(8, os.cpu_count() or 1)
+
+# Set TOKEN_COUNT_CACHE_SIZE to 0 to disable the cache
+TOKEN_COUNT_CACHE_SIZE = int(os.getenv("TOKEN_COUNT_CACHE_SIZE", 100000))
+token_count_cache = TokenCountCache(TOKEN_COUNT_CACHE_SIZE)
+
+
 def get_num_tokens(text: str, llm_for_token_counting: BaseLanguageModel | None = None):
-    """Get the number of tokens in a text."""
-    return len(get_token_ids(text, llm_for_token_counting))
+    """Get the number of tokens in a text (cached, see TokenCountCache)."""
+    tiktoken_encoding = get_tiktoken_encoding(llm_for_token_counting)
+    if not TOKEN_COUNT_CACHE_SIZE:
+        return len(tiktoken_encoding.encode_ordinary(text))
+
+    key = TokenCountCache.get_key(tiktoken_encoding.name, text)
+    if (num_tokens := token_count_cache.get(key)) is None:
+        num_tokens = len(tiktoken_encoding.encode_ordinary(text))
+        token_count_cache.put(key, num_tokens)
+    return num_tokens
+
+
+def add_chunk_num_tokens(
+    chunks: list[Document], llm_for_token_counting: BaseLanguageModel | None = None
+) -> None:
+    """
+    Store the number of tokens of each chunk in its metadata ("chunk_num_tokens",
+    along with the name of the tokenizer in "chunk_tokenizer"), so that retrieval
+    doesn't have to count them again.
+    """
+    tokenizer_name = get_tiktoken_encoding(llm_for_token_counting).name
+    token_counts = get_num_tokens_in_texts(
+        [chunk.page_content for chunk in chunks], llm_for_token_counting
+    )
+    for chunk, num_tokens in zip(chunks, token_counts):
+        chunk.metadata["chunk_num_tokens"] = num_tokens
+        chunk.metadata["chunk_tokenizer"] = tokenizer_name
+
+
+def get_chunk_num_tokens(
+    chunk: Document, llm_for_token_counting: BaseLanguageModel | None = None
+) -> int:
+    """
+    Get the number of tokens in a chunk, using the count stored in its metadata if
+    it was obtained with the same tokenizer (see add_chunk_num_tokens).
+    """
+    tiktoken_encoding = get_tiktoken_encoding(llm_for_token_counting)
+    if chunk.metadata.get("chunk_tokenizer") == tiktoken_encoding.name:
+        return chunk.metadata["chunk_num_tokens"]
+    return get_num_tokens(chunk.page_content, llm_for_token_counting)
 
 
 def get_num_tokens_in_texts(
     texts: list[str], llm_for_token_counting: BaseLanguageModel | None = None
 ) -> list[int]:
     """
-    Get the number of tokens in a list of texts using multiple threads.
+    Get the number of tokens in a list of texts. Counts are looked up in the token
+    count cache first. If the rest of the texts are long enough in total, they are
+    tokenized in parallel using tiktoken's batch encoding (tiktoken releases the GIL,
+    so its threads run in parallel), otherwise one by one.
     """
+    tiktoken_encoding = get_tiktoken_encoding(llm_for_token_counting)
+    token_counts: list[int | None] = [None] * len(texts)
+    keys: list[tuple[str, bytes] | None] = [None] * len(texts)
+    if TOKEN_COUNT_CACHE_SIZE:
+        for i, text in enumerate(texts):
+            keys[i] = TokenCountCache.get_key(tiktoken_encoding.name, text)
+            token_counts[i] = token_count_cache.get(keys[i])
+
+    idxs_to_count = [i for i, count in enumerate(token_counts) if count is None]
+    texts_to_count = [texts[i] for i in idxs_to_count]
+    num_chars_to_count = sum(len(text) for text in texts_to_count)
+    if (
+        NUM_TOKENIZATION_THREADS > 1
+        and len(texts_to_count) > 1
+        and num_chars_to_count >= MIN_CHARS_FOR_BATCH_TOKENIZATION
+    ):
+        new_token_counts = [
+            len(token_ids)
+            for token_ids in tiktoken_encoding.encode_ordinary_batch(
+                texts_to_count, num_threads=NUM_TOKENIZATION_THREADS
+            )
+        ]
+    else:
+        new_token_counts = [
+            len(tiktoken_encoding.encode_ordinary(text)) for text in texts_to_count
+        ]
 
-    def _get_num_tokens(text):
-        return get_num_tokens(text, llm_for_token_counting)
-
-    # TODO: experiment - since this is CPU-bound, may not benefit from threads
-    token_counts = execute_func_map_in_threads(_get_num_tokens, texts)
+    for i, num_tokens in zip(idxs_to_count, new_token_counts):
+        token_counts[i] = num_tokens
+        if TOKEN_COUNT_CACHE_SIZE:
+            token_count_cache.put(keys[i], num_tokens)
     return token_counts
 
 
@@ -254,46 +423,36 @@ def limit_tokens_in_text(
     text: str,
     max_tokens: int,
     llm_for_token_counting: BaseLanguageModel | None = None,
-    slow_down_factor=1.0,  # 0 = quicker but can undershoot significantly
-) -> str:
+) -> tuple[str, int]:
     """
-    Limit the number of tokens in a text to the specified amount (or slightly less).
+    Limit the number of tokens in a text to the specified amount.
 
-    Tokens are removed from the end of the text.
+    Tokens are removed from the end of the text. The text (usually just its
+    beginning) is encoded once and cut at the boundary of its max_tokens-th
+    token. Returns the resulting text and its number of tokens.
     """
-
-    # NOTE: Can implement without "guesses", using get_token_ids and token lookup
-    words = text.split(" ")
-    num_tokens = 0
-    at_most_words = len(words)
-
-    # Get the initial guess for the number of words to keep
-    # print("max_tokens:", max_tokens)
-    # print("Initial token counting...")
-    for i, word in enumerate(words):
-        curr_num_tokens = get_num_tokens(word, llm_for_token_counting)
-        num_tokens += curr_num_tokens
-        if num_tokens > max_tokens:
-            at_most_words = i
-            break
-    # print("actual number of words:", len(words))
-    # print("at_most_words:", at_most_words)
-
-    # Keep reducing the number of words to keep until we're below the token limit
+    # Only the beginning of the text can fit, so try encoding just that first
+    text_to_encode = text[: max_tokens * MAX_CHARS_PER_TOKEN_TO_ENCODE]
+    token_ids = get_token_ids(text_to_encode, llm_for_token_counting)
+    if len(token_ids) <= max_tokens and len(text_to_encode) < len(text):
+        token_ids = get_token_ids(text, llm_for_token_counting)  # unusual text
+    if len(token_ids) <= max_tokens:
+        return text, len(token_ids)
+
+    # The tokens' bytes add up to the UTF-8 encoding of the encoded text, so the
+    # bytes of the first max_tokens tokens are a prefix of it. The prefix may end in
+    # the middle of a multi-byte character, which we drop. Dropping it (or cutting
+    # in the middle of a word) can change how the rest is tokenized, so we count the
+    # tokens of the text we return, and cut again in the rare case they don't fit.
+    tiktoken_encoding = get_tiktoken_encoding(llm_for_token_counting)
     while True:
-        text = " ".join(words[:at_most_words])
-        true_num_tokens = get_num_tokens(text, llm_for_token_counting)
-        if true_num_tokens <= max_tokens:
-            return text, true_num_tokens
-        # Reduce the number of words to keep and try again
-        # print("true_num_tokens:", true_num_tokens)
-        # print("at_most_words:", at_most_words, end=" -> ")
-        at_most_words = int(
-            at_most_words
-            * (max_tokens / true_num_tokens + slow_down_factor)
-            / (1 + slow_down_factor)
+        kept_bytes = b"".join(
+            tiktoken_encoding.decode_tokens_bytes(token_ids[:max_tokens])
         )
-        # print(at_most_words)
+        text = kept_bytes.decode("utf-8", errors="ignore")
+        token_ids = get_token_ids(text, llm_for_token_counting)
+        if len(token_ids) <= max_tokens:
+            return text, len(token_ids)
 
 
 def get_max_token_allowance_for_texts(
@@ -384,7 +543,9 @@ def expand_chunks(
     number of tokens below the specified limit (or slightly above). The expanded chunks
     will have the same metadata as the base chunks, except for the "start_index" metadata,
     which will be updated to reflect the new start index in the parent document, and the
-    "num_tokens" metadata, which will contain the chunk's number of tokens.
+    "num_tokens" metadata, which will contain the chunk's number of tokens. (The
+    "chunk_num_tokens" and "chunk_tokenizer" metadata of the base chunks, if any, are
+    used to avoid recounting their tokens and are not kept.)
 
     If during expansion two or more chunks in the same parent document overlap, they will
     be merged into one chunk.
@@ -455,11 +616,17 @@ def expand_chunks(
         start_chunk_idx = chunk_idx
         end_chunk_idx = chunk_idx + 1
 
-        # Expanded chunk starts with the original chunk
-        num_tokens = get_num_tokens(base_chunk.page_content, llm_for_token_counting)
+        # Expanded chunk starts with the original chunk (the stored token count of
+        # the original chunk doesn't apply to expanded chunks, so we drop it)
+        num_tokens = get_chunk_num_tokens(base_chunk, llm_for_token_counting)
+        metadata = {
+            k: v
+            for k, v in base_chunk.metadata.items()
+            if k not in ("chunk_num_tokens", "chunk_tokenizer")
+        }
         expanded_chunk = Document(
             page_content=base_chunk.page_content,
-            metadata=base_chunk.metadata | {"num_tokens": num_tokens},
+            metadata=metadata | {"num_tokens": num_tokens},
         )
 
         target_num_tokens = token_allowance_left * boost_factor / boost_factors_sum_left
@@ -523,7 +690,7 @@ def expand_chunks(
             # Update the expanded chunk
             expanded_chunk = Document(
                 page_content=new_text,
-                metadata=base_chunk.metadata
+                metadata=metadata
                 | {"num_tokens": new_num_tokens, "start_index": new_start_idx},
             )
         clg.log(
@@ -554,7 +721,7 @@ def expand_chunks(
                     num_tokens = get_num_tokens(chunk_text, llm_for_token_counting)
                     new_chunks_in_parent[idx_pair] = Document(
                         page_content=chunk_text,
-                        metadata=base_chunk.metadata
+                        metadata=metadata
                         | {
                             "start_index": idx_pair[0],
                             "num_tokens": num_tokens,
@@ -78,6 +78,14 @@ DOMAIN_NAME_FOR_SHARING = os.getenv("DOMAIN_NAME_FOR_SHARING", "shared")
 
 MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 100 * 1024 * 1024))
 
+# Admission control for the FastAPI server (see utils.request_pool)
+API_MAX_CONCURRENT_REQUESTS = int(os.getenv("API_MAX_CONCURRENT_REQUESTS", 8))
+API_MAX_CONCURRENT_ASYNC_REQUESTS = int(  # requests that don't need a worker thread
+    os.getenv("API_MAX_CONCURRENT_ASYNC_REQUESTS", 256)
+)
+API_MAX_QUEUED_REQUESTS = int(os.getenv("API_MAX_QUEUED_REQUESTS", 32))
+API_QUEUE_TIMEOUT_S = float(os.getenv("API_QUEUE_TIMEOUT_S", 30))
+
 INITIAL_TEST_QUERY_STREAMLIT = os.getenv("INITIAL_QUERY_STREAMLIT")
 
 # Check that the necessary environment variables are set
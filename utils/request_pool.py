@@ -0,0 +1,176 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable
+
+from utils.prepare import get_logger
+from utils.type_utils import DDGError
+
+logger = get_logger()
+
+# How often to check whether the client is still connected
+DISCONNECT_POLL_INTERVAL_S = 1.0
+
+
+class ServerOverloadedError(DDGError):
+    default_user_facing_message = (
+        "Apologies, I'm handling too many requests right now. "
+        "Please try again in a little while."
+    )
+    default_http_status_code = 429
+
+
+class RequestCancelledError(DDGError):
+    default_user_facing_message = "The request was cancelled."
+    default_http_status_code = 499  # "client closed request"
+
+
+class RequestWorkerPool:
+    """
+    Runs blocking request handlers in a pool of worker threads, so that they don't
+    block the event loop, with admission control: at most max_concurrent requests
+    run at a time, at most max_queued wait for a free worker, and each waits at most
+    queue_timeout_s. Requests that can't be admitted get a ServerOverloadedError.
+
+    If the client disconnects, the request is dropped if it's still waiting, or its
+    on_disconnect callback is called if it's already running (a running thread can't
+    be stopped, so it's up to the handler to check for cancellation, see
+    CallbackHandlerDDGCancellation). Either way, a RequestCancelledError is raised.
+    The worker stays taken until the handler actually returns.
+
+    Requests that are natively async can instead be run as coroutines in the event
+    loop (see submit_coroutine), in which case the "workers" are just slots and no
+    thread is used.
+
+    Must be used from a single event loop (e.g. the FastAPI one).
+    """
+
+    def __init__(self, max_concurrent: int, max_queued: int, queue_timeout_s: float):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.queue_timeout_s = queue_timeout_s
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_concurrent, thread_name_prefix="request-worker"
+        )
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self.num_queued = 0
+        self.num_running = 0
+
+    async def aacquire_worker(
+        self, ais_disconnected: Callable[[], Awaitable[bool]] | None = None
+    ) -> None:
+        """
+        Wait for a free worker (see the class docstring). Must be followed by submit.
+        """
+        if not self._semaphore.locked():
+            await self._semaphore.acquire()  # a worker is free, no need to queue
+            return
+        if self.num_queued >= self.max_queued:
+            raise ServerOverloadedError(f"{self.num_queued} requests already queued")
+
+        self.num_queued += 1
+        acquire_task = asyncio.ensure_future(self._semaphore.acquire())
+        try:
+            time_left = self.queue_timeout_s
+            while True:
+                timeout = min(DISCONNECT_POLL_INTERVAL_S, time_left)
+                done, _ = await asyncio.wait({acquire_task}, timeout=timeout)
+                if done:
+                    return
+                time_left -= timeout
+                if time_left <= 0:
+                    raise ServerOverloadedError(
+                        f"No free worker after {self.queue_timeout_s}s in the queue"
+                    )
+                if ais_disconnected and await ais_disconnected():
+                    raise RequestCancelledError("Client disconnected while queued")
+        except BaseException:
+            # Don't leak the worker if it was acquired just as we gave up
+            if acquire_task.done() and not acquire_task.cancelled():
+                self._semaphore.release()
+            else:
+                acquire_task.cancel()
+            raise
+        finally:
+            self.num_queued -= 1
+
+    def _release_worker(self, _future) -> None:
+        self.num_running -= 1
+        self._semaphore.release()
+
+    def submit(self, func: Callable, *args) -> asyncio.Future:
+        """
+        Run func(*args) in the worker acquired with aacquire_worker. The worker is
+        released when func returns.
+        """
+        self.num_running += 1
+        future = asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        future.add_done_callback(self._release_worker)
+        return future
+
+    def submit_coroutine(self, coro) -> asyncio.Task:
+        """
+        Like submit, but run a coroutine object natively in the event loop rather
+        than in a worker thread. The worker is released when the coroutine returns.
+        """
+        self.num_running += 1
+        task = asyncio.ensure_future(coro)
+        task.add_done_callback(self._release_worker)
+        return task
+
+    async def aresult(
+        self,
+        future: asyncio.Future,
+        ais_disconnected: Callable[[], Awaitable[bool]] | None = None,
+        on_disconnect: Callable[[], None] | None = None,
+    ):
+        """
+        Wait for the result of a submitted request, calling on_disconnect (and
+        raising RequestCancelledError) if the client disconnects first.
+        """
+        try:
+            while True:
+                done, _ = await asyncio.wait(
+                    {future}, timeout=DISCONNECT_POLL_INTERVAL_S
+                )
+                if done:
+                    return future.result()
+                if ais_disconnected and await ais_disconnected():
+                    raise RequestCancelledError("Client disconnected")
+        except BaseException:  # including asyncio.CancelledError
+            if not future.done():
+                logger.info("Cancelling a running request")
+                if on_disconnect:
+                    on_disconnect()
+            raise
+
+    async def arun(
+        self,
+        func: Callable,
+        *args,
+        ais_disconnected: Callable[[], Awaitable[bool]] | None = None,
+        on_disconnect: Callable[[], None] | None = None,
+    ):
+        """
+        Run func(*args) in a worker thread and return its result. ais_disconnected
+        is polled to detect that the client went away (e.g. Request.is_disconnected).
+        """
+        await self.aacquire_worker(ais_disconnected)
+        future = self.submit(func, *args)
+        return await self.aresult(future, ais_disconnected, on_disconnect)
+
+    async def arun_coroutine(
+        self,
+        async_func: Callable[..., Awaitable],
+        *args,
+        ais_disconnected: Callable[[], Awaitable[bool]] | None = None,
+    ):
+        """
+        Run async_func(*args) in the event loop, with the same admission control as
+        arun, and return its result. If the client disconnects, it's cancelled.
+        """
+        await self.aacquire_worker(ais_disconnected)
+        task = self.submit_coroutine(async_func(*args))
+        return await self.aresult(task, ais_disconnected, on_disconnect=task.cancel)
+
+    def get_stats(self) -> dict[str, int]:
+        return {"running": self.num_running, "queued": self.num_queued}
@@ -0,0 +1,111 @@
+import json
+import os
+import threading
+import time
+
+from utils.output import format_exception
+from utils.prepare import get_logger
+from utils.sqlite_utils import SQLiteDB
+
+logger = get_logger()
+
+# Set SEARCH_CACHE_DB_PATH to an empty string to disable the cache
+SEARCH_CACHE_DB_PATH = os.getenv("SEARCH_CACHE_DB_PATH", "search-cache.sqlite3")
+SEARCH_CACHE_TTL_S = int(os.getenv("SEARCH_CACHE_TTL_S", 24 * 60 * 60))
+
+SEARCH_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS search_results (
+    query_key TEXT NOT NULL,
+    num_results INTEGER NOT NULL,
+    results TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (query_key, num_results)
+);
+CREATE INDEX IF NOT EXISTS search_results_created_at ON search_results (created_at);
+"""
+
+
+def normalize_query(query: str) -> str:
+    """
+    Normalize a search query for use as a cache key: case-fold it and collapse
+    whitespace. (Punctuation is kept, since e.g. quotes change the search.)
+    """
+    return " ".join(query.casefold().split())
+
+
+class SearchResultsCache:
+    """
+    SQLite-backed cache of web search results (the JSON returned by the search
+    API), keyed by the normalized query and the number of requested results.
+    Entries older than ttl_s are treated as missing and deleted from time to time.
+    """
+
+    def __init__(self, db_path: str, ttl_s: float):
+        self.ttl_s = ttl_s
+        self.db = SQLiteDB(db_path, SEARCH_CACHE_SCHEMA)
+        self.num_hits = 0
+        self.num_misses = 0
+        self._last_purge_time = 0.0
+        self._stats_lock = threading.Lock()
+
+    def get(self, query: str, num_results: int) -> dict | None:
+        """Return the cached search results, or None if not cached or expired."""
+        rows = self.db.execute(
+            "SELECT results FROM search_results "
+            "WHERE query_key = ? AND num_results = ? AND created_at > ?",
+            (normalize_query(query), num_results, time.time() - self.ttl_s),
+        )
+        with self._stats_lock:
+            if rows:
+                self.num_hits += 1
+            else:
+                self.num_misses += 1
+        return json.loads(rows[0][0]) if rows else None
+
+    def put(self, query: str, num_results: int, results: dict) -> None:
+        """Store the search results (should only be called for successful searches)."""
+        now = time.time()
+        self.db.execute(
+            "INSERT OR REPLACE INTO search_results "
+            "(query_key, num_results, results, created_at) VALUES (?, ?, ?, ?)",
+            (normalize_query(query), num_results, json.dumps(results), now),
+        )
+
+        # Delete expired entries, but not more often than once per TTL
+        if now - self._last_purge_time > self.ttl_s:
+            self._last_purge_time = now
+            self.db.execute(
+                "DELETE FROM search_results WHERE created_at <= ?", (now - self.ttl_s,)
+            )
+
+    def get_stats(self) -> dict[str, int]:
+        with self._stats_lock:
+            return {"hits": self.num_hits, "misses": self.num_misses}
+
+
+_search_cache: SearchResultsCache | None = None
+_search_cache_lock = threading.Lock()
+_is_search_cache_unavailable = False
+
+
+def get_search_cache() -> SearchResultsCache | None:
+    """
+    Return the process-wide search results cache, or None if it's disabled or
+    couldn't be opened (in which case searches are simply not cached).
+    """
+    global _search_cache, _is_search_cache_unavailable
+    if not SEARCH_CACHE_DB_PATH:
+        return None
+    with _search_cache_lock:
+        if _search_cache is None and not _is_search_cache_unavailable:
+            try:
+                _search_cache = SearchResultsCache(
+                    SEARCH_CACHE_DB_PATH, SEARCH_CACHE_TTL_S
+                )
+            except Exception as e:
+                _is_search_cache_unavailable = True  # don't retry on every search
+                logger.error(
+                    f"Could not open the search cache at {SEARCH_CACHE_DB_PATH}, "
+                    f"searches won't be cached: {format_exception(e)}"
+                )
+    return _search_cache
@@ -0,0 +1,115 @@
+import asyncio
+import json
+import os
+from typing import Any
+
+import aiohttp
+
+from utils.async_utils import run_task_in_shared_loop
+from utils.prepare import get_logger
+from utils.web import get_shared_aiohttp_session
+
+logger = get_logger()
+
+SERPER_SEARCH_URL = "https://google.serper.dev/search"
+SERPER_MAX_QUERIES_PER_BATCH = 20
+SERPER_MAX_CONCURRENT_REQUESTS = 5  # when falling back to one request per query
+SERPER_TIMEOUT_S = 20
+
+
+class SerperClient:
+    """
+    Client for the Serper.dev Google Search API. It sends up to
+    SERPER_MAX_QUERIES_PER_BATCH queries in one request to the batch endpoint,
+    over the shared aiohttp session (so connections are reused). If the batch
+    endpoint answers with a non-2xx status or a response that isn't one result
+    per query, it falls back to one request per query, with at most
+    SERPER_MAX_CONCURRENT_REQUESTS requests at a time. Timeouts and other errors
+    are raised rather than retried query by query, since the batch may have been
+    processed (and charged for) already.
+
+    Search results are returned as the JSON from the API, like the results of
+    GoogleSerperAPIWrapper.results (including errors, such as
+    {"statusCode": 400, "message": "Not enough credits"}).
+    """
+
+    def __init__(self, api_key: str | None = None, gl: str = "us", hl: str = "en"):
+        self.api_key = api_key or os.getenv("SERPER_API_KEY", "")
+        self.gl = gl
+        self.hl = hl
+
+    def _get_payload(self, query: str, num_results: int) -> dict[str, Any]:
+        return {"q": query, "gl": self.gl, "hl": self.hl, "num": num_results}
+
+    async def _apost(self, payload: dict | list) -> tuple[int, Any]:
+        """
+        Send a request to the search endpoint and return the status and the JSON
+        of the response (None if the response isn't JSON).
+        """
+        headers = {"X-API-KEY": self.api_key, "Content-Type": "application/json"}
+        async with get_shared_aiohttp_session().post(
+            SERPER_SEARCH_URL,
+            json=payload,
+            headers=headers,
+            timeout=aiohttp.ClientTimeout(total=SERPER_TIMEOUT_S),
+        ) as response:
+            text = await response.text()
+        try:
+            return response.status, json.loads(text)
+        except ValueError:
+            return response.status, None
+
+    async def _asearch_one(
+        self, query: str, num_results: int, semaphore: asyncio.Semaphore
+    ) -> dict[str, Any]:
+        async with semaphore:
+            status, data = await self._apost(self._get_payload(query, num_results))
+        if data is None:
+            raise ValueError(f"Search API response is not JSON (status {status})")
+        if status // 100 != 2 and isinstance(data, dict):
+            data.setdefault("statusCode", status)
+        return data
+
+    async def _asearch_batch(
+        self, queries: list[str], num_results: int, semaphore: asyncio.Semaphore
+    ) -> list[dict[str, Any]]:
+        if len(queries) > 1:
+            payload = [self._get_payload(query, num_results) for query in queries]
+            # NOTE: errors (e.g. a read timeout) are not followed by one request per
+            # query, since the server may have processed (and charged for) the batch
+            async with semaphore:
+                status, data = await self._apost(payload)
+            if status // 100 == 2 and isinstance(data, list):
+                if len(data) == len(queries):
+                    return data
+            logger.warning(
+                f"Unexpected response from the batch search endpoint (status "
+                f"{status}), falling back to one request per query"
+            )
+
+        return await asyncio.gather(
+            *(self._asearch_one(query, num_results, semaphore) for query in queries)
+        )
+
+    async def asearch(
+        self, queries: list[str], num_results: int = 10
+    ) -> list[dict[str, Any]]:
+        """
+        Asynchronously do a Google search for each query and return the search
+        results in the same order as the queries. Must be run in the shared loop.
+        """
+        semaphore = asyncio.Semaphore(SERPER_MAX_CONCURRENT_REQUESTS)
+        batches = [
+            queries[i : i + SERPER_MAX_QUERIES_PER_BATCH]
+            for i in range(0, len(queries), SERPER_MAX_QUERIES_PER_BATCH)
+        ]
+        results_for_batches = await asyncio.gather(
+            *(self._asearch_batch(batch, num_results, semaphore) for batch in batches)
+        )
+        return [result for results in results_for_batches for result in results]
+
+    def search(
+        self, queries: list[str], num_results: int = 10
+    ) -> list[dict[str, Any]]:
+        """Do a Google search for each query and return the search results."""
+        return run_task_in_shared_loop(self.asearch(queries, num_results))
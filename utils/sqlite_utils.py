@@ -0,0 +1,53 @@
+import contextlib
+import os
+import sqlite3
+import threading
+
+SQLITE_BUSY_TIMEOUT_MS = 5000
+
+
+class SQLiteDB:
+    """
+    Thin wrapper around a SQLite connection that can be shared between threads
+    (e.g. the main thread and the shared event loop's thread). All statements are
+    executed under a lock, and each call to `execute` or `executemany` is committed.
+
+    The database uses WAL mode, so that several processes can read it while one
+    of them is writing.
+    """
+
+    def __init__(self, path: str, schema: str = ""):
+        # Create the parent directory if needed (sqlite3 creates the file itself)
+        if dirname := os.path.dirname(path):
+            os.makedirs(dirname, exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        if schema:
+            with self.lock, self.conn:
+                self.conn.executescript(schema)
+
+    def execute(self, sql: str, params=()) -> list[tuple]:
+        """Execute a statement, commit, and return all resulting rows."""
+        with self.lock, self.conn:
+            return self.conn.execute(sql, params).fetchall()
+
+    def executemany(self, sql: str, seq_of_params) -> None:
+        """Execute a statement for each set of parameters and commit."""
+        with self.lock, self.conn:
+            self.conn.executemany(sql, seq_of_params)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Context manager that yields the connection for several statements that
+        must be executed atomically (committed on success, rolled back on error).
+        """
+        with self.lock, self.conn:
+            yield self.conn
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
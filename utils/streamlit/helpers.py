@@ -1,10 +1,10 @@
-import re
 import time
 from typing import Any
 
 import streamlit as st
 from pydantic import BaseModel
 
+from utils.strings import escape_dollars, fix_markdown  # noqa: F401 (re-exported)
 from utils.type_utils import ChatMode
 
 WELCOME_TEMPLATE_COLL_IN_URL = """\
@@ -182,21 +182,6 @@ def update_url_if_scheduled():
         st.session_state.update_query_params = None
 
 
-def escape_dollars(text: str) -> str:
-    """
-    Escape dollar signs in the text that come before numbers.
-    """
-    return re.sub(r"\$(?=\d)", r"\$", text)
-
-
-def fix_markdown(text: str) -> str:
-    """
-    Escape dollar signs in the text that come before numbers and add
-    two spaces before every newline.
-    """
-    return re.sub(r"\$(?=\d)", r"\$", text).replace("\n", "  \n")
-
-
 def write_slowly(message_placeholder, answer, delay=None):
     """Write a message to the message placeholder not all at once but word by word."""
     pieces = answer.split(" ")
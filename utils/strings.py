@@ -1,3 +1,4 @@
+import difflib
 import json
 import re
 from typing import Iterable
@@ -53,6 +54,21 @@ def remove_consecutive_blank_lines(
     return new_lines
 
 
+def escape_dollars(text: str) -> str:
+    """
+    Escape dollar signs in the text that come before numbers.
+    """
+    return re.sub(r"\$(?=\d)", r"\$", text)
+
+
+def fix_markdown(text: str) -> str:
+    """
+    Escape dollar signs in the text that come before numbers and add
+    two spaces before every newline.
+    """
+    return re.sub(r"\$(?=\d)", r"\$", text).replace("\n", "  \n")
+
+
 def limit_number_of_words(text: str, max_words: int) -> tuple[str, int]:
     """
     Limit the number of words in a text to a given number.
@@ -126,3 +142,13 @@ def has_which_substring(text: str, substrings: Iterable[str]) -> str | None:
         if substring in text:
             return substring
     return None
+
+
+def get_text_similarity(text1: str, text2: str) -> float:
+    """
+    Return a similarity ratio between 0 and 1 for two short texts (e.g. queries),
+    ignoring case and differences in whitespace. 1 means the texts are the same.
+    """
+    text1 = " ".join(text1.lower().split())
+    text2 = " ".join(text2.lower().split())
+    return difflib.SequenceMatcher(None, text1, text2).ratio()
@@ -0,0 +1,292 @@
+import hashlib
+import os
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from pydantic import BaseModel
+
+from utils.output import format_exception
+from utils.prepare import get_logger
+from utils.sqlite_utils import SQLiteDB
+
+logger = get_logger()
+
+# Set URL_CACHE_DIR to an empty string to disable the cache
+URL_CACHE_DIR = os.getenv("URL_CACHE_DIR", "url-cache/")
+URL_CACHE_TTL_S = int(os.getenv("URL_CACHE_TTL_S", 24 * 60 * 60))
+URL_CACHE_MAX_MB = int(os.getenv("URL_CACHE_MAX_MB", 500))
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+URL_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS urls (
+    namespace TEXT NOT NULL,
+    url_key TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    fetched_at REAL NOT NULL,
+    last_accessed REAL NOT NULL,
+    PRIMARY KEY (namespace, url_key)
+);
+CREATE INDEX IF NOT EXISTS urls_last_accessed ON urls (last_accessed);
+CREATE TABLE IF NOT EXISTS blobs (
+    content_hash TEXT PRIMARY KEY,
+    size INTEGER NOT NULL
+);
+"""
+
+
+def normalize_url(url: str) -> str:
+    """
+    Normalize a URL for use as a cache key: lowercase the scheme and host, drop
+    the default port and the fragment, and sort the query parameters.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host += f":{parts.port}"
+    if parts.username:
+        userinfo = parts.username + (f":{parts.password}" if parts.password else "")
+        host = f"{userinfo}@{host}"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, host, parts.path or "/", query, ""))
+
+
+class CachedURLContent(BaseModel):
+    content: str
+    etag: str | None = None
+    last_modified: str | None = None
+    fetched_at: float
+    is_fresh: bool
+
+
+class URLCache:
+    """
+    On-disk cache of fetched URL content. The content is stored in files named
+    by its SHA-256 hash (so identical content is stored only once), and a SQLite
+    index maps normalized URLs to the hashes, along with the ETag/Last-Modified
+    headers needed to revalidate stale entries. When the total size of the stored
+    content exceeds max_bytes, the least recently used entries are evicted.
+
+    Entries are kept in separate namespaces (e.g. "aiohttp" and "playwright"),
+    since different fetchers return different content for the same URL.
+    """
+
+    def __init__(self, cache_dir: str, ttl_s: float, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.blob_dir = os.path.join(cache_dir, "blobs")
+        self.ttl_s = ttl_s
+        self.max_bytes = max_bytes
+        self.db = SQLiteDB(os.path.join(cache_dir, "index.sqlite3"), URL_CACHE_SCHEMA)
+        rows = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs")
+        self.total_bytes = rows[0][0]
+
+        self._stats_lock = threading.Lock()
+        self.stats = {
+            "hits": 0,  # fresh entry found
+            "misses": 0,  # no entry found
+            "stale": 0,  # entry found but expired
+            "revalidated": 0,  # expired entry confirmed as unchanged by the server
+            "stores": 0,
+            "evictions": 0,
+        }
+
+    def _increment_stat(self, name: str):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def get_stats(self) -> dict[str, int | float]:
+        """Return the hit/miss counts since startup, the hit rate, and the size."""
+        with self._stats_lock:
+            stats = self.stats.copy()
+        num_lookups = stats["hits"] + stats["misses"] + stats["stale"]
+        num_served = stats["hits"] + stats["revalidated"]
+        stats["hit_rate"] = num_served / num_lookups if num_lookups else 0.0
+        stats["total_bytes"] = self.total_bytes
+        return stats
+
+    def _get_blob_path(self, content_hash: str) -> str:
+        return os.path.join(self.blob_dir, content_hash[:2], content_hash)
+
+    def get(self, url: str, namespace: str) -> CachedURLContent | None:
+        """
+        Return the cached content for the URL, including stale content (which
+        can be revalidated with its ETag/Last-Modified), or None if not cached.
+        """
+        url_key = normalize_url(url)
+        rows = self.db.execute(
+            "SELECT content_hash, etag, last_modified, fetched_at FROM urls "
+            "WHERE namespace = ? AND url_key = ?",
+            (namespace, url_key),
+        )
+        if not rows:
+            self._increment_stat("misses")
+            return None
+
+        content_hash, etag, last_modified, fetched_at = rows[0]
+        try:
+            with open(self._get_blob_path(content_hash), encoding="utf-8") as f:
+                content = f.read()
+        except OSError:
+            # The blob is gone (e.g. deleted by hand), so treat as a miss
+            self._delete_url(namespace, url_key)
+            self._increment_stat("misses")
+            return None
+
+        now = time.time()
+        is_fresh = now - fetched_at < self.ttl_s
+        self._increment_stat("hits" if is_fresh else "stale")
+        self.db.execute(
+            "UPDATE urls SET last_accessed = ? WHERE namespace = ? AND url_key = ?",
+            (now, namespace, url_key),
+        )
+        return CachedURLContent(
+            content=content,
+            etag=etag,
+            last_modified=last_modified,
+            fetched_at=fetched_at,
+            is_fresh=is_fresh,
+        )
+
+    def mark_revalidated(self, url: str, namespace: str) -> None:
+        """Record that the server confirmed a stale entry is unchanged (HTTP 304)."""
+        self._increment_stat("revalidated")
+        self.db.execute(
+            "UPDATE urls SET fetched_at = ? WHERE namespace = ? AND url_key = ?",
+            (time.time(), namespace, normalize_url(url)),
+        )
+
+    def put(
+        self,
+        url: str,
+        namespace: str,
+        content: str,
+        etag: str | None = None,
+        last_modified: str | None = None,
+    ) -> None:
+        """Store the content for the URL and evict old entries if over the size cap."""
+        url_key = normalize_url(url)
+        data = content.encode("utf-8")
+        content_hash = hashlib.sha256(data).hexdigest()
+        blob_path = self._get_blob_path(content_hash)
+
+        # Write the blob first (atomically), so the index never points to a partial file
+        if not os.path.exists(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            tmp_path = f"{blob_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, blob_path)
+
+        now = time.time()
+        with self.db.transaction() as conn:
+            is_new_blob = conn.execute(
+                "INSERT OR IGNORE INTO blobs (content_hash, size) VALUES (?, ?)",
+                (content_hash, len(data)),
+            ).rowcount
+            old_rows = conn.execute(
+                "SELECT content_hash FROM urls WHERE namespace = ? AND url_key = ?",
+                (namespace, url_key),
+            ).fetchall()
+            conn.execute(
+                "INSERT OR REPLACE INTO urls (namespace, url_key, content_hash, etag, "
+                "last_modified, fetched_at, last_accessed) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    namespace,
+                    url_key,
+                    content_hash,
+                    etag,
+                    last_modified,
+                    now,
+                    now,
+                ),
+            )
+            if is_new_blob:
+                self.total_bytes += len(data)
+            if old_rows and old_rows[0][0] != content_hash:
+                self._delete_blob_if_unused(conn, old_rows[0][0])
+
+        self._increment_stat("stores")
+        if self.total_bytes > self.max_bytes:
+            self._evict()
+
+    def _delete_blob_if_unused(self, conn, content_hash: str) -> None:
+        # Must be called inside a transaction
+        if conn.execute(
+            "SELECT 1 FROM urls WHERE content_hash = ? LIMIT 1", (content_hash,)
+        ).fetchone():
+            return
+        rows = conn.execute(
+            "SELECT size FROM blobs WHERE content_hash = ?", (content_hash,)
+        ).fetchall()
+        conn.execute("DELETE FROM blobs WHERE content_hash = ?", (content_hash,))
+        if rows:
+            self.total_bytes -= rows[0][0]
+        try:
+            os.remove(self._get_blob_path(content_hash))
+        except OSError:
+            pass
+
+    def _delete_url(self, namespace: str, url_key: str) -> None:
+        with self.db.transaction() as conn:
+            rows = conn.execute(
+                "SELECT content_hash FROM urls WHERE namespace = ? AND url_key = ?",
+                (namespace, url_key),
+            ).fetchall()
+            conn.execute(
+                "DELETE FROM urls WHERE namespace = ? AND url_key = ?",
+                (namespace, url_key),
+            )
+            if rows:
+                self._delete_blob_if_unused(conn, rows[0][0])
+
+    def _evict(self) -> None:
+        """Evict least recently used entries until the size is at most 90% of the cap."""
+        target_bytes = int(self.max_bytes * 0.9)
+        with self.db.transaction() as conn:
+            rows = conn.execute(
+                "SELECT namespace, url_key, content_hash FROM urls "
+                "ORDER BY last_accessed"
+            ).fetchall()
+            for namespace, url_key, content_hash in rows:
+                if self.total_bytes <= target_bytes:
+                    break
+                conn.execute(
+                    "DELETE FROM urls WHERE namespace = ? AND url_key = ?",
+                    (namespace, url_key),
+                )
+                self._delete_blob_if_unused(conn, content_hash)
+                self._increment_stat("evictions")
+        logger.info(f"URL cache: evicted entries, new size is {self.total_bytes} bytes")
+
+
+_url_cache: URLCache | None = None
+_url_cache_lock = threading.Lock()
+_is_url_cache_unavailable = False
+
+
+def get_url_cache() -> URLCache | None:
+    """
+    Return the process-wide URL cache, or None if it's disabled or couldn't be
+    opened (in which case URLs are simply fetched without it).
+    """
+    global _url_cache, _is_url_cache_unavailable
+    if not URL_CACHE_DIR:
+        return None
+    with _url_cache_lock:
+        if _url_cache is None and not _is_url_cache_unavailable:
+            try:
+                _url_cache = URLCache(
+                    URL_CACHE_DIR, URL_CACHE_TTL_S, URL_CACHE_MAX_MB * 1024 * 1024
+                )
+            except Exception as e:
+                _is_url_cache_unavailable = True  # don't retry on every fetch
+                logger.error(
+                    f"Could not open the URL cache at {URL_CACHE_DIR}, "
+                    f"URLs won't be cached: {format_exception(e)}"
+                )
+    return _url_cache
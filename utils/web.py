@@ -1,33 +1,146 @@
 import asyncio
-import io
+import atexit
+import contextlib
+import functools
 import os
+from concurrent.futures.process import BrokenProcessPool
 from enum import Enum
+from typing import TYPE_CHECKING, AsyncIterator, Awaitable, Callable
 
 import aiohttp
-import trafilatura
-from bs4 import BeautifulSoup
 from fake_useragent import UserAgent
-from langchain_community.document_loaders import AsyncChromiumLoader, AsyncHtmlLoader
-from langchain_community.document_transformers import BeautifulSoupTransformer
-from langchain_community.document_loaders.async_html import default_header_template
-from playwright.async_api import TimeoutError as PlaywrightTimeoutError
-from playwright.async_api import async_playwright
 from pydantic import BaseModel
 
-from utils.async_utils import make_sync
+from utils.async_utils import (
+    discard_process_pool,
+    get_process_pool,
+    make_sync,
+    make_sync_in_shared_loop,
+    shared_loop,
+)
 from utils.helpers import print_no_newline
-from utils.ingest import get_text_from_pdf
+from utils.ingest import get_text_from_pdf_bytes
 from utils.output import format_exception
 from utils.strings import remove_consecutive_blank_lines
+from utils.url_cache import get_url_cache
 from langchain_core.documents import Document
 
+# NOTE: playwright, trafilatura, bs4 and the LangChain loaders are slow to import and
+# not needed by every process (or every fetch), so they are imported on first use
+if TYPE_CHECKING:
+    from playwright.async_api import Browser, Page, Playwright
+
 MAX_PLAYWRIGHT_INSTANCES = 5
-# TODO: 1 causes afetch_urls_in_parallel_playwright to hang (semaphore?)
+
+# Settings for the process-wide browser pool (see BrowserPool)
+NUM_PLAYWRIGHT_BROWSERS = int(os.getenv("NUM_PLAYWRIGHT_BROWSERS", 2))
+MAX_PAGES_PER_PLAYWRIGHT_BROWSER = int(
+    os.getenv("MAX_PAGES_PER_PLAYWRIGHT_BROWSER", 50)
+)
 
 PLAYWRIGHT_TIMEOUT_MS = 10000
 AIOHTTP_TIMEOUT_MS = 10000
 PDF_TEXT_PREFIX = "PLAIN_TEXT[PDF]: "
 
+# Number of worker processes for extracting text from HTML and PDFs (0 means
+# extracting in a thread of the main process instead)
+TEXT_EXTRACTION_WORKERS = int(
+    os.getenv("TEXT_EXTRACTION_WORKERS") or min(4, os.cpu_count() or 1)
+)
+TEXT_EXTRACTION_POOL_NAME = "text-extraction"
+
+# Limits for PDFs fetched from the web: larger PDFs are not downloaded at all (a
+# truncated PDF can't be parsed), and text extraction stops after roughly
+# PDF_MAX_TOKENS tokens (estimated from the number of characters)
+PDF_MAX_DOWNLOAD_MB = int(os.getenv("PDF_MAX_DOWNLOAD_MB", 20))
+PDF_MAX_TOKENS = int(os.getenv("PDF_MAX_TOKENS", 50000))
+CHARS_PER_TOKEN_ESTIMATE = 4
+
+# Settings for the process-wide aiohttp session (see get_shared_aiohttp_session)
+AIOHTTP_MAX_CONNECTIONS = int(os.getenv("AIOHTTP_MAX_CONNECTIONS", 100))
+AIOHTTP_MAX_CONNECTIONS_PER_HOST = int(os.getenv("AIOHTTP_MAX_CONNECTIONS_PER_HOST", 8))
+AIOHTTP_KEEPALIVE_TIMEOUT_S = 30
+AIOHTTP_DNS_CACHE_TTL_S = 300
+
+_shared_aiohttp_session: aiohttp.ClientSession | None = None
+_user_agent: UserAgent | None = None
+
+
+def get_user_agent() -> UserAgent:
+    """Return a cached UserAgent object (loading its data is relatively slow)."""
+    global _user_agent
+    if _user_agent is None:
+        _user_agent = UserAgent()
+    return _user_agent
+
+
+async def _arun_in_extraction_pool(func, *args):
+    """
+    Run a CPU-heavy function (which must be picklable, e.g. a module-level function)
+    in the extraction process pool, or in the default thread pool if
+    TEXT_EXTRACTION_WORKERS is 0 (never on the event loop itself, which would hold
+    up everything else running in it).
+
+    If the process pool is broken because a worker died (e.g. killed for using too
+    much memory), it's replaced with a new one and the function is retried once.
+    """
+    loop = asyncio.get_running_loop()
+    if not TEXT_EXTRACTION_WORKERS:
+        return await loop.run_in_executor(None, func, *args)
+
+    pool = get_process_pool(TEXT_EXTRACTION_POOL_NAME, TEXT_EXTRACTION_WORKERS)
+    try:
+        return await loop.run_in_executor(pool, func, *args)
+    except BrokenProcessPool:
+        discard_process_pool(TEXT_EXTRACTION_POOL_NAME, pool)
+
+    # If the new pool breaks too, the input itself may be what kills the workers
+    pool = get_process_pool(TEXT_EXTRACTION_POOL_NAME, TEXT_EXTRACTION_WORKERS)
+    try:
+        return await loop.run_in_executor(pool, func, *args)
+    except BrokenProcessPool:
+        discard_process_pool(TEXT_EXTRACTION_POOL_NAME, pool)
+        raise
+
+
+def get_shared_aiohttp_session() -> aiohttp.ClientSession:
+    """
+    Return the process-wide aiohttp session, creating it if needed. The session
+    keeps DNS results and keep-alive TCP/TLS connections between batches of URLs,
+    with a limit on the number of connections per host.
+
+    Must be called from within the shared event loop (see utils.async_utils), since
+    an aiohttp session can only be used in the event loop it was created in.
+    """
+    global _shared_aiohttp_session
+    if not shared_loop.is_current():
+        raise RuntimeError("The shared aiohttp session lives in the shared loop.")
+
+    if _shared_aiohttp_session is None or _shared_aiohttp_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=AIOHTTP_MAX_CONNECTIONS,
+            limit_per_host=AIOHTTP_MAX_CONNECTIONS_PER_HOST,
+            ttl_dns_cache=AIOHTTP_DNS_CACHE_TTL_S,
+            keepalive_timeout=AIOHTTP_KEEPALIVE_TIMEOUT_S,
+        )
+        _shared_aiohttp_session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=AIOHTTP_TIMEOUT_MS / 1000),
+        )
+    return _shared_aiohttp_session
+
+
+def _close_shared_aiohttp_session():
+    if _shared_aiohttp_session is None or _shared_aiohttp_session.closed:
+        return
+    try:
+        shared_loop.run(_shared_aiohttp_session.close())
+    except Exception:
+        pass  # we are shutting down anyway
+
+
+atexit.register(_close_shared_aiohttp_session)
+
 
 async def afetch_url_aiohttp(
     session: aiohttp.ClientSession, url: str, retries=3, backoff_factor=0.5
@@ -35,23 +148,60 @@ async def afetch_url_aiohttp(
     """
     Asynchronously fetch a URL using an aiohttp session with retry and exponential backoff.
     It extracts text from PDFs and returns HTML content otherwise.
+
+    If the URL cache is enabled, a fresh cached entry is returned without a request,
+    a stale one is revalidated using its ETag/Last-Modified headers, and successful
+    responses are stored in the cache.
     """
-    header_template = default_header_template
-    header_template["User-Agent"] = UserAgent().random
+    from langchain_community.document_loaders.async_html import default_header_template
+
+    # NOTE: the cache does (fast) blocking disk I/O, which is fine for our purposes
+    url_cache = get_url_cache()
+    cached = url_cache.get(url, "aiohttp") if url_cache else None
+    if cached and cached.is_fresh:
+        return cached.content
+
+    # Copy the template, since the same session can be fetching many URLs at once
+    header_template = default_header_template | {"User-Agent": get_user_agent().random}
+    if cached and cached.etag:
+        header_template["If-None-Match"] = cached.etag
+    if cached and cached.last_modified:
+        header_template["If-Modified-Since"] = cached.last_modified
 
     for attempt in range(retries):
         try:
             async with session.get(url, headers=header_template) as response:
+                if cached and response.status == 304:
+                    url_cache.mark_revalidated(url, "aiohttp")
+                    return cached.content
+
                 response.raise_for_status()  # Raises exception for 4xx/5xx errors
 
                 content_type = response.headers.get("Content-Type", "")
                 if "application/pdf" in content_type:
-                    # Handle PDF content
-                    pdf_content = await response.read()
-                    with io.BytesIO(pdf_content) as pdf_file:
-                        return PDF_TEXT_PREFIX + get_text_from_pdf(pdf_file)
+                    # Handle PDF content (download and extract up to the limits)
+                    pdf_bytes = await _aread_response_up_to(
+                        response, PDF_MAX_DOWNLOAD_MB * 1024 * 1024
+                    )
+                    if pdf_bytes is None:
+                        return f"Error: PDF is larger than {PDF_MAX_DOWNLOAD_MB} MB"
+                    content = PDF_TEXT_PREFIX + await _arun_in_extraction_pool(
+                        get_text_from_pdf_bytes,
+                        pdf_bytes,
+                        PDF_MAX_TOKENS * CHARS_PER_TOKEN_ESTIMATE,
+                    )
                 else:
-                    return await response.text()
+                    content = await response.text()
+
+                if url_cache:
+                    url_cache.put(
+                        url,
+                        "aiohttp",
+                        content,
+                        etag=response.headers.get("ETag"),
+                        last_modified=response.headers.get("Last-Modified"),
+                    )
+                return content
 
         except Exception as e:
             # TODO: ClientError, asyncio.TimeoutError, etc.
@@ -62,12 +212,37 @@ async def afetch_url_aiohttp(
             await asyncio.sleep(sleep_time)
 
 
+async def _aread_response_up_to(
+    response: aiohttp.ClientResponse, max_bytes: int
+) -> bytes | None:
+    """
+    Read the body of a response in chunks, stopping (and returning None) as soon
+    as it's clear that it's larger than max_bytes.
+    """
+    if response.content_length and response.content_length > max_bytes:
+        return None
+    body = bytearray()
+    async for chunk in response.content.iter_chunked(64 * 1024):
+        body += chunk
+        if len(body) > max_bytes:
+            return None
+    return bytes(body)
+
+
 async def afetch_urls_in_parallel_aiohttp(urls):
     """
     Asynchronously fetch multiple URLs in parallel using aiohttp.
     Return the HTML content of each URL. If there is an error in a particular URL,
     return the error message instead of that URL's content, starting with "Error: ".
+
+    When run in the shared event loop, the process-wide session is used, so that
+    connections are reused across batches. Otherwise, a temporary session is created.
     """
+    if shared_loop.is_current():
+        session = get_shared_aiohttp_session()
+        tasks = [afetch_url_aiohttp(session, url) for url in urls]
+        return await asyncio.gather(*tasks)
+
     timeout = aiohttp.ClientTimeout(total=AIOHTTP_TIMEOUT_MS / 1000)
     async with aiohttp.ClientSession(timeout=timeout) as session:
         tasks = [afetch_url_aiohttp(session, url) for url in urls]
@@ -76,47 +251,251 @@ async def afetch_urls_in_parallel_aiohttp(urls):
     return htmls
 
 
+class _PooledBrowser:
+    """A browser in a BrowserPool, with the bookkeeping needed to recycle it."""
+
+    def __init__(self, browser: "Browser"):
+        self.browser = browser
+        self.num_pages_served = 0
+        self.num_active_contexts = 0
+        self.is_retired = False
+
+
+class BrowserPool:
+    """
+    Pool of warm Chromium instances (launched with playwright). Each fetch gets a
+    fresh browser context (so no cookies, cache, etc. are shared between fetches),
+    but the browser processes themselves are reused. A browser is retired after
+    serving max_pages_per_browser pages or if it crashes, and closed once its last
+    context is done.
+
+    All methods must be awaited in the same event loop.
+    """
+
+    def __init__(
+        self,
+        num_browsers: int = NUM_PLAYWRIGHT_BROWSERS,
+        max_pages_per_browser: int = MAX_PAGES_PER_PLAYWRIGHT_BROWSER,
+        max_concurrent_pages: int = MAX_PLAYWRIGHT_INSTANCES,
+        headless: bool = True,
+    ):
+        self.num_browsers = num_browsers
+        self.max_pages_per_browser = max_pages_per_browser
+        self.max_concurrent_pages = max_concurrent_pages
+        self.headless = headless
+
+        self._pwt: "Playwright | None" = None
+        self._device: dict | None = None
+        self._browsers: list[_PooledBrowser] = []
+        self._lock: asyncio.Lock | None = None
+        self._semaphore: asyncio.Semaphore | None = None
+
+    async def _astart(self):
+        # NOTE: the lock and semaphore are created here to bind them to the right loop
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+            self._semaphore = asyncio.Semaphore(self.max_concurrent_pages)
+        if self._pwt is None:
+            from playwright.async_api import async_playwright
+
+            self._pwt = await async_playwright().start()
+            self._device = self._pwt.devices["iPhone 13"]
+
+    async def _aclose_browser(self, pooled_browser: _PooledBrowser):
+        try:
+            await pooled_browser.browser.close()
+        except Exception:
+            pass  # it may have crashed already
+
+    async def _aacquire_browser(self) -> _PooledBrowser:
+        async with self._lock:
+            # Forget retired and crashed browsers (the latter are closed just in case)
+            for pooled_browser in self._browsers:
+                if not pooled_browser.browser.is_connected():
+                    pooled_browser.is_retired = True
+                    if not pooled_browser.num_active_contexts:
+                        await self._aclose_browser(pooled_browser)
+            self._browsers = [b for b in self._browsers if not b.is_retired]
+
+            # Launch a new browser if below the target number, else use the least busy
+            if len(self._browsers) < self.num_browsers:
+                browser = await self._pwt.chromium.launch(headless=self.headless)
+                pooled_browser = _PooledBrowser(browser)
+                self._browsers.append(pooled_browser)
+            else:
+                pooled_browser = min(self._browsers, key=lambda b: b.num_active_contexts)
+
+            pooled_browser.num_active_contexts += 1
+            pooled_browser.num_pages_served += 1
+            if pooled_browser.num_pages_served >= self.max_pages_per_browser:
+                pooled_browser.is_retired = True  # no new pages; close when idle
+            return pooled_browser
+
+    async def _arelease_browser(self, pooled_browser: _PooledBrowser):
+        pooled_browser.num_active_contexts -= 1
+        if not pooled_browser.browser.is_connected():
+            pooled_browser.is_retired = True
+        if pooled_browser.is_retired and not pooled_browser.num_active_contexts:
+            await self._aclose_browser(pooled_browser)
+
+    async def awarm_up(self):
+        """Launch all browsers in advance, so that the first fetches are fast."""
+        await self._astart()
+        async with self._lock:
+            while len(self._browsers) < self.num_browsers:
+                browser = await self._pwt.chromium.launch(headless=self.headless)
+                self._browsers.append(_PooledBrowser(browser))
+
+    @contextlib.asynccontextmanager
+    async def anew_page(self) -> AsyncIterator["Page"]:
+        """
+        Context manager that provides a page in a fresh context of one of the
+        pooled browsers. Waits if max_concurrent_pages pages are already in use.
+        """
+        await self._astart()
+        async with self._semaphore:
+            pooled_browser = await self._aacquire_browser()
+            context = None
+            try:
+                context = await pooled_browser.browser.new_context(**self._device)
+                yield await context.new_page()
+            finally:
+                if context is not None:
+                    try:
+                        await context.close()
+                    except Exception:
+                        pass  # the browser may have crashed
+                await self._arelease_browser(pooled_browser)
+
+    async def aclose(self):
+        """Close all browsers and stop playwright."""
+        if self._lock is None:
+            return
+        async with self._lock:
+            for pooled_browser in self._browsers:
+                await self._aclose_browser(pooled_browser)
+            self._browsers = []
+            if self._pwt is not None:
+                await self._pwt.stop()
+                self._pwt = None
+
+
+_shared_browser_pool: BrowserPool | None = None
+
+
+def get_shared_browser_pool() -> BrowserPool:
+    """
+    Return the process-wide browser pool, creating it if needed. Like the shared
+    aiohttp session, it must only be used from within the shared event loop.
+    """
+    global _shared_browser_pool
+    if not shared_loop.is_current():
+        raise RuntimeError("The shared browser pool lives in the shared loop.")
+
+    if _shared_browser_pool is None:
+        _shared_browser_pool = BrowserPool()
+    return _shared_browser_pool
+
+
+def _close_shared_browser_pool():
+    if _shared_browser_pool is None:
+        return
+    try:
+        shared_loop.run(_shared_browser_pool.aclose())
+    except Exception:
+        pass  # we are shutting down anyway
+
+
+atexit.register(_close_shared_browser_pool)
+
+
+async def _aget_page_content(
+    page: "Page", url: str, sleep_after_load_ms, **fetch_options
+):
+    from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+
+    try:
+        await page.goto(url, **fetch_options)  # eg wait_until="networkidle"
+        if sleep_after_load_ms:
+            await asyncio.sleep(sleep_after_load_ms / 1000)
+        return await page.content()
+    except PlaywrightTimeoutError:
+        # Still try to get the content
+        html_content = await page.content()
+        if not html_content or html_content.startswith(
+            "<html><head></head><body></body></html>"
+        ):
+            html_content = "Error: timed out before any content was loaded"
+        return html_content
+
+
 async def afetch_url_playwright(
     url: str,
     headless=True,
     timeout=PLAYWRIGHT_TIMEOUT_MS,
     sleep_after_load_ms=0,
+    browser_pool: BrowserPool | None = None,
     **fetch_options,
 ):
     """
     Asynchronously fetch the content from a URL using an instance of
     Chromium (with playwright).
 
+    If browser_pool is given, a page from the pool is used. Otherwise, when run
+    headless in the shared event loop, the shared browser pool is used, and in other
+    cases a new browser is launched just for this URL.
+
+    If the URL cache is enabled, fresh cached content is returned without fetching
+    (there is no revalidation, since we don't get the response headers), and
+    successfully fetched content is stored in the cache.
+
     If there is an error, return the error message instead.
     """
+    url_cache = get_url_cache()
+    cached = url_cache.get(url, "playwright") if url_cache else None
+    if cached and cached.is_fresh:
+        return cached.content
+
     fetch_options["timeout"] = timeout
+    if browser_pool is None and headless and shared_loop.is_current():
+        browser_pool = get_shared_browser_pool()
+
     try:
-        async with async_playwright() as pwt:
-            # NOTE: consider whether to use one pwt for all parallel fetches
-            # browser = await pwt.webkit.launch(headless=False)
-            browser = await pwt.chromium.launch(headless=headless)
-            iphone_13 = pwt.devices["iPhone 13"]
-            context = await browser.new_context(**iphone_13)
-            page = await context.new_page()
-            try:
-                await page.goto(url, **fetch_options)  # eg wait_until="networkidle"
-                if sleep_after_load_ms:
-                    await asyncio.sleep(sleep_after_load_ms / 1000)
-                html_content = await page.content()
-            except PlaywrightTimeoutError:
-                # Still try to get the content
-                html_content = await page.content()
-                if not html_content or html_content.startswith(
-                    "<html><head></head><body></body></html>"
-                ):
-                    html_content = "Error: timed out before any content was loaded"
-            finally:
-                await browser.close()
+        if browser_pool is not None:
+            async with browser_pool.anew_page() as page:
+                html_content = await _aget_page_content(
+                    page, url, sleep_after_load_ms, **fetch_options
+                )
+        else:
+            html_content = await _afetch_url_playwright_new_browser(
+                url, headless, sleep_after_load_ms, **fetch_options
+            )
     except Exception as e:
         html_content = f"Error: {e}"
+
+    if url_cache and not html_content.startswith("Error: "):
+        url_cache.put(url, "playwright", html_content)
     return html_content
 
 
+async def _afetch_url_playwright_new_browser(
+    url: str, headless: bool, sleep_after_load_ms, **fetch_options
+):
+    from playwright.async_api import async_playwright
+
+    async with async_playwright() as pwt:
+        browser = await pwt.chromium.launch(headless=headless)
+        iphone_13 = pwt.devices["iPhone 13"]
+        context = await browser.new_context(**iphone_13)
+        page = await context.new_page()
+        try:
+            return await _aget_page_content(
+                page, url, sleep_after_load_ms, **fetch_options
+            )
+        finally:
+            await browser.close()
+
+
 async def afetch_urls_in_parallel_playwright(
     urls,
     headless=True,
@@ -130,10 +509,16 @@ async def afetch_urls_in_parallel_playwright(
     Chromium (with playwright). Return the HTML content of each URL.
     If there is an error in a particular URL, return the error message instead.
 
-    Uses a semaphore to limit the number of concurrent playwright instances to
-    MAX_PLAYWRIGHT_INSTANCES.
+    When run headless in the shared event loop, pages come from the shared browser
+    pool, which limits the number of concurrent pages. Otherwise, a semaphore limits
+    the number of concurrent playwright instances to MAX_PLAYWRIGHT_INSTANCES.
     """
-    semaphore = asyncio.Semaphore(MAX_PLAYWRIGHT_INSTANCES)
+    if headless and shared_loop.is_current():
+        browser_pool = get_shared_browser_pool()
+        semaphore = contextlib.nullcontext()  # the pool has its own limit
+    else:
+        browser_pool = None
+        semaphore = asyncio.Semaphore(MAX_PLAYWRIGHT_INSTANCES)
 
     async def fetch_with_semaphore(url):
         async with semaphore:
@@ -142,6 +527,7 @@ async def afetch_urls_in_parallel_playwright(
                 headless=headless,
                 timeout=timeout,
                 sleep_after_load_ms=sleep_after_load_ms,
+                browser_pool=browser_pool,
                 **fetch_options,
             )
             if callback:
@@ -173,6 +559,8 @@ async def afetch_urls_in_parallel_chromium_loader(urls):
     Uses a semaphore to limit the number of concurrent playwright instances to
     MAX_PLAYWRIGHT_INSTANCES.
     """
+    from langchain_community.document_loaders import AsyncChromiumLoader
+
     semaphore = asyncio.Semaphore(MAX_PLAYWRIGHT_INSTANCES)
     loader = AsyncChromiumLoader([])
 
@@ -190,6 +578,8 @@ async def afetch_urls_in_parallel_html_loader(urls):
     Asynchronously fetch multiple URLs in parallel using AsyncHtmlLoader.
     Return the HTML content of each URL.
     """
+    from langchain_community.document_loaders import AsyncHtmlLoader
+    from langchain_community.document_loaders.async_html import default_header_template
 
     header_template = default_header_template
     header_template["User-Agent"] = UserAgent().random
@@ -205,6 +595,9 @@ def fetch_urls_with_lc_html_loader(urls):
     NOTE: The current implementation of AsyncHtmlLoader's load() appears to first fetch the URLs
     in parallel, but then to fetch them again sequentially.
     """
+    from langchain_community.document_loaders import AsyncHtmlLoader
+    from langchain_community.document_loaders.async_html import default_header_template
+
     header_template = default_header_template
     header_template["User-Agent"] = UserAgent().random
     loader = AsyncHtmlLoader(urls, header_template=header_template)
@@ -249,6 +642,8 @@ def get_text_from_html(
         return html_content
 
     if mode == TextFromHtmlMode.TRAFILATURA:
+        import trafilatura
+
         # https://trafilatura.readthedocs.io/en/latest/usage-python.html
         text = trafilatura.extract(
             html_content,
@@ -262,6 +657,8 @@ def get_text_from_html(
         clean = False  # trafilatura already does some cleaning
     elif mode == TextFromHtmlMode.LC_BS_TRANSFORMER:
         # Use langchain to extract text
+        from langchain_community.document_transformers import BeautifulSoupTransformer
+
         bs_transformer = BeautifulSoupTransformer()
         tmp_docs = [Document(page_content=html_content)]
         docs_transformed = bs_transformer.transform_documents(
@@ -272,6 +669,8 @@ def get_text_from_html(
         )
         text = docs_transformed[0].page_content
     else:
+        from bs4 import BeautifulSoup
+
         soup = BeautifulSoup(html_content, "html.parser")
         # Remove script and style elements
         for script_or_style in soup(["script", "style"]):
@@ -328,6 +727,7 @@ class LinkData(BaseModel):
     error: str | None = None
     num_tokens: int | None = None
     is_ingested: bool = False
+    doc_id: str | None = None  # id of the ingested full doc, which holds the text
 
     @classmethod
     def from_raw_content(cls, content: str):
@@ -344,13 +744,116 @@ class LinkData(BaseModel):
         return cls(text=text, error="UNACCEPTABLE_EXTRACTED_TEXT")
 
 
+def extract_link_data(content: str) -> LinkData:
+    """
+    Return a LinkData instance from the raw content of a URL. Module-level function,
+    so that it can be sent to the worker processes of the extraction process pool.
+    """
+    return LinkData.from_raw_content(content)
+
+
+def _needs_html_extraction(content: str) -> bool:
+    # Errors and PDF text are turned into LinkData without any heavy lifting
+    return not content.startswith("Error: ") and not content.startswith(PDF_TEXT_PREFIX)
+
+
+async def aextract_link_data(content: str) -> LinkData:
+    """
+    Asynchronously obtain LinkData from the raw content of a URL. Text extraction
+    from HTML (trafilatura) is CPU-heavy, so it's done in the extraction process
+    pool (see _arun_in_extraction_pool).
+    """
+    if not _needs_html_extraction(content):
+        return LinkData.from_raw_content(content)
+    return await _arun_in_extraction_pool(extract_link_data, content)
+
+
+async def afetch_link_data(url: str) -> LinkData:
+    """
+    Asynchronously fetch a URL and obtain its LinkData (see aextract_link_data).
+
+    Must be run in the shared event loop (uses the shared aiohttp session or,
+    if USE_PLAYWRIGHT is set, the shared browser pool).
+    """
+    if os.getenv("USE_PLAYWRIGHT"):
+        content = await afetch_url_playwright(url)
+    else:
+        content = await afetch_url_aiohttp(get_shared_aiohttp_session(), url)
+    return await aextract_link_data(content)
+
+
+async def afetch_link_data_in_parallel(urls: list[str]) -> list[LinkData]:
+    """
+    Asynchronously fetch multiple URLs in parallel and obtain their LinkData. The
+    text of each page is extracted as soon as the page is fetched, so that the
+    extraction overlaps with the fetching of the remaining pages.
+
+    Must be run in the shared event loop (see afetch_link_data).
+    """
+    return await asyncio.gather(*(afetch_link_data(url) for url in urls))
+
+
+async def astream_link_data(
+    urls: list[str],
+    max_in_flight: int | Callable[[], int],
+    afetch_link_data_func: Callable[[str], Awaitable[LinkData]] = afetch_link_data,
+) -> AsyncIterator[tuple[str, LinkData]]:
+    """
+    Asynchronously fetch URLs (in order) and obtain their LinkData, yielding
+    (url, link_data) pairs as soon as each URL is done, i.e. in order of completion.
+
+    At most max_in_flight URLs are in flight at a time (max_in_flight can be a
+    function, which is then called each time before starting new fetches), and
+    new fetches start as soon as the consumer has received a result, so that a
+    slow site doesn't hold up the rest. If the consumer stops early (and closes
+    the generator, e.g. with aclose()), the fetches still in flight are cancelled.
+    """
+    in_flight: dict[asyncio.Task, str] = {}
+    url_iter = iter(urls)
+
+    def start_fetches():
+        limit = max_in_flight() if callable(max_in_flight) else max_in_flight
+        while len(in_flight) < max(1, limit):
+            if (url := next(url_iter, None)) is None:
+                return
+            in_flight[asyncio.create_task(afetch_link_data_func(url))] = url
+
+    try:
+        start_fetches()
+        while in_flight:
+            done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                url = in_flight.pop(task)
+                try:
+                    link_data = task.result()
+                except Exception as e:
+                    link_data = LinkData(error=f"Error: {format_exception(e)}")
+                yield url, link_data
+            start_fetches()
+    finally:
+        for task in in_flight:
+            task.cancel()
+        if in_flight:
+            await asyncio.gather(*in_flight, return_exceptions=True)
+
+
+def get_batch_link_data_fetcher() -> Callable[[list[str]], list[LinkData]]:
+    """
+    Return a function that fetches a batch of URLs and returns their LinkData,
+    with text extraction overlapped with fetching (see afetch_link_data_in_parallel).
+    """
+    return make_sync_in_shared_loop(afetch_link_data_in_parallel)
+
+
 def get_batch_url_fetcher():
     """Decide which fetcher to use for the links."""
     if not os.getenv("USE_PLAYWRIGHT"):
-        return make_sync(afetch_urls_in_parallel_aiohttp)
+        # Use the shared loop to reuse the shared session's connections across batches
+        return make_sync_in_shared_loop(afetch_urls_in_parallel_aiohttp)
 
     def link_fetcher(links):
-        return make_sync(afetch_urls_in_parallel_playwright)(
+        # Use the shared loop to reuse the shared pool's browsers across batches
+        return make_sync_in_shared_loop(afetch_urls_in_parallel_playwright)(
             links, callback=lambda url, html: print_no_newline(".")
         )
 